@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Memory taken by the parsed metadata of many Service Providers, as nested
+saml_to_dict dictionaries and as spmodel objects.
+
+    python benchmarks/metadata_memory.py [--sps 1000] [--metadata path]
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import gc
+import os.path
+import sys
+import tracemalloc
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_PATH)
+
+from testenv.spmodel import parse_entity_descriptor  # noqa: E402 isort:skip
+from testenv.utils import saml_to_dict  # noqa: E402 isort:skip
+
+EXAMPLE_METADATA = os.path.join(ROOT_PATH, 'testenv', 'tests', 'data', 'sp-metadata.xml.example')
+
+
+def _documents(path, count):
+    with open(path, 'rb') as fp:
+        xml = fp.read()
+    entity_id = b'https://spid.test:8000'
+    return [
+        xml.replace(entity_id, 'https://sp{}.spid.test'.format(index).encode('ascii'))
+        for index in range(count)
+    ]
+
+
+def measure(parse, documents):
+    gc.collect()
+    tracemalloc.start()
+    parsed = [parse(document) for document in documents]
+    gc.collect()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del parsed
+    return size, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sps', type=int, default=1000)
+    parser.add_argument('--metadata', default=EXAMPLE_METADATA)
+    args = parser.parse_args()
+    documents = _documents(args.metadata, args.sps)
+    results = [
+        ('saml_to_dict', measure(saml_to_dict, documents)),
+        ('spmodel', measure(parse_entity_descriptor, documents)),
+    ]
+    print('{} SP'.format(args.sps))
+    for name, (size, peak) in results:
+        print('{:<14} {:>10.1f} KiB  {:>8.1f} KiB/SP  (picco {:.1f} KiB)'.format(
+            name, size / 1024.0, size / 1024.0 / args.sps, peak / 1024.0))
+    print('rapporto: {:.1f}x'.format(results[0][1][0] / float(results[1][1][0])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Time taken to build an unsigned Response with create_response() and with
+a ResponseFactory reusing its precompiled skeleton.
+
+    python benchmarks/response_builder.py [--requests 5000]
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import os.path
+import sys
+import timeit
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_PATH)
+
+from testenv.saml import ResponseFactory, create_response  # noqa: E402 isort:skip
+from testenv.settings import SPID_ATTRIBUTES, SPID_LEVEL_1, STATUS_SUCCESS  # noqa: E402 isort:skip
+
+DATA = {
+    'response': {'attrs': {'in_response_to': 'id_request', 'destination': 'https://sp.example.org/acs'}},
+    'issuer': {'attrs': {'name_qualifier': 'https://idp.example.org'}, 'text': 'https://idp.example.org'},
+    'name_id': {'attrs': {'name_qualifier': 'https://idp.example.org'}},
+    'subject_confirmation_data': {'attrs': {'recipient': 'https://sp.example.org/acs'}},
+    'audience': {'text': 'https://sp.example.org'},
+    'authn_context_class_ref': {'text': SPID_LEVEL_1},
+}
+STATUS = {'status_code': STATUS_SUCCESS}
+ATTRIBUTES = dict(
+    (name, (attr_type, 'value of {}'.format(name)))
+    for name, attr_type in SPID_ATTRIBUTES['primary'].items()
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=5000)
+    args = parser.parse_args()
+    factory = ResponseFactory()
+    builders = [
+        ('create_response', lambda: create_response(DATA, STATUS, ATTRIBUTES).to_xml()),
+        ('ResponseFactory', lambda: factory.create_response(DATA, STATUS, ATTRIBUTES)),
+    ]
+    print('{} risposte, {} attributi'.format(args.requests, len(ATTRIBUTES)))
+    timings = []
+    for name, build in builders:
+        build()
+        elapsed = min(timeit.repeat(build, number=args.requests, repeat=3))
+        timings.append(elapsed)
+        print('{:<16} {:>8.1f} µs/risposta'.format(name, elapsed / args.requests * 1e6))
+    print('rapporto: {:.1f}x'.format(timings[0] / timings[1]))
+
+
+if __name__ == '__main__':
+    main()
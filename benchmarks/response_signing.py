@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Allocations made to sign a logout response for the HTTP-POST binding,
+passing sign_http_post() the serialized message or its element tree.
+
+    python benchmarks/response_signing.py [--responses 200]
+
+tracemalloc only sees the Python heap: the buffers allocated by libxml2
+while serializing and parsing are not counted, the timings include them.
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_PATH)
+
+from testenv.crypto import load_certificate_chain, load_private_key, sign_http_post  # noqa: E402 isort:skip
+from testenv.saml import create_logout_response  # noqa: E402 isort:skip
+from testenv.settings import STATUS_SUCCESS  # noqa: E402 isort:skip
+from testenv.tests.utils import generate_certificate  # noqa: E402 isort:skip
+
+DATA = {
+    'logout_response': {'attrs': {'in_response_to': 'id_request', 'destination': 'https://sp.example.org/slo'}},
+    'issuer': {'attrs': {'name_qualifier': 'https://idp.example.org'}, 'text': 'https://idp.example.org'},
+}
+STATUS = {'status_code': STATUS_SUCCESS}
+
+
+def _load_credentials():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        generate_certificate(fname='idp', path=tmpdir)
+        with open(os.path.join(tmpdir, 'idp.key'), 'rb') as key, \
+                open(os.path.join(tmpdir, 'idp.crt'), 'rb') as cert:
+            return load_private_key(key.read()), load_certificate_chain(cert.read())
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def measure(sign, count):
+    """
+    Time per call and average peak of the Python heap during a call.
+    """
+    sign()
+    elapsed = peaks = 0
+    for _ in range(count):
+        tracemalloc.start()
+        started = time.time()
+        sign()
+        elapsed += time.time() - started
+        peaks += tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return elapsed / count, peaks / float(count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--responses', type=int, default=200)
+    args = parser.parse_args()
+    key, cert = _load_credentials()
+
+    def from_bytes():
+        xml = create_logout_response(DATA, STATUS).to_xml()
+        return sign_http_post(xml, key, cert, message=True, assertion=False)
+
+    def from_tree():
+        tree = create_logout_response(DATA, STATUS).tree
+        return sign_http_post(tree, key, cert, message=True, assertion=False)
+
+    print('{} risposte'.format(args.responses))
+    results = []
+    for name, sign in (('bytes', from_bytes), ('albero', from_tree)):
+        elapsed, peak = measure(sign, args.responses)
+        results.append(peak)
+        print('{:<8} {:>8.1f} µs/risposta  picco {:>6.1f} KiB/risposta'.format(
+            name, elapsed * 1e6, peak / 1024.0))
+    print('risparmiati: {:.1f} KiB/risposta'.format((results[0] - results[1]) / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
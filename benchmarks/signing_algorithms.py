@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Time taken to sign a login Response (HTTP-POST) and a logout Response
+(HTTP-Redirect) with each signature algorithm, for an RSA 2048 and an
+ECDSA P-256 key.
+
+    python benchmarks/signing_algorithms.py [--responses 300] [--engine fast]
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import os.path
+import shutil
+import sys
+import tempfile
+import timeit
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_PATH)
+
+from testenv.crypto import (  # noqa: E402 isort:skip
+    SIGNING_ENGINES, load_certificate_chain, load_private_key, sign_http_post, sign_http_redirect,
+)
+from testenv.saml import ResponseFactory, create_logout_response  # noqa: E402 isort:skip
+from testenv.settings import (  # noqa: E402 isort:skip
+    DIGEST_SHA256, ECDSA_ALGORITHMS, SPID_ATTRIBUTES, SPID_LEVEL_1, STATUS_SUCCESS, SUPPORTED_ALGORITHMS,
+)
+from testenv.tests.utils import generate_certificate, generate_ecdsa_certificate  # noqa: E402 isort:skip
+
+DATA = {
+    'response': {'attrs': {'in_response_to': 'id_request', 'destination': 'https://sp.example.org/acs'}},
+    'issuer': {'attrs': {'name_qualifier': 'https://idp.example.org'}, 'text': 'https://idp.example.org'},
+    'name_id': {'attrs': {'name_qualifier': 'https://idp.example.org'}},
+    'subject_confirmation_data': {'attrs': {'recipient': 'https://sp.example.org/acs'}},
+    'audience': {'text': 'https://sp.example.org'},
+    'authn_context_class_ref': {'text': SPID_LEVEL_1},
+}
+LOGOUT_DATA = {
+    'logout_response': {'attrs': {'in_response_to': 'id_request', 'destination': 'https://sp.example.org/slo'}},
+    'issuer': {'attrs': {'name_qualifier': 'https://idp.example.org'}, 'text': 'https://idp.example.org'},
+}
+STATUS = {'status_code': STATUS_SUCCESS}
+ATTRIBUTES = dict(
+    (name, (attr_type, 'value of {}'.format(name)))
+    for name, attr_type in SPID_ATTRIBUTES['primary'].items()
+)
+
+
+def _load_credentials(generate):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        generate(fname='idp', path=tmpdir)
+        with open(os.path.join(tmpdir, 'idp.key'), 'rb') as key, \
+                open(os.path.join(tmpdir, 'idp.crt'), 'rb') as cert:
+            return load_private_key(key.read()), load_certificate_chain(cert.read())
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--responses', type=int, default=300)
+    parser.add_argument('--engine', choices=sorted(SIGNING_ENGINES), default='fast')
+    args = parser.parse_args()
+    xml = ResponseFactory().create_response(DATA, STATUS, ATTRIBUTES)
+    logout_xml = create_logout_response(LOGOUT_DATA, STATUS).to_xml()
+    keys = [
+        (generate_certificate, SUPPORTED_ALGORITHMS),
+        (generate_ecdsa_certificate, ECDSA_ALGORITHMS),
+    ]
+    print('{} risposte, motore "{}", digest sha256'.format(args.responses, args.engine))
+    print('{:<14} {:>14} {:>14}'.format('algoritmo', 'HTTP-POST', 'HTTP-Redirect'))
+    for generate, algorithms in keys:
+        key, cert = _load_credentials(generate)
+        for algorithm in algorithms:
+            jobs = [
+                lambda: sign_http_post(
+                    xml, key, cert, engine=args.engine, algorithm=algorithm, digest_algorithm=DIGEST_SHA256),
+                lambda: sign_http_redirect(logout_xml, key, algorithm=algorithm),
+            ]
+            timings = []
+            for job in jobs:
+                job()
+                elapsed = min(timeit.repeat(job, number=args.responses, repeat=3))
+                timings.append(elapsed / args.responses * 1e6)
+            print('{:<14} {:>11.1f} µs {:>11.1f} µs'.format(algorithm.split('#')[1], *timings))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Time taken to sign the Assertion of a login Response with each of the
+engines of sign_http_post().
+
+    python benchmarks/signing_engines.py [--responses 1000]
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import os.path
+import shutil
+import sys
+import tempfile
+import timeit
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_PATH)
+
+from testenv.crypto import (  # noqa: E402 isort:skip
+    SIGNING_ENGINES, load_certificate_chain, load_private_key, sign_http_post,
+)
+from testenv.saml import ResponseFactory  # noqa: E402 isort:skip
+from testenv.settings import SPID_ATTRIBUTES, SPID_LEVEL_1, STATUS_SUCCESS  # noqa: E402 isort:skip
+from testenv.tests.utils import generate_certificate  # noqa: E402 isort:skip
+
+DATA = {
+    'response': {'attrs': {'in_response_to': 'id_request', 'destination': 'https://sp.example.org/acs'}},
+    'issuer': {'attrs': {'name_qualifier': 'https://idp.example.org'}, 'text': 'https://idp.example.org'},
+    'name_id': {'attrs': {'name_qualifier': 'https://idp.example.org'}},
+    'subject_confirmation_data': {'attrs': {'recipient': 'https://sp.example.org/acs'}},
+    'audience': {'text': 'https://sp.example.org'},
+    'authn_context_class_ref': {'text': SPID_LEVEL_1},
+}
+STATUS = {'status_code': STATUS_SUCCESS}
+ATTRIBUTES = dict(
+    (name, (attr_type, 'value of {}'.format(name)))
+    for name, attr_type in SPID_ATTRIBUTES['primary'].items()
+)
+
+
+def _load_credentials():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        generate_certificate(fname='idp', path=tmpdir)
+        with open(os.path.join(tmpdir, 'idp.key'), 'rb') as key, \
+                open(os.path.join(tmpdir, 'idp.crt'), 'rb') as cert:
+            return load_private_key(key.read()), load_certificate_chain(cert.read())
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--responses', type=int, default=1000)
+    args = parser.parse_args()
+    key, cert = _load_credentials()
+    xml = ResponseFactory().create_response(DATA, STATUS, ATTRIBUTES)
+    print('{} risposte, {} attributi'.format(args.responses, len(ATTRIBUTES)))
+    timings = []
+    for engine in sorted(SIGNING_ENGINES, reverse=True):
+        def sign():
+            return sign_http_post(xml, key, cert, engine=engine)
+        sign()
+        elapsed = min(timeit.repeat(sign, number=args.responses, repeat=3))
+        timings.append(elapsed)
+        print('{:<8} {:>8.1f} µs/risposta'.format(engine, elapsed / args.responses * 1e6))
+    print('rapporto: {:.1f}x'.format(timings[0] / timings[1]))
+
+
+if __name__ == '__main__':
+    main()
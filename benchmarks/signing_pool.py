@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Signed login responses per second with several request threads, signing
+inline or through a PoolSigningService.
+
+    python benchmarks/signing_pool.py [--responses 400] [--threads 8] [--workers 4]
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_PATH)
+
+from testenv.saml import ResponseFactory  # noqa: E402 isort:skip
+from testenv.settings import SPID_ATTRIBUTES, SPID_LEVEL_1, STATUS_SUCCESS  # noqa: E402 isort:skip
+from testenv.signing import InlineSigningService, PoolSigningService  # noqa: E402 isort:skip
+from testenv.tests.utils import generate_certificate  # noqa: E402 isort:skip
+
+DATA = {
+    'response': {'attrs': {'in_response_to': 'id_request', 'destination': 'https://sp.example.org/acs'}},
+    'issuer': {'attrs': {'name_qualifier': 'https://idp.example.org'}, 'text': 'https://idp.example.org'},
+    'name_id': {'attrs': {'name_qualifier': 'https://idp.example.org'}},
+    'subject_confirmation_data': {'attrs': {'recipient': 'https://sp.example.org/acs'}},
+    'audience': {'text': 'https://sp.example.org'},
+    'authn_context_class_ref': {'text': SPID_LEVEL_1},
+}
+STATUS = {'status_code': STATUS_SUCCESS}
+ATTRIBUTES = dict(
+    (name, (attr_type, 'value of {}'.format(name)))
+    for name, attr_type in SPID_ATTRIBUTES['primary'].items()
+)
+
+
+def _read_credentials():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        generate_certificate(fname='idp', path=tmpdir)
+        with open(os.path.join(tmpdir, 'idp.key'), 'rb') as key, \
+                open(os.path.join(tmpdir, 'idp.crt'), 'rb') as cert:
+            return key.read(), cert.read()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--responses', type=int, default=400)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+    key, cert = _read_credentials()
+    xml = ResponseFactory().create_response(DATA, STATUS, ATTRIBUTES)
+    services = [
+        ('inline', InlineSigningService(key, cert)),
+        ('pool', PoolSigningService(key, cert, workers=args.workers, queue_size=args.responses)),
+    ]
+    print('{} risposte, {} thread, {} processi'.format(args.responses, args.threads, args.workers))
+    threads = ThreadPool(args.threads)
+    try:
+        for name, service in services:
+            service.sign_http_post(xml)
+            started = time.time()
+            threads.map(lambda _: service.sign_http_post(xml), range(args.responses))
+            elapsed = time.time() - started
+            print('{:<8} {:>8.1f} risposte/s'.format(name, args.responses / elapsed))
+            if name == 'pool':
+                stats = service.stats
+                print('latenza media {:.1f} ms, massima {:.1f} ms, coda massima {}'.format(
+                    stats['average_latency'] * 1e3, stats['max_latency'] * 1e3, stats['max_pending']))
+                service.close()
+    finally:
+        threads.close()
+        threads.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -5,11 +5,8 @@ import argparse
 import os
 import os.path
 
-from flask import Flask
-
-from testenv import config, spmetadata
 from testenv.exceptions import BadConfiguration
-from testenv.server import IdpServer
+from testenv.wsgi import ProductionServer, create_app
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -21,13 +18,21 @@ if __name__ == '__main__':
         '-ct', dest='configuration_type',
         help='Configuration type [yaml|json]', default='yaml'
     )
+    parser.add_argument(
+        '--server', dest='server', choices=['development', 'production'],
+        help='Web server [development|production]', default='development'
+    )
     args = parser.parse_args()
+    if args.server == 'development':
+        os.environ['FLASK_ENV'] = 'development'
     try:
-        config.load(args.config, args.configuration_type)
+        # the gunicorn workers start their own threads, not the master
+        app = create_app(
+            args.config, args.configuration_type, start_threads=args.server != 'production')
     except BadConfiguration as e:
         print(e)
     else:
-        spmetadata.build_metadata_registry()
-        os.environ['FLASK_ENV'] = 'development'
-        server = IdpServer(app=Flask(__name__, static_url_path='/static'))
-        server.start()
+        if args.server == 'production':
+            ProductionServer(app).run()
+        else:
+            app.extensions['idp_server'].start()
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hmac
+import time
+
+from flask import jsonify, request
+
+from testenv import spmetadata
+from testenv.exceptions import MetadataLoadError, MetadataNotFoundError
+
+XML_CONTENT_TYPES = ('application/xml', 'text/xml', 'application/samlmetadata+xml')
+
+
+class MetadataAdminAPI(object):
+    """
+    Authenticated endpoints to add, replace and remove Service Providers
+    from the live registry:
+
+        GET    /admin/metadata                 registered entity IDs
+        POST   /admin/metadata                 add new metadata (bulk)
+        PUT    /admin/metadata                 add or replace metadata (bulk)
+        DELETE /admin/metadata                 remove {"entity_ids": [...]}
+        DELETE /admin/metadata/<entity_id>     remove a single SP
+        GET    /admin/metadata/stats           statistics of the metadata file
+                                               watcher and of the state stores
+        GET    /admin/signing                  statistics of the signing service
+
+    Metadata are sent either as a single XML body or as JSON
+    {"metadata": ["<md:EntityDescriptor ...", ...]}; requests carry
+    "Authorization: Bearer <admin.token>".
+    """
+
+    prefix = '/admin/metadata'
+
+    def __init__(self, app, registry, conf, signing=None, state_stores=()):
+        self.app = app
+        self._registry = registry
+        self._signing = signing
+        self._state_stores = list(state_stores)
+        self._token = conf.admin['token']
+        self._setup_routes()
+
+    def _setup_routes(self):
+        self.app.add_url_rule(
+            '{}/stats'.format(self.prefix), 'admin_metadata_stats',
+            self._authenticated(self.metadata_stats), methods=['GET']
+        )
+        self.app.add_url_rule(
+            self.prefix, 'admin_metadata', self._authenticated(self.metadata),
+            methods=['GET', 'POST', 'PUT', 'DELETE']
+        )
+        self.app.add_url_rule(
+            '{}/<path:entity_id>'.format(self.prefix), 'admin_metadata_entity',
+            self._authenticated(self.delete_metadata), methods=['DELETE']
+        )
+        if self._signing is not None:
+            self.app.add_url_rule(
+                '/admin/signing', 'admin_signing', self._authenticated(self.signing_stats),
+                methods=['GET']
+            )
+
+    def _authenticated(self, view):
+        def wrapper(*args, **kwargs):
+            scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+            if scheme.lower() != 'bearer' or not hmac.compare_digest(
+                    token.strip().encode('utf-8'), self._token.encode('utf-8')):
+                return jsonify({'error': 'Token di autenticazione mancante o non valido'}), 401
+            return view(*args, **kwargs)
+        return wrapper
+
+    def metadata(self):
+        if request.method == 'GET':
+            return jsonify({'service_providers': sorted(self._registry.service_providers)})
+        if request.method == 'DELETE':
+            data = request.get_json(silent=True) or {}
+            entity_ids = data.get('entity_ids')
+            if not isinstance(entity_ids, list):
+                return self._bad_request("Il campo 'entity_ids' deve essere una lista")
+            return self._response([self._unregister(entity_id) for entity_id in entity_ids])
+        documents = self._documents()
+        if not documents:
+            return self._bad_request(
+                "Il campo 'metadata' deve essere una lista non vuota di documenti XML")
+        return self._register(documents, replace=request.method == 'PUT')
+
+    def signing_stats(self):
+        return jsonify(self._signing.stats)
+
+    def metadata_stats(self):
+        watcher = spmetadata.watcher
+        return jsonify({
+            'watcher': watcher.stats if watcher is not None else None,
+            'state_stores': dict((store.name, store.stats) for store in self._state_stores),
+        })
+
+    def delete_metadata(self, entity_id):
+        result = self._unregister(entity_id)
+        status = 404 if result['status'] == 'not_found' else 200
+        return self._response([result], status)
+
+    def _documents(self):
+        if request.mimetype in XML_CONTENT_TYPES:
+            return [request.get_data()]
+        data = request.get_json(silent=True) or {}
+        documents = data.get('metadata')
+        if not isinstance(documents, list):
+            return None
+        return [
+            document.encode('utf-8') if not isinstance(document, bytes) else document
+            for document in documents
+        ]
+
+    def _register(self, documents, replace):
+        started = time.time()
+        results = []
+        for position, (metadata, result) in enumerate(spmetadata.load_documents(documents)):
+            outcome = {
+                'position': position,
+                'entity_id': None,
+                'elapsed': round(result.elapsed, 6),
+            }
+            if result.error is not None:
+                outcome.update(status='error', errors=[str(result.error)])
+            else:
+                outcome['entity_id'] = metadata.entity_id
+                status = self._registry.add(metadata, replace=replace)
+                if status == 'exists':
+                    outcome.update(
+                        status='error', errors=['Service Provider già registrato'])
+                elif status is not None:
+                    outcome['status'] = status
+                else:
+                    outcome.update(
+                        status='error', errors=['Impossibile registrare il metadata'])
+            results.append(outcome)
+        return self._response(results, elapsed=time.time() - started)
+
+    def _unregister(self, entity_id):
+        started = time.time()
+        outcome = {'entity_id': entity_id}
+        try:
+            self._registry.unregister(entity_id)
+        except MetadataNotFoundError:
+            outcome.update(status='not_found', errors=['Service Provider non registrato'])
+        except MetadataLoadError as e:
+            outcome.update(status='error', errors=[str(e)])
+        else:
+            outcome['status'] = 'deleted'
+        outcome['elapsed'] = round(time.time() - started, 6)
+        return outcome
+
+    def _response(self, results, status=200, elapsed=None):
+        data = {
+            'results': results,
+            'errors': len([result for result in results if 'errors' in result]),
+        }
+        if elapsed is not None:
+            data['elapsed'] = round(elapsed, 6)
+        return jsonify(data), status
+
+    @staticmethod
+    def _bad_request(message):
+        return jsonify({'error': message}), 400
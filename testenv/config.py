@@ -5,10 +5,18 @@ import json
 from copy import deepcopy
 
 import yaml
-from voluptuous import ALLOW_EXTRA, All, Any, Invalid, Length, Required, Schema, Url
+from voluptuous import ALLOW_EXTRA, All, Any, In, Invalid, Length, Range, Required, Schema, Url
 
 from testenv import settings
+from testenv.crypto import check_signing_algorithm, default_signing_algorithm, load_certificate_chain, load_private_key
 from testenv.exceptions import BadConfiguration
+from testenv.settings import (
+    DIGEST_ALGORITHMS, DIGEST_SHA256, METADATA_HTTP_TIMEOUT, METADATA_LAZY_CACHE_SIZE, METADATA_LOAD_WORKERS,
+    METADATA_MAX_BACKOFF, METADATA_REFRESH_INTERVAL, METADATA_RETRY_INTERVAL, METADATA_WATCH_INTERVAL,
+    SIGNING_ALGORITHMS,
+)
+from testenv.signing import SIGNING_QUEUE_SIZE, SIGNING_TIMEOUT
+from testenv.storage import DEFAULT_MAX_SIZE, DEFAULT_SQLITE_PATH, DEFAULT_SWEEP_INTERVAL, DEFAULT_TTL
 
 
 class ConfigValidator(object):
@@ -30,12 +38,45 @@ class ConfigValidator(object):
             'https_cert_file': str,
             'https_key_file': str,
             'users_file': str,
+            'spid_validator_engine': In(['voluptuous', 'lxml']),
+            'server': {
+                'workers': All(int, Range(min=1)),
+                'threads': All(int, Range(min=1)),
+                'keepalive': All(int, Range(min=0)),
+                'backlog': All(int, Range(min=1)),
+                'timeout': All(int, Range(min=0)),
+            },
+            'admin': {
+                'token': All(str, Length(min=16)),
+            },
+            'signing': {
+                'engine': In(['signxml', 'fast']),
+                'algorithm': In(SIGNING_ALGORITHMS),
+                'digest_algorithm': In(DIGEST_ALGORITHMS),
+                'service_providers': {
+                    str: {
+                        'algorithm': In(SIGNING_ALGORITHMS),
+                        'digest_algorithm': In(DIGEST_ALGORITHMS),
+                    },
+                },
+                'workers': All(int, Range(min=0)),
+                'queue_size': All(int, Range(min=1)),
+                'timeout': All(Any(int, float), Range(min=0)),
+            },
+            'storage': {
+                'backend': In(['memory', 'sqlite']),
+                'path': str,
+                'ttl': All(int, Range(min=0)),
+                'max_size': All(int, Range(min=0)),
+                'sweep_interval': All(int, Range(min=0)),
+            },
             'endpoints': {
                 'single_logout_service': str,
                 'single_sign_on_service': str,
             },
             'metadata': {
                 'local': All([str], Length(min=0)),
+                'aggregate': All([str], Length(min=0)),
                 'remote': All(
                     [
                         {
@@ -45,7 +86,21 @@ class ConfigValidator(object):
                     ],
                     Length(min=0),
                 )
-            }
+            },
+            'metadata_loading': {
+                'pool': In(['thread', 'process']),
+                'workers': All(int, Range(min=1)),
+                'lazy': bool,
+                'cache_size': All(int, Range(min=1)),
+                'cache_dir': Any(str, None),
+            },
+            'metadata_refresh': {
+                'interval': All(int, Range(min=0)),
+                'retry_interval': All(int, Range(min=1)),
+                'max_backoff': All(int, Range(min=1)),
+                'timeout': All(Any(int, float), Range(min=0)),
+                'watch_interval': All(Any(int, float), Range(min=0)),
+            },
         }
 
     def _init_custom_validators(self):
@@ -68,9 +123,21 @@ class ConfigValidator(object):
                     )
             return data
 
+        def check_admin(data):
+            # registrations live in the memory of a single worker
+            admin = data.get('admin') or {}
+            server = data.get('server') or {}
+            if admin.get('token') and server.get('workers', 1) > 1:
+                raise Invalid(
+                    'Errore nella configurazione delle API di amministrazione: '
+                    'non sono disponibili con più di un worker (server.workers)'
+                )
+            return data
+
         self._custom_validators = [
             check_https,
             check_endpoints,
+            check_admin,
         ]
 
     def validate(self):
@@ -97,6 +164,9 @@ class Config(object):
         self._confdata = confdata
         self._idp_key = self._load_idp_key()
         self._idp_certificate = self._load_idp_certificate()
+        self._idp_private_key = self._parse_idp_key()
+        self._idp_certificate_chain = load_certificate_chain(self._idp_certificate)
+        self._check_signing_algorithms()
 
     def _load_idp_key(self):
         try:
@@ -105,6 +175,26 @@ class Config(object):
             self._fail('Impossibile ottenere la chiave privata dal file {}'.format(
                 self.key_file_path))
 
+    def _parse_idp_key(self):
+        try:
+            return load_private_key(self._idp_key)
+        except Exception:
+            self._fail('Impossibile leggere la chiave privata dal file {}'.format(
+                self.idp_key_file_path))
+
+    def _check_signing_algorithms(self):
+        # the key type is known only once the key has been read
+        signing = self.signing
+        algorithms = [signing['algorithm']] + [
+            override['algorithm']
+            for override in signing['service_providers'].values() if 'algorithm' in override
+        ]
+        for algorithm in algorithms:
+            try:
+                check_signing_algorithm(self._idp_private_key, algorithm)
+            except ValueError as e:
+                self._fail('{} (file {})'.format(e, self.idp_key_file_path))
+
     @staticmethod
     def _read_file_bytes(path):
         with open(path, 'rb') as fp:
@@ -137,6 +227,14 @@ class Config(object):
     def idp_certificate(self):
         return self._idp_certificate
 
+    @property
+    def idp_private_key(self):
+        return self._idp_private_key
+
+    @property
+    def idp_certificate_chain(self):
+        return self._idp_certificate_chain
+
     @property
     def entity_id(self):
         return self._confdata['base_url']
@@ -176,14 +274,88 @@ class Config(object):
     def metadata(self):
         metadata = {
             mdtype: self._confdata.get('metadata', {}).get(mdtype, [])
-            for mdtype in ('local', 'remote')
+            for mdtype in ('local', 'remote', 'aggregate')
         }
         return deepcopy(metadata)
 
+    @property
+    def metadata_loading(self):
+        metadata_loading = {
+            'pool': 'thread',
+            'workers': METADATA_LOAD_WORKERS,
+            'lazy': False,
+            'cache_size': METADATA_LAZY_CACHE_SIZE,
+            'cache_dir': None,
+        }
+        metadata_loading.update(self._confdata.get('metadata_loading') or {})
+        return metadata_loading
+
+    @property
+    def metadata_refresh(self):
+        metadata_refresh = {
+            'interval': METADATA_REFRESH_INTERVAL,
+            'retry_interval': METADATA_RETRY_INTERVAL,
+            'max_backoff': METADATA_MAX_BACKOFF,
+            'timeout': METADATA_HTTP_TIMEOUT,
+            'watch_interval': METADATA_WATCH_INTERVAL,
+        }
+        metadata_refresh.update(self._confdata.get('metadata_refresh') or {})
+        return metadata_refresh
+
     @property
     def users_file_path(self):
         return self._confdata.get('users_file', 'conf/users.json')
 
+    @property
+    def spid_validator_engine(self):
+        return self._confdata.get('spid_validator_engine', 'voluptuous')
+
+    @property
+    def server(self):
+        server = {
+            'workers': 1,
+            'threads': 8,
+            'keepalive': 5,
+            'backlog': 2048,
+            'timeout': 30,
+        }
+        server.update(self._confdata.get('server') or {})
+        return server
+
+    @property
+    def admin(self):
+        admin = {
+            'token': None,
+        }
+        admin.update(self._confdata.get('admin') or {})
+        return admin
+
+    @property
+    def signing(self):
+        signing = {
+            'engine': 'signxml',
+            'algorithm': default_signing_algorithm(self._idp_private_key),
+            'digest_algorithm': DIGEST_SHA256,
+            'service_providers': {},
+            'workers': 0,
+            'queue_size': SIGNING_QUEUE_SIZE,
+            'timeout': SIGNING_TIMEOUT,
+        }
+        signing.update(self._confdata.get('signing') or {})
+        return signing
+
+    @property
+    def storage(self):
+        storage = {
+            'backend': 'memory',
+            'ttl': DEFAULT_TTL,
+            'max_size': DEFAULT_MAX_SIZE,
+            'sweep_interval': DEFAULT_SWEEP_INTERVAL,
+            'path': DEFAULT_SQLITE_PATH,
+        }
+        storage.update(self._confdata.get('storage') or {})
+        return storage
+
     @property
     def pysaml2compat(self):
         # FIXME remove after pysaml2 drop
@@ -2,24 +2,37 @@
 from __future__ import unicode_literals
 
 import base64
+import hashlib
+import re
+import threading
 import zlib
+from collections import namedtuple
+from copy import deepcopy
 
 from cryptography.exceptions import InvalidSignature
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric.ec import ECDSA, EllipticCurvePrivateKey
 from cryptography.hazmat.primitives.asymmetric.padding import PKCS1v15
+from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature
 from cryptography.hazmat.primitives.serialization import load_pem_private_key
-from cryptography.x509 import load_pem_x509_certificate
-from lxml import objectify
-from lxml.etree import fromstring, tostring
+from cryptography.utils import int_to_bytes
+from cryptography.x509 import load_der_x509_certificate, load_pem_x509_certificate
+from lxml.etree import Element, SubElement, fromstring, iselement, tostring
+from OpenSSL.crypto import X509
 from signxml import XMLSigner, XMLVerifier
 from signxml.exceptions import InvalidDigest, InvalidSignature as InvalidSignature_
+from signxml.util import strip_pem_header
 
 from testenv.exceptions import SignatureVerificationError
 from testenv.settings import (
-    DEPRECATED_ALGORITHMS, KEY_INFO, SAML, SIG_NS, SIG_RSA_SHA224, SIG_RSA_SHA256, SIG_RSA_SHA384, SIG_RSA_SHA512,
-    SIGNATURE, SIGNATURE_METHOD, SIGNED_INFO, SIGNED_PARAMS, SUPPORTED_ALGORITHMS, X509_CERTIFICATE, X509_DATA,
+    C14N_EXCLUSIVE, CANONICALIZATION_METHOD, DEPRECATED_ALGORITHMS, DIGEST_METHOD, DIGEST_SHA224, DIGEST_SHA256,
+    DIGEST_SHA384, DIGEST_SHA512, DIGEST_VALUE, KEY_INFO, REFERENCE, SAML, SIG_ECDSA_SHA224, SIG_ECDSA_SHA256,
+    SIG_ECDSA_SHA384, SIG_ECDSA_SHA512, SIG_RSA_SHA224, SIG_RSA_SHA256, SIG_RSA_SHA384, SIG_RSA_SHA512, SIGNATURE,
+    SIGNATURE_METHOD, SIGNATURE_VALUE, SIGNED_INFO, SIGNED_PARAMS, SUPPORTED_ALGORITHMS, TRANSFORM,
+    TRANSFORM_ENVELOPED_SIGNATURE, TRANSFORMS, X509_CERTIFICATE, X509_DATA, XMLDSIG,
 )
+from testenv.utils import get_request_context
 
 try:
     from urllib import urlencode
@@ -55,6 +68,84 @@ def normalize_x509(cert):
     )
 
 
+Certificate = namedtuple(
+    'Certificate',
+    ['text', 'normalized', 'fingerprint', 'x509', 'public_key', 'openssl_x509'],
+)
+
+
+def certificate_fingerprint(cert):
+    """
+    SHA-256 fingerprint of a base64 (PEM or bare) X509 certificate, None
+    if it can not be decoded.
+    """
+    try:
+        der = base64.b64decode(normalize_x509(cert))
+    except (TypeError, ValueError):
+        return None
+    return hashlib.sha256(der).digest()
+
+
+def load_certificate(cert):
+    """
+    Parse a base64 (PEM or bare) X509 certificate once, keeping all the
+    representations needed by the signature verifiers.
+    """
+    normalized = normalize_x509(cert)
+    try:
+        der = base64.b64decode(normalized)
+    except (TypeError, ValueError):
+        raise ValueError('Certificato X509 non decodificabile')
+    x509 = load_der_x509_certificate(der, default_backend())
+    return Certificate(
+        cert,
+        normalized,
+        x509.fingerprint(hashes.SHA256()),
+        x509,
+        x509.public_key(),
+        X509.from_cryptography(x509),
+    )
+
+
+class KeyRing(object):
+    """
+    Parsed certificates of the registered Service Providers, by entity ID
+    and by SHA-256 fingerprint.
+    """
+
+    def __init__(self):
+        self._certificates = {}
+        self._fingerprints = {}
+        self._lock = threading.Lock()
+
+    def set(self, entity_id, certificates):
+        certificates = tuple(certificates)
+        fingerprints = {}
+        for certificate in certificates:
+            fingerprints.setdefault(certificate.fingerprint, certificate)
+        with self._lock:
+            self._certificates[entity_id] = certificates
+            self._fingerprints[entity_id] = fingerprints
+
+    def remove(self, entity_id):
+        with self._lock:
+            self._certificates.pop(entity_id, None)
+            self._fingerprints.pop(entity_id, None)
+
+    def get(self, entity_id):
+        return list(self._certificates[entity_id])
+
+    def find(self, entity_id, fingerprint):
+        """
+        Certificate of `entity_id` with the given fingerprint, None if the
+        Service Provider does not publish it.
+        """
+        return self._fingerprints[entity_id].get(fingerprint)
+
+    def __contains__(self, entity_id):
+        return entity_id in self._certificates
+
+
 class RSASigner(object):
 
     def __init__(self, digest, key=None, padding=None):
@@ -99,35 +190,243 @@ RSA_SIGNERS = {
 }
 
 
-def sign_http_post(xmlstr, key, cert, message=False, assertion=True):
-    # We have to use xml-exc-c14n# because when we isolate the Assertion
-    # element below, a superfluous xmlns:samlp attribute gets added by etree.tostring()
-    # which is not removed by xml-c14n11 (thus generating a wrong digest).
-    signer = XMLSigner(
-        signature_algorithm='rsa-sha256',
-        digest_algorithm='sha256',
-        c14n_algorithm='http://www.w3.org/2001/10/xml-exc-c14n#',
-    )
-    root = fromstring(xmlstr)
-    if message:
-        root = signer.sign(root, key=key, cert=cert)
+class ECDSASigner(object):
+    """
+    ECDSA signature in the XML-DSig format: the integers r and s, each one
+    padded to the size of the curve, instead of their DER sequence.
+    """
+
+    def __init__(self, digest, key=None):
+        self._key = key
+        self._digest = digest
+
+    def sign(self, unsigned_data, key=None):
+        if key is None:
+            key = self._key
+        r, s = decode_dss_signature(key.sign(unsigned_data, ECDSA(self._digest)))
+        size = (key.curve.key_size + 7) // 8
+        return int_to_bytes(r, size) + int_to_bytes(s, size)
+
+
+ECDSA_SIGNERS = {
+    SIG_ECDSA_SHA224: ECDSASigner(hashes.SHA224()),
+    SIG_ECDSA_SHA256: ECDSASigner(hashes.SHA256()),
+    SIG_ECDSA_SHA384: ECDSASigner(hashes.SHA384()),
+    SIG_ECDSA_SHA512: ECDSASigner(hashes.SHA512()),
+}
+
+
+SIGNERS = dict(RSA_SIGNERS, **ECDSA_SIGNERS)
+
+
+DIGESTS = {
+    DIGEST_SHA224: hashlib.sha224,
+    DIGEST_SHA256: hashlib.sha256,
+    DIGEST_SHA384: hashlib.sha384,
+    DIGEST_SHA512: hashlib.sha512,
+}
+
+
+PEM_CERTIFICATE = re.compile(
+    r'-----BEGIN CERTIFICATE-----.+?-----END CERTIFICATE-----', re.DOTALL)
+
+
+def load_private_key(key):
+    """
+    Return a private key object, deserializing it if given as PEM data.
+    """
+    if isinstance(key, (bytes, str)):
+        if not isinstance(key, bytes):
+            key = key.encode('ascii')
+        return load_pem_private_key(key, None, default_backend())
+    return key
+
+
+def load_certificate_chain(cert):
+    """
+    Split PEM data into the list of certificates accepted by XMLSigner.
+    """
+    if isinstance(cert, (list, tuple)):
+        return list(cert)
+    if isinstance(cert, bytes):
+        cert = cert.decode('ascii')
+    return PEM_CERTIFICATE.findall(cert) or [cert]
+
+
+def default_signing_algorithm(key):
+    if isinstance(load_private_key(key), EllipticCurvePrivateKey):
+        return SIG_ECDSA_SHA256
+    return SIG_RSA_SHA256
+
+
+def check_signing_algorithm(key, algorithm):
+    """
+    Raise ValueError if the private `key` can not sign with `algorithm`.
+    """
+    if algorithm not in SIGNERS:
+        raise ValueError("Algoritmo di firma '{}' non supportato".format(algorithm))
+    is_ecdsa_key = isinstance(load_private_key(key), EllipticCurvePrivateKey)
+    if (algorithm in ECDSA_SIGNERS) != is_ecdsa_key:
+        raise ValueError(
+            "L'algoritmo di firma '{}' non è utilizzabile con una chiave {}".format(
+                algorithm, 'ECDSA' if is_ecdsa_key else 'RSA'))
+
+
+_signers = threading.local()
+
+
+def _get_xml_signer(algorithm=SIG_RSA_SHA256, digest_algorithm=DIGEST_SHA256):
+    # XMLSigner keeps some state while signing, one instance per thread
+    # and pair of algorithms
+    signers = getattr(_signers, 'xml_signers', None)
+    if signers is None:
+        signers = _signers.xml_signers = {}
+    signer = signers.get((algorithm, digest_algorithm))
+    if signer is None:
+        # We have to use xml-exc-c14n# because when we isolate the Assertion
+        # element below, a superfluous xmlns:samlp attribute gets added by etree.tostring()
+        # which is not removed by xml-c14n11 (thus generating a wrong digest).
+        # signxml names the algorithms after the fragment of their URI.
+        signer = XMLSigner(
+            signature_algorithm=algorithm.split('#')[1],
+            digest_algorithm=digest_algorithm.split('#')[1],
+            c14n_algorithm=C14N_EXCLUSIVE,
+        )
+        signers[(algorithm, digest_algorithm)] = signer
+    return signer
+
+
+def _signxml_signer(key, cert, algorithm, digest_algorithm):
+    signer = _get_xml_signer(algorithm, digest_algorithm)
+    key = load_private_key(key)
+    cert = load_certificate_chain(cert)
+
+    def sign(element):
+        # XMLSigner works on a copy of the element
+        signed = signer.sign(element, key=key, cert=cert)
+        parent = element.getparent()
+        if parent is not None:
+            parent.replace(element, signed)
+        return signed
+    return sign
+
+
+def _c14n_attribute(value):
+    # attribute escaping of the canonical form
+    return value.replace('&', '&amp;').replace('<', '&lt;').replace('"', '&quot;').replace(
+        '\t', '&#x9;').replace('\n', '&#xA;').replace('\r', '&#xD;')
+
+
+class EnvelopedSigner(object):
+    """
+    Enveloped XML signature with exclusive c14n, the only profile used by
+    the IdP. The SignedInfo and KeyInfo fragments are prepared once for a
+    key, its certificates and the algorithms; signing an element then
+    canonicalizes just that element, in place, and fills the template.
+    """
+
+    _marker = '@@{}@@'
+
+    def __init__(self, key, cert, algorithm=SIG_RSA_SHA256, digest_algorithm=DIGEST_SHA256):
+        self._key = load_private_key(key)
+        self._signer = SIGNERS[algorithm]
+        self._digest = DIGESTS[digest_algorithm]
+        self._template = self._build_template(
+            load_certificate_chain(cert), algorithm, digest_algorithm)
+        # the canonical SignedInfo does not depend on its position in the
+        # document, so it is rendered once around the two variable fields
+        c14n = tostring(self._template[0], method='c14n', exclusive=True)
+        head, c14n = c14n.split(self._marker.format('uri').encode('ascii'))
+        middle, tail = c14n.split(self._marker.format('digest').encode('ascii'))
+        self._signed_info = (head, middle, tail)
+
+    def _build_template(self, certificates, algorithm, digest_algorithm):
+        signature = Element(SIGNATURE, nsmap={'ds': XMLDSIG})
+        signed_info = SubElement(signature, SIGNED_INFO)
+        SubElement(signed_info, CANONICALIZATION_METHOD, Algorithm=C14N_EXCLUSIVE)
+        SubElement(signed_info, SIGNATURE_METHOD, Algorithm=algorithm)
+        reference = SubElement(signed_info, REFERENCE, URI=self._marker.format('uri'))
+        transforms = SubElement(reference, TRANSFORMS)
+        SubElement(transforms, TRANSFORM, Algorithm=TRANSFORM_ENVELOPED_SIGNATURE)
+        SubElement(transforms, TRANSFORM, Algorithm=C14N_EXCLUSIVE)
+        SubElement(reference, DIGEST_METHOD, Algorithm=digest_algorithm)
+        SubElement(reference, DIGEST_VALUE).text = self._marker.format('digest')
+        SubElement(signature, SIGNATURE_VALUE)
+        x509_data = SubElement(SubElement(signature, KEY_INFO), X509_DATA)
+        for certificate in certificates:
+            SubElement(x509_data, X509_CERTIFICATE).text = strip_pem_header(certificate)
+        return signature
+
+    def sign(self, element):
+        """
+        Append the signature of `element` as its last child and return
+        the element, like XMLSigner does for a copy of it.
+        """
+        payload_id = element.get('Id', element.get('ID'))
+        uri = '#{}'.format(payload_id) if payload_id is not None else ''
+        digest = base64.b64encode(
+            self._digest(tostring(element, method='c14n', exclusive=True)).digest())
+        head, middle, tail = self._signed_info
+        signed_info = b''.join((head, _c14n_attribute(uri).encode('utf-8'), middle, digest, tail))
+        signature_value = self._signer.sign(signed_info, self._key)
+        signature = deepcopy(self._template)
+        reference = signature[0][2]
+        reference.set('URI', uri)
+        reference[2].text = digest.decode('ascii')
+        signature[1].text = base64.b64encode(signature_value).decode('ascii')
+        element.append(signature)
+        return element
+
+
+_enveloped_signers = {}
+_enveloped_signers_lock = threading.Lock()
+
+
+def _enveloped_signer(key, cert, algorithm, digest_algorithm):
+    # one signer for each key, certificate chain and pair of algorithms,
+    # usually just a few for the IdP key
+    cache_key = (key, tuple(cert) if isinstance(cert, list) else cert, algorithm, digest_algorithm)
+    signer = _enveloped_signers.get(cache_key)
+    if signer is None:
+        signer = EnvelopedSigner(key, cert, algorithm, digest_algorithm)
+        with _enveloped_signers_lock:
+            _enveloped_signers[cache_key] = signer
+    return signer.sign
+
+
+SIGNING_ENGINES = {
+    'signxml': _signxml_signer,
+    'fast': _enveloped_signer,
+}
+
+
+def sign_http_post(xml, key, cert, message=False, assertion=True, engine='signxml',
+                   algorithm=SIG_RSA_SHA256, digest_algorithm=DIGEST_SHA256):
+    """
+    Sign a SAML message for the HTTP-POST binding and return it base64
+    encoded. `xml` is either the serialized message or its element tree,
+    which is then signed in place without being serialized and parsed.
+    """
+    sign = SIGNING_ENGINES[engine](key, cert, algorithm, digest_algorithm)
+    root = xml if iselement(xml) else fromstring(xml)
+    # the assertions first, so that the message signature covers them
     if assertion:
-        assertions = root.findall('{%s}Assertion' % SAML)
-        for assertion in assertions:
-            _assertion = signer.sign(assertion, key=key, cert=cert)
+        for _assertion in root.findall('{%s}Assertion' % SAML):
+            _assertion = sign(_assertion)
             issuer = _assertion.find('{%s}Issuer' % SAML)
-            signature = _assertion.find('%sSignature' % SIG_NS)
+            signature = _assertion.find(SIGNATURE)
             issuer.addnext(signature)
-            assertion.getparent().replace(assertion, _assertion)
+    if message:
+        root = sign(root)
     response = tostring(root)
     return base64.b64encode(response).decode('ascii')
 
 
-def sign_http_redirect(xmlstr, key, relay_state=None, req_type='SAMLResponse'):
+def sign_http_redirect(xmlstr, key, relay_state=None, req_type='SAMLResponse', algorithm=SIG_RSA_SHA256):
     encoded_message = deflate_and_base64_encode(xmlstr)
     args = {
         req_type: encoded_message,
-        'SigAlg': SIG_RSA_SHA256,
+        'SigAlg': algorithm,
     }
     if relay_state is not None and relay_state.strip() != '':
         args['RelayState'] = relay_state
@@ -136,8 +435,8 @@ def sign_http_redirect(xmlstr, key, relay_state=None, req_type='SAMLResponse'):
             for k in SIGNED_PARAMS
             if k in args],
     ).encode('ascii')
-    signer = RSA_SIGNERS[SIG_RSA_SHA256]
-    key = load_pem_private_key(key, None, default_backend())
+    signer = SIGNERS[algorithm]
+    key = load_private_key(key)
     args["Signature"] = base64.b64encode(signer.sign(query_string, key))
     return urlencode(args)
 
@@ -189,18 +488,49 @@ class HTTPRedirectSignatureVerifier(object):
             self._fail('Verifica della firma fallita.')
 
     def _get_pubkey(self):
+        if isinstance(self._cert, Certificate):
+            return self._cert.public_key
         cert_bytes = pem_format(self._cert).encode('ascii')
         x509 = load_pem_x509_certificate(cert_bytes, backend=default_backend())
         return x509.public_key()
 
 
+def verify_http_redirect_signature(certificates, request):
+    """
+    Verify an HTTP-Redirect request, which does not carry the signing
+    certificate, against the certificates of the Service Provider in
+    order: the first one validating the signature is returned.
+    """
+    error = None
+    for certificate in certificates:
+        try:
+            HTTPRedirectSignatureVerifier(certificate, request).verify()
+        except SignatureVerificationError as e:
+            error = e
+        else:
+            return certificate
+    raise error
+
+
+def request_certificate_fingerprint(request):
+    """
+    Fingerprint of the certificate in the KeyInfo of an HTTP-POST
+    request, None if there is none.
+    """
+    element = get_request_context(request).xml_doc.find(
+        '/'.join([SIGNATURE, KEY_INFO, X509_DATA, X509_CERTIFICATE]))
+    if element is None or not element.text:
+        return None
+    return certificate_fingerprint(element.text)
+
+
 class HTTPPostSignatureVerifier(object):
 
     def __init__(self, certificate, request, verifier=None):
         self._cert = certificate
         self._request = request
         self._verifier = verifier or XMLVerifier()
-        self._xml_doc = objectify.fromstring(request.saml_request)
+        self._xml_doc = get_request_context(request).xml_doc
 
     @property
     def _supported_algorithms(self):
@@ -225,14 +555,19 @@ class HTTPPostSignatureVerifier(object):
             )
 
     def _extract(self, key):
-        return {
-            'sig_alg': (
-                self._xml_doc[SIGNATURE][SIGNED_INFO]
-                [SIGNATURE_METHOD].get('Algorithm')),
-            'certificate': (
-                self._xml_doc[SIGNATURE][KEY_INFO][X509_DATA]
-                [X509_CERTIFICATE].text),
-        }[key]
+        if key == 'sig_alg':
+            return self._find(
+                SIGNATURE, SIGNED_INFO, SIGNATURE_METHOD).get('Algorithm')
+        elif key == 'certificate':
+            return self._find(
+                SIGNATURE, KEY_INFO, X509_DATA, X509_CERTIFICATE).text
+        raise KeyError(key)
+
+    def _find(self, *path):
+        element = self._xml_doc.find('/'.join(path))
+        if element is None:
+            raise KeyError('/'.join(path))
+        return element
 
     @staticmethod
     def _fail(message):
@@ -249,16 +584,25 @@ class HTTPPostSignatureVerifier(object):
 
     def _ensure_matching_certificate(self):
         request_cert = self._extract('certificate')
-        if normalize_x509(request_cert) != normalize_x509(self._cert):
+        if normalize_x509(request_cert) != self._normalized_cert:
             self._fail(
                 'Il certificato X509 contenuto nella request è differente '
                 'rispetto a quello contenuto nei metadata del Service Provider.'
             )
 
+    @property
+    def _normalized_cert(self):
+        if isinstance(self._cert, Certificate):
+            return self._cert.normalized
+        return normalize_x509(self._cert)
+
     def _verify_signature(self):
+        x509_cert = self._cert
+        if isinstance(x509_cert, Certificate):
+            x509_cert = x509_cert.openssl_x509
         try:
             self._verifier.verify(
-                self._request.saml_request, x509_cert=self._cert)
+                self._request.saml_request, x509_cert=x509_cert)
         except InvalidDigest:
             self._fail('Il valore del digest non è valido.')
         except InvalidSignature_:
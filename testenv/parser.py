@@ -6,11 +6,12 @@ import zlib
 from base64 import b64decode
 from collections import namedtuple
 
-from lxml import etree, objectify
+from lxml import etree
 
 from testenv.exceptions import DeserializationError, RequestParserError, ValidationError
 from testenv.settings import BINDING_HTTP_POST, BINDING_HTTP_REDIRECT, MULTIPLE_OCCURRENCES_TAGS
-from testenv.validators import AuthnRequestXMLSchemaValidator, SpidValidator, ValidatorGroup, XMLFormatValidator
+from testenv.utils import SAMLRequestContext, get_request_context
+from testenv.validators import AuthnRequestXMLSchemaValidator, ValidatorGroup, XMLFormatValidator, get_spid_validator
 
 try:
     from urllib import urlencode
@@ -23,19 +24,21 @@ SIGNED_PARAMS = ['SAMLRequest', 'RelayState', 'SigAlg']
 
 HTTPRedirectRequest = namedtuple(
     'HTTPRedirectRequest',
-    ['saml_request', 'relay_state', 'sig_alg', 'signature', 'signed_data', 'auto_login'],
+    ['saml_request', 'relay_state', 'sig_alg', 'signature', 'signed_data', 'auto_login', 'context'],
 )
+HTTPRedirectRequest.__new__.__defaults__ = (None, None)
 
 
 HTTPPostRequest = namedtuple(
-    'HTTPPostRequest', ['saml_request', 'relay_state', 'auto_login'])
+    'HTTPPostRequest', ['saml_request', 'relay_state', 'auto_login', 'context'])
+HTTPPostRequest.__new__.__defaults__ = (None, None)
 
 
 def _get_deserializer(request, action, binding):
     validators = [
         XMLFormatValidator(),
         AuthnRequestXMLSchemaValidator(),
-        SpidValidator(action, binding),
+        get_spid_validator(action, binding),
     ]
     validator_group = ValidatorGroup(validators)
     return HTTPRequestDeserializer(request, validator_group)
@@ -60,6 +63,7 @@ class HTTPRedirectRequestParser(object):
         self._signature = None
         self._signed_data = None
         self._auto_login = None
+        self._context = None
 
     def parse(self):
         self._saml_request = self._parse_saml_request()
@@ -68,6 +72,7 @@ class HTTPRedirectRequestParser(object):
         self._signature = self._parse_signature()
         self._signed_data = self._build_signed_data()
         self._auto_login = self._build_auto_login()
+        self._context = self._build_context()
         return self._build_request()
 
     def _parse_saml_request(self):
@@ -127,6 +132,9 @@ class HTTPRedirectRequestParser(object):
         auto_login = self._querystring.get('auto_login', None)
         return auto_login
 
+    def _build_context(self):
+        return SAMLRequestContext(self._saml_request)
+
     def _build_request(self):
         return self._request_class(
             self._saml_request,
@@ -134,7 +142,8 @@ class HTTPRedirectRequestParser(object):
             self._sig_alg,
             self._signature,
             self._signed_data,
-            self._auto_login
+            self._auto_login,
+            self._context,
         )
 
 
@@ -145,10 +154,14 @@ class HTTPPostRequestParser(object):
         self._request_class = request_class or HTTPPostRequest
         self._saml_request = None
         self._relay_state = None
+        self._auto_login = None
+        self._context = None
 
     def parse(self):
         self._saml_request = self._parse_saml_request()
         self._relay_state = self._parse_relay_state()
+        self._auto_login = self._build_auto_login()
+        self._context = self._build_context()
         return self._build_request()
 
     def _parse_saml_request(self):
@@ -182,8 +195,20 @@ class HTTPPostRequestParser(object):
         except RequestParserError:
             return None
 
+    def _build_auto_login(self):
+        auto_login = self._form.get('auto_login', None)
+        return auto_login
+
+    def _build_context(self):
+        return SAMLRequestContext(self._saml_request)
+
     def _build_request(self):
-        return self._request_class(self._saml_request, self._relay_state)
+        return self._request_class(
+            self._saml_request,
+            self._relay_state,
+            self._auto_login,
+            self._context,
+        )
 
 
 class HTTPRequestDeserializer(object):
@@ -207,10 +232,14 @@ class HTTPRequestDeserializer(object):
             )
 
     def _deserialize(self):
-        xml_doc = objectify.fromstring(self._request.saml_request)
+        xml_doc = get_request_context(self._request).xml_doc
         return self._saml_class(xml_doc)
 
 
+def _load_saml_tree(saml_class, xml, multi_occur_tags):
+    return saml_class(etree.fromstring(xml), multi_occur_tags)
+
+
 class SAMLTree(object):
 
     def __init__(self, xml_doc, multi_occur_tags=None):
@@ -221,6 +250,13 @@ class SAMLTree(object):
         self._bind_attributes()
         self._bind_subtrees()
 
+    def __reduce__(self):
+        # lxml elements cannot be pickled, rebuild the tree from its XML
+        return (
+            _load_saml_tree,
+            (self.__class__, etree.tostring(self._xml_doc), self._multi_occur_tags),
+        )
+
     def _bind_tag(self):
         tag = etree.QName(self._xml_doc).localname
         self.tag = self._to_snake_case(tag)
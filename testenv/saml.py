@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import re
+import threading
+from collections import OrderedDict
 from copy import deepcopy
 from datetime import datetime, timedelta
 from hashlib import sha1
@@ -10,8 +13,8 @@ from lxml.builder import ElementMaker
 from lxml.etree import tostring
 
 from testenv.settings import (
-    BINDING_HTTP_POST, DS, MD, NAME_FORMAT_BASIC, NAMEID_FORMAT_ENTITY, NAMEID_FORMAT_TRANSIENT, NSMAP, SAML, SAMLP,
-    SCM_BEARER, SPID_ATTRIBUTES, TIMEDELTA, VERSION, XS, XSI,
+    BINDING_HTTP_POST, DS, MD, NAME_FORMAT_BASIC, NAMEID_FORMAT_ENTITY, NAMEID_FORMAT_TRANSIENT, NSMAP,
+    RESPONSE_SKELETON_CACHE_SIZE, SAML, SAMLP, SCM_BEARER, SPID_ATTRIBUTES, TIMEDELTA, VERSION, XS, XSI,
 )
 
 samlp_maker = ElementMaker(
@@ -266,11 +269,26 @@ def create_logout_response(data, response_status):
 
 def create_response(data, response_status, attributes={}):
     issue_instant, not_before, not_on_or_after = generate_issue_instant()
+    return _create_response(data, response_status, attributes, {
+        'response_id': generate_unique_id(),
+        'assertion_id': generate_unique_id(),
+        'name_id': generate_unique_id(),
+        'session_index': generate_unique_id(),
+        'issue_instant': issue_instant,
+        'not_before': not_before,
+        'not_on_or_after': not_on_or_after,
+    })
+
+
+def _create_response(data, response_status, attributes, values):
+    issue_instant = values['issue_instant']
+    not_before = values['not_before']
+    not_on_or_after = values['not_on_or_after']
     response_attrs = data.get('response').get('attrs')
     # Create a response
     response = Response(
         attrib=dict(
-            ID=generate_unique_id(),
+            ID=values['response_id'],
             IssueInstant=issue_instant,
             Destination=response_attrs.get('destination'),
             InResponseTo=response_attrs.get('in_response_to')
@@ -301,7 +319,7 @@ def create_response(data, response_status, attributes={}):
     # Create and setup the assertion
     assertion = Assertion(
         attrib=dict(
-            ID=generate_unique_id(),
+            ID=values['assertion_id'],
             IssueInstant=issue_instant,
         )
     )
@@ -312,7 +330,7 @@ def create_response(data, response_status, attributes={}):
         attrib=dict(
             NameQualifier=name_id_attrs.get('name_qualifier'),
         ),
-        text=generate_unique_id()
+        text=values['name_id']
     )
     subject.append(name_id)
     subject_confirmation = SubjectConfirmation()
@@ -346,7 +364,7 @@ def create_response(data, response_status, attributes={}):
     authn_statement = AuthnStatement(
         attrib=dict(
             AuthnInstant=issue_instant,
-            SessionIndex=generate_unique_id()
+            SessionIndex=values['session_index']
         )
     )
     authn_context = AuthnContext()
@@ -376,6 +394,118 @@ def create_response(data, response_status, attributes={}):
     return response
 
 
+# random for every process, so that no static value (Destination, Issuer,
+# attribute names...) can be mistaken for a field of the skeleton
+FIELD_TOKEN = uuid4().hex
+FIELD_MARKER = '@' + FIELD_TOKEN + '@{}@'
+FIELD = re.compile(('@' + FIELD_TOKEN + r'@(\w+)@').encode('ascii'))
+
+
+def _escape_text(value):
+    # the same escaping applied by tostring()
+    return value.replace(
+        '&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('\r', '&#13;')
+
+
+def _escape_attribute(value):
+    return _escape_text(value).replace(
+        '"', '&quot;').replace('\n', '&#10;').replace('\t', '&#9;')
+
+
+class ResponseSkeleton(object):
+    """
+    A serialized Response split around the fields that change for every
+    request, rendered by joining the chunks with the escaped values.
+    """
+
+    def __init__(self, xml):
+        parts = FIELD.split(xml)
+        self._head = parts[0]
+        self._fields = []
+        for index in range(1, len(parts), 2):
+            escape = _escape_attribute if parts[index - 1].endswith(b'="') else _escape_text
+            self._fields.append((parts[index].decode('ascii'), escape, parts[index + 1]))
+
+    def render(self, values):
+        chunks = [self._head]
+        for name, escape, chunk in self._fields:
+            chunks.append(escape(values[name]).encode('ascii', 'xmlcharrefreplace'))
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+
+class ResponseFactory(object):
+    """
+    Build Response documents like create_response(...).to_xml(), from a
+    skeleton compiled once per destination (SP and ACS) and attribute set.
+    For every request only IDs, timestamps, NameID, audience, authn
+    context and attribute values are filled in.
+    """
+
+    def __init__(self, max_size=RESPONSE_SKELETON_CACHE_SIZE):
+        self._skeletons = OrderedDict()
+        self._max_size = max_size
+        self._lock = threading.Lock()
+
+    def create_response(self, data, response_status, attributes={}):
+        attributes = list(attributes.items())
+        skeleton = self._skeleton(data, response_status, attributes)
+        issue_instant, not_before, not_on_or_after = generate_issue_instant()
+        values = {
+            'response_id': generate_unique_id(),
+            'assertion_id': generate_unique_id(),
+            'name_id': generate_unique_id(),
+            'session_index': generate_unique_id(),
+            'issue_instant': issue_instant,
+            'not_before': not_before,
+            'not_on_or_after': not_on_or_after,
+            'in_response_to': data.get('response').get('attrs').get('in_response_to'),
+            'audience': data.get('audience').get('text'),
+            'authn_context_class_ref': data.get('authn_context_class_ref').get('text'),
+        }
+        for index, (_, info) in enumerate(attributes):
+            values['attribute_{}'.format(index)] = info[1]
+        return skeleton.render(values)
+
+    def _skeleton(self, data, response_status, attributes):
+        key = (
+            data.get('response').get('attrs').get('destination'),
+            data.get('issuer').get('attrs').get('name_qualifier'),
+            data.get('issuer').get('text'),
+            data.get('name_id').get('attrs').get('name_qualifier'),
+            data.get('subject_confirmation_data').get('attrs').get('recipient'),
+            response_status.get('status_code'),
+            tuple((name, info[0], info[1] is None) for name, info in attributes),
+        )
+        with self._lock:
+            skeleton = self._skeletons.pop(key, None)
+            if skeleton is None:
+                skeleton = self._compile(data, response_status, attributes)
+            self._skeletons[key] = skeleton
+            while len(self._skeletons) > self._max_size:
+                self._skeletons.popitem(last=False)
+        return skeleton
+
+    @staticmethod
+    def _compile(data, response_status, attributes):
+        marker = FIELD_MARKER.format
+        data = dict(data)
+        data['response'] = {'attrs': dict(
+            data.get('response').get('attrs'), in_response_to=marker('in_response_to'))}
+        data['audience'] = {'text': marker('audience')}
+        data['authn_context_class_ref'] = {'text': marker('authn_context_class_ref')}
+        values = dict((name, marker(name)) for name in (
+            'response_id', 'assertion_id', 'name_id', 'session_index',
+            'issue_instant', 'not_before', 'not_on_or_after',
+        ))
+        attributes = OrderedDict(
+            (name, (info[0], None if info[1] is None else marker('attribute_{}'.format(index))))
+            for index, (name, info) in enumerate(attributes)
+        )
+        response = _create_response(data, response_status, attributes, values)
+        return ResponseSkeleton(response.to_xml())
+
+
 def create_error_response(data, response_status):
     issue_instant, not_before, not_on_or_after = generate_issue_instant()
     response_attrs = data.get('response').get('attrs')
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import logging
 import random
 import string
 from collections import namedtuple
@@ -11,19 +12,23 @@ from logging.handlers import RotatingFileHandler
 from flask import Response, abort, escape, redirect, render_template, request, session, url_for
 
 from testenv import config, spmetadata
-from testenv.crypto import HTTPPostSignatureVerifier, HTTPRedirectSignatureVerifier, sign_http_post, sign_http_redirect
+from testenv.admin import MetadataAdminAPI
+from testenv.crypto import HTTPPostSignatureVerifier, request_certificate_fingerprint, verify_http_redirect_signature
 from testenv.exceptions import (
-    DeserializationError, NoCertificateError, RequestParserError, SignatureVerificationError, UnknownEntityIDError,
+    DeserializationError, NoCertificateError, RequestParserError, SignatureVerificationError, SigningError,
+    UnknownEntityIDError,
 )
 from testenv.parser import (
     HTTPPostRequestParser, HTTPRedirectRequestParser, get_http_post_request_deserializer,
     get_http_redirect_request_deserializer,
 )
-from testenv.saml import create_error_response, create_idp_metadata, create_logout_response, create_response
+from testenv.saml import ResponseFactory, create_error_response, create_idp_metadata, create_logout_response
 from testenv.settings import (
     AUTH_NO_CONSENT, BINDING_HTTP_POST, BINDING_HTTP_REDIRECT, CHALLENGES_TIMEOUT, SPID_ATTRIBUTES, SPID_LEVELS,
     STATUS_SUCCESS,
 )
+from testenv.signing import create_signing_service
+from testenv.storage import StateStoreSweeper, create_state_store
 from testenv.users import AutoLoginJsonUserManager, JsonUserManager
 from testenv.utils import Key, Slo, Sso, get_spid_error
 
@@ -37,9 +42,6 @@ def from_session(key):
 
 class IdpServer(object):
 
-    ticket = {}
-    responses = {}
-    challenges = {}
     _binding_mapping = {
         'http-redirect': BINDING_HTTP_REDIRECT,
         'http-post': BINDING_HTTP_POST
@@ -50,10 +52,12 @@ class IdpServer(object):
     # digitalAddress => PEC
     challenges_timeout = CHALLENGES_TIMEOUT
 
-    def __init__(self, app, conf=None, registry=None, *args, **kwargs):
+    def __init__(self, app, conf=None, registry=None, start_threads=True, *args, **kwargs):
         """
         :param app: Flask instance
         :param conf: config.Config instance
+        :param start_threads: start the thread purging expired state, left
+            to start_sweeper() in the processes forked to serve the requests
         :param args:
         :param kwargs:
         """
@@ -64,6 +68,11 @@ class IdpServer(object):
         # setup
         self._config = conf or config.params
         self._registry = registry or spmetadata.registry
+        self._response_factory = ResponseFactory()
+        self._signing = create_signing_service(
+            self._config.idp_key, self._config.idp_certificate, self._config.signing,
+            self._config.idp_private_key, self._config.idp_certificate_chain)
+        self._setup_state_stores(start_threads)
         self.app.secret_key = 'sosecret'
         handler = RotatingFileHandler(
             'spid.log', maxBytes=500000, backupCount=1
@@ -71,6 +80,40 @@ class IdpServer(object):
         self.app.logger.addHandler(handler)
         self._prepare_server()
 
+    def _setup_state_stores(self, start_threads=True):
+        storage = self._config.storage
+        # pending AuthnRequests, rendered responses and OTP challenges
+        self.ticket = create_state_store('ticket', storage)
+        self.responses = create_state_store('responses', storage)
+        self.challenges = create_state_store('challenges', storage)
+        self._sweeper = None
+        if start_threads:
+            self.start_sweeper()
+
+    def start_sweeper(self):
+        """
+        Start the thread purging expired state, a forked worker
+        process has to start its own.
+        """
+        self.stop_sweeper()
+        interval = self._config.storage['sweep_interval']
+        if interval:
+            self._sweeper = StateStoreSweeper(
+                [self.ticket, self.responses, self.challenges], interval)
+            self._sweeper.start()
+
+    def stop_sweeper(self):
+        sweeper, self._sweeper = self._sweeper, None
+        if sweeper is not None:
+            sweeper.stop()
+
+    def close(self):
+        """
+        Stop the thread purging expired state and the signing processes.
+        """
+        self.stop_sweeper()
+        self._signing.close()
+
     @property
     def _mode(self):
         return 'https' if self._config.https else 'http'
@@ -107,6 +150,12 @@ class IdpServer(object):
         self.app.add_url_rule(
             '/metadata', 'metadata', self.metadata, methods=['POST', 'GET']
         )
+        self.app.register_error_handler(SigningError, self._signing_error)
+        # Runtime management of the Service Providers, only with a token
+        if self._config.admin['token']:
+            self.admin = MetadataAdminAPI(
+                self.app, self._registry, self._config, self._signing,
+                [self.ticket, self.responses, self.challenges])
 
     def _prepare_server(self):
         """
@@ -188,6 +237,13 @@ class IdpServer(object):
             )
         )
 
+    def _signing_error(self, error):
+        # a full signing queue or a timeout of the signing processes
+        self.app.logger.error('Firma della risposta non riuscita: {}'.format(error))
+        return render_template(
+            'error.html', msg='Servizio di firma non disponibile', extra=str(error)
+        ), 503
+
     def _store_request(self, authnreq):
         """
         Store authnrequest in a dictionary
@@ -244,8 +300,8 @@ class IdpServer(object):
         certs = self._get_certificates_by_issuer(saml_tree.issuer.text)
         if not certs:
             raise NoCertificateError
-        for cert in certs:
-            HTTPRedirectSignatureVerifier(cert, request_data).verify()
+        # no certificate in the request: the first key that validates wins
+        verify_http_redirect_signature(certs, request_data)
         return SPIDRequest(request_data, saml_tree)
 
     def _handle_http_post(self, action):
@@ -258,16 +314,19 @@ class IdpServer(object):
         request_data = HTTPPostRequestParser(saml_msg).parse()
         deserializer = get_http_post_request_deserializer(request_data, action)
         saml_tree = deserializer.deserialize()
-        certs = self._get_certificates_by_issuer(saml_tree.issuer.text)
+        issuer = saml_tree.issuer.text
+        certs = self._get_certificates_by_issuer(issuer)
         if not certs:
             raise NoCertificateError
-        for cert in certs:
-            HTTPPostSignatureVerifier(cert, request_data).verify()
+        fingerprint = request_certificate_fingerprint(request_data)
+        cert = self._registry.certificate(issuer, fingerprint) if fingerprint else None
+        # an unknown certificate is reported as a mismatch by the verifier
+        HTTPPostSignatureVerifier(cert or certs[0], request_data).verify()
         return SPIDRequest(request_data, saml_tree)
 
     def _get_certificates_by_issuer(self, issuer):
         try:
-            return self._registry.get(issuer).certs()
+            return self._registry.certificates(issuer)
         except KeyError:
             self._raise_error(
                 'entity ID {} non registrato, impossibile ricavare'
@@ -388,7 +447,7 @@ class IdpServer(object):
             'Filtered data: {}'.format(_identity)
         )
 
-        response_xmlstr = create_response(
+        response_xmlstr = self._response_factory.create_response(
             {
                 'response': {
                     'attrs': {
@@ -424,11 +483,10 @@ class IdpServer(object):
                 'status_code': STATUS_SUCCESS
             },
             _identity.copy()
-        ).to_xml()
-        response = sign_http_post(
+        )
+        response = self._signing.sign_http_post(
             response_xmlstr,
-            self._config.idp_key,
-            self._config.idp_certificate,
+            entity_id=sp_id,
         )
         rendered_template = render_template(
             'form_http_post.html',
@@ -468,14 +526,11 @@ class IdpServer(object):
                 'status_code': error_info[0],
                 'status_message': error_info[1]
             }
-        ).to_xml()
-        self.app.logger.debug(
-            'Error response: \n{}'.format(response)
         )
-        response = sign_http_post(
-            response,
-            self._config.idp_key,
-            self._config.idp_certificate,
+        self._log_error_response(response)
+        response = self._signing.sign_http_post(
+            response.tree,
+            entity_id=authn_request.issuer.text,
         )
         del self.ticket[key]
         rendered_template = render_template(
@@ -571,7 +626,7 @@ class IdpServer(object):
             acss = self._registry.get(
                 sp_id).assertion_consumer_service(index=acs_index)
             if acss:
-                destination = acss[0].get('Location')
+                destination = acss[0].location
             self.app.logger.debug(
                 'AssertionConsumerServiceIndex Location: {}'.format(
                     destination
@@ -664,7 +719,7 @@ class IdpServer(object):
     def continue_response(self):
         key = request.form['request_key']
         relay_state = from_session('relay_state')
-        if key and key in self.responses:
+        if key and key in self.responses and key in self.ticket:
             _response = self.responses.pop(key)
             auth_req = self.ticket.pop(key)
             if 'confirm' in request.form:
@@ -695,14 +750,11 @@ class IdpServer(object):
                         'status_code': error_info[0],
                         'status_message': error_info[1]
                     }
-                ).to_xml()
-                self.app.logger.debug(
-                    'Error response: \n{}'.format(response)
                 )
-                response = sign_http_post(
-                    response,
-                    self._config.idp_key,
-                    self._config.idp_certificate,
+                self._log_error_response(response)
+                response = self._signing.sign_http_post(
+                    response.tree,
+                    entity_id=auth_req.issuer.text,
                 )
                 rendered_template = render_template(
                     'form_http_post.html',
@@ -716,6 +768,13 @@ class IdpServer(object):
                 return rendered_template, 200
         return render_template('403.html'), 403
 
+    def _log_error_response(self, response):
+        # serialize the response only when it is going to be logged
+        if self.app.logger.isEnabledFor(logging.DEBUG):
+            self.app.logger.debug(
+                'Error response: \n{}'.format(response.to_xml())
+            )
+
     def _sp_single_logout_service(self, issuer_name):
         _slo = None
         try:
@@ -741,13 +800,13 @@ class IdpServer(object):
                         issuer_name
                     )
                 )
-            response_binding = _slo.get('Binding')
+            response_binding = _slo.binding
             self.app.logger.debug(
                 'Response binding: \n{}'.format(
                     response_binding
                 )
             )
-            destination = _slo.get('Location')
+            destination = _slo.location
             response = create_logout_response(
                 {
                     'logout_response': {
@@ -766,14 +825,13 @@ class IdpServer(object):
                 {
                     'status_code': STATUS_SUCCESS
                 }
-            ).to_xml()
+            )
             relay_state = spid_request.data.relay_state or ''
             if response_binding == BINDING_HTTP_POST:
-                response = sign_http_post(
-                    response,
-                    self._config.idp_key,
-                    self._config.idp_certificate,
-                    message=True, assertion=False
+                response = self._signing.sign_http_post(
+                    response.tree,
+                    message=True, assertion=False,
+                    entity_id=issuer_name,
                 )
                 rendered_template = render_template(
                     'form_http_post.html',
@@ -786,10 +844,10 @@ class IdpServer(object):
                 )
                 return rendered_template, 200
             elif response_binding == BINDING_HTTP_REDIRECT:
-                query_string = sign_http_redirect(
-                    response,
-                    self._config.idp_key,
+                query_string = self._signing.sign_http_redirect(
+                    response.to_xml(),
                     relay_state,
+                    entity_id=issuer_name,
                 )
                 location = '{}?{}'.format(destination, query_string)
                 if location:
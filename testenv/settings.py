@@ -97,15 +97,39 @@ SIG_RSA_SHA224 = 'http://www.w3.org/2001/04/xmldsig-more#rsa-sha224'
 SIG_RSA_SHA256 = 'http://www.w3.org/2001/04/xmldsig-more#rsa-sha256'
 SIG_RSA_SHA384 = 'http://www.w3.org/2001/04/xmldsig-more#rsa-sha384'
 SIG_RSA_SHA512 = 'http://www.w3.org/2001/04/xmldsig-more#rsa-sha512'
+SIG_ECDSA_SHA224 = 'http://www.w3.org/2001/04/xmldsig-more#ecdsa-sha224'
+SIG_ECDSA_SHA256 = 'http://www.w3.org/2001/04/xmldsig-more#ecdsa-sha256'
+SIG_ECDSA_SHA384 = 'http://www.w3.org/2001/04/xmldsig-more#ecdsa-sha384'
+SIG_ECDSA_SHA512 = 'http://www.w3.org/2001/04/xmldsig-more#ecdsa-sha512'
 DEPRECATED_ALGORITHMS = [SIG_RSA_SHA1]
 SUPPORTED_ALGORITHMS = [SIG_RSA_SHA224,
                         SIG_RSA_SHA256, SIG_RSA_SHA384, SIG_RSA_SHA512]
-
-SIG_NS = '{http://www.w3.org/2000/09/xmldsig#}'
+ECDSA_ALGORITHMS = [SIG_ECDSA_SHA224,
+                    SIG_ECDSA_SHA256, SIG_ECDSA_SHA384, SIG_ECDSA_SHA512]
+# algorithms of the signatures made by the IdP
+SIGNING_ALGORITHMS = SUPPORTED_ALGORITHMS + ECDSA_ALGORITHMS
+
+DIGEST_SHA224 = 'http://www.w3.org/2001/04/xmldsig-more#sha224'
+DIGEST_SHA256 = 'http://www.w3.org/2001/04/xmlenc#sha256'
+DIGEST_SHA384 = 'http://www.w3.org/2001/04/xmldsig-more#sha384'
+DIGEST_SHA512 = 'http://www.w3.org/2001/04/xmlenc#sha512'
+DIGEST_ALGORITHMS = [DIGEST_SHA224, DIGEST_SHA256, DIGEST_SHA384, DIGEST_SHA512]
+C14N_EXCLUSIVE = 'http://www.w3.org/2001/10/xml-exc-c14n#'
+TRANSFORM_ENVELOPED_SIGNATURE = 'http://www.w3.org/2000/09/xmldsig#enveloped-signature'
+
+XMLDSIG = 'http://www.w3.org/2000/09/xmldsig#'
+SIG_NS = '{%s}' % XMLDSIG
 
 SIGNATURE = '{}Signature'.format(SIG_NS)
 SIGNED_INFO = '{}SignedInfo'.format(SIG_NS)
 SIGNATURE_METHOD = '{}SignatureMethod'.format(SIG_NS)
+SIGNATURE_VALUE = '{}SignatureValue'.format(SIG_NS)
+CANONICALIZATION_METHOD = '{}CanonicalizationMethod'.format(SIG_NS)
+REFERENCE = '{}Reference'.format(SIG_NS)
+TRANSFORMS = '{}Transforms'.format(SIG_NS)
+TRANSFORM = '{}Transform'.format(SIG_NS)
+DIGEST_METHOD = '{}DigestMethod'.format(SIG_NS)
+DIGEST_VALUE = '{}DigestValue'.format(SIG_NS)
 KEY_INFO = '{}KeyInfo'.format(SIG_NS)
 X509_DATA = '{}X509Data'.format(SIG_NS)
 X509_CERTIFICATE = '{}X509Certificate'.format(SIG_NS)
@@ -119,6 +143,15 @@ SIGNED_PARAMS = ['SAMLRequest', 'SAMLResponse', 'RelayState', 'SigAlg']
 # minutes (used to verify and generate range limits for issue instant etc.)
 TIMEDELTA = 2
 CHALLENGES_TIMEOUT = 30  # seconds (used to verify spid level >= 2 challenges)
+# seconds (used to fetch and refresh the remote SP metadata)
+METADATA_HTTP_TIMEOUT = 10
+METADATA_REFRESH_INTERVAL = 3600
+METADATA_RETRY_INTERVAL = 30
+METADATA_MAX_BACKOFF = 3600
+METADATA_WATCH_INTERVAL = 2
+METADATA_LOAD_WORKERS = 8  # threads or processes loading the metadata at startup
+METADATA_LAZY_CACHE_SIZE = 1000  # parsed SP metadata kept in memory in lazy mode
+RESPONSE_SKELETON_CACHE_SIZE = 1000  # precompiled Response skeletons (SP, ACS, attribute set)
 
 MULTIPLE_OCCURRENCES_TAGS = {
     '{%s}AssertionConsumerService' % (MD),
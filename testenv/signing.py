@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+from lxml.etree import iselement, tostring
+
+from testenv.crypto import load_certificate_chain, load_private_key, sign_http_post, sign_http_redirect
+from testenv.exceptions import SigningError
+from testenv.settings import DIGEST_SHA256, SIG_RSA_SHA256
+
+logger = logging.getLogger(__name__)
+
+SIGNING_QUEUE_SIZE = 64
+SIGNING_TIMEOUT = 5  # seconds
+# a job still in the pool after this many timeouts is considered lost
+SIGNING_LOST_JOB_TIMEOUTS = 3
+
+
+class SigningAlgorithms(object):
+    """
+    Signature and digest algorithms of the IdP, possibly overridden for
+    some Service Providers.
+    """
+
+    def __init__(self, algorithm=SIG_RSA_SHA256, digest_algorithm=DIGEST_SHA256, service_providers=None):
+        self._default = (algorithm, digest_algorithm)
+        self._overrides = {
+            entity_id: (
+                override.get('algorithm', algorithm),
+                override.get('digest_algorithm', digest_algorithm),
+            )
+            for entity_id, override in (service_providers or {}).items()
+        }
+
+    @classmethod
+    def from_config(cls, conf):
+        return cls(
+            conf.get('algorithm', SIG_RSA_SHA256),
+            conf.get('digest_algorithm', DIGEST_SHA256),
+            conf.get('service_providers'),
+        )
+
+    def get(self, entity_id=None):
+        """
+        The (signature, digest) algorithms for the messages sent to
+        `entity_id`.
+        """
+        return self._overrides.get(entity_id, self._default)
+
+
+class InlineSigningService(object):
+    """
+    Sign the responses in the thread serving the request.
+    """
+
+    def __init__(self, key, cert, engine='signxml', algorithms=None):
+        self._key = load_private_key(key)
+        self._cert = load_certificate_chain(cert)
+        self._engine = engine
+        self._algorithms = algorithms or SigningAlgorithms()
+
+    @classmethod
+    def from_config(cls, key, cert, conf):
+        return cls(
+            key, cert,
+            engine=conf.get('engine', 'signxml'),
+            algorithms=SigningAlgorithms.from_config(conf),
+        )
+
+    def sign_http_post(self, xml, message=False, assertion=True, entity_id=None):
+        algorithm, digest_algorithm = self._algorithms.get(entity_id)
+        return sign_http_post(
+            xml, self._key, self._cert, message=message, assertion=assertion, engine=self._engine,
+            algorithm=algorithm, digest_algorithm=digest_algorithm)
+
+    def sign_http_redirect(self, xmlstr, relay_state=None, req_type='SAMLResponse', entity_id=None):
+        algorithm, _ = self._algorithms.get(entity_id)
+        return sign_http_redirect(xmlstr, self._key, relay_state, req_type, algorithm=algorithm)
+
+    def close(self):
+        pass
+
+    @property
+    def stats(self):
+        return {
+            'workers': 0,
+        }
+
+
+# key and certificates of a signing process, loaded once by _init_worker()
+_worker = {}
+
+
+def _init_worker(key, cert, engine):
+    _worker['key'] = load_private_key(key)
+    _worker['cert'] = load_certificate_chain(cert)
+    _worker['engine'] = engine
+
+
+def _sign_http_post(xml, message, assertion, algorithm, digest_algorithm):
+    return sign_http_post(
+        xml, _worker['key'], _worker['cert'], message=message, assertion=assertion, engine=_worker['engine'],
+        algorithm=algorithm, digest_algorithm=digest_algorithm)
+
+
+def _sign_http_redirect(xmlstr, relay_state, req_type, algorithm):
+    return sign_http_redirect(xmlstr, _worker['key'], relay_state, req_type, algorithm=algorithm)
+
+
+def _pool_context():
+    # the pool is started by the threads serving the requests, and forking
+    # a threaded process is not safe: start clean processes where possible
+    if not hasattr(multiprocessing, 'get_context'):  # Python 2
+        return multiprocessing
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def _run_job(func, args):
+    # errors are returned, so that the completion callback always runs
+    try:
+        return True, func(*args)
+    except Exception as e:
+        return False, '{}: {}'.format(e.__class__.__name__, e)
+
+
+class _Job(object):
+
+    def __init__(self, started):
+        self.started = started
+        self.released = False
+
+
+class PoolSigningService(object):
+    """
+    Sign the responses in a pool of processes, each one loading the IdP key
+    once, so that the XML signature does not hold the GIL of the threads
+    serving the requests.
+
+    At most `queue_size` jobs are waiting or running at the same time and
+    further ones are rejected; a job not completed within `timeout` seconds
+    fails as well. Either way a SigningError is raised. A job whose caller
+    has timed out keeps its slot until it completes: if some job is still
+    in the pool after SIGNING_LOST_JOB_TIMEOUTS timeouts (e.g. its process
+    died), the pool is recycled and the slots of its jobs are given back.
+
+    The pool is started by the first job of every process: server workers
+    forked after the service has been built do not share it. Its processes
+    are started by a fork server (or spawned) rather than forked from the
+    threaded server.
+    """
+
+    def __init__(self, key, cert, engine='signxml', algorithms=None, workers=None,
+                 queue_size=SIGNING_QUEUE_SIZE, timeout=SIGNING_TIMEOUT, clock=None):
+        self._initargs = (key, cert, engine)
+        self._algorithms = algorithms or SigningAlgorithms()
+        self._workers = workers or multiprocessing.cpu_count()
+        self._queue_size = queue_size
+        self._timeout = timeout or None
+        self._clock = clock or time.time
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+        self._jobs = set()
+        self._recycled = 0
+        self._pending = 0
+        self._max_pending = 0
+        self._completed = 0
+        self._rejected = 0
+        self._timeouts = 0
+        self._failures = 0
+        self._total_latency = 0.0
+        self._last_latency = None
+        self._max_latency = None
+
+    @classmethod
+    def from_config(cls, key, cert, conf):
+        return cls(
+            key, cert,
+            engine=conf.get('engine', 'signxml'),
+            algorithms=SigningAlgorithms.from_config(conf),
+            workers=conf.get('workers'),
+            queue_size=conf.get('queue_size', SIGNING_QUEUE_SIZE),
+            timeout=conf.get('timeout', SIGNING_TIMEOUT),
+        )
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = _pool_context().Pool(
+                    self._workers, initializer=_init_worker, initargs=self._initargs)
+                self._pid = os.getpid()
+            return self._pool
+
+    def sign_http_post(self, xml, message=False, assertion=True, entity_id=None):
+        # the element tree can not be sent to another process
+        if iselement(xml):
+            xml = tostring(xml)
+        algorithm, digest_algorithm = self._algorithms.get(entity_id)
+        return self._run(_sign_http_post, (xml, message, assertion, algorithm, digest_algorithm))
+
+    def sign_http_redirect(self, xmlstr, relay_state=None, req_type='SAMLResponse', entity_id=None):
+        algorithm, _ = self._algorithms.get(entity_id)
+        return self._run(_sign_http_redirect, (xmlstr, relay_state, req_type, algorithm))
+
+    def _run(self, func, args):
+        # the queue may be full of lost jobs
+        if not self._slots.acquire(False) and not (self._recycle_lost() and self._slots.acquire(False)):
+            with self._lock:
+                self._rejected += 1
+            logger.warning('Coda di firma piena: {} richieste in attesa'.format(self._queue_size))
+            raise SigningError(
+                'Troppe richieste di firma in attesa ({})'.format(self._queue_size))
+        job = _Job(self._clock())
+        with self._lock:
+            self._jobs.add(job)
+            self._pending += 1
+            self._max_pending = max(self._pending, self._max_pending)
+        try:
+            result = self._get_pool().apply_async(
+                _run_job, (func, args), callback=lambda outcome: self._done(job))
+        except Exception:
+            self._release(job)
+            raise
+        try:
+            succeeded, value = result.get(self._timeout)
+        except multiprocessing.TimeoutError:
+            # the job keeps its slot until it completes
+            with self._lock:
+                self._timeouts += 1
+            self._recycle_lost()
+            logger.warning('Firma non completata entro {} secondi'.format(self._timeout))
+            raise SigningError(
+                'Firma non completata entro {} secondi'.format(self._timeout))
+        if not succeeded:
+            with self._lock:
+                self._failures += 1
+            raise SigningError('Errore durante la firma: {}'.format(value))
+        return value
+
+    def _done(self, job):
+        # run when the job completes, even after its caller has timed out
+        latency = self._clock() - job.started
+        with self._lock:
+            self._completed += 1
+            self._total_latency += latency
+            self._last_latency = latency
+            self._max_latency = max(latency, self._max_latency or 0)
+        self._release(job)
+
+    def _release(self, job):
+        # either the completion callback or the pool recycling, only once
+        with self._lock:
+            if job.released:
+                return
+            job.released = True
+            self._jobs.discard(job)
+            self._pending -= 1
+        self._slots.release()
+
+    def _recycle_lost(self):
+        """
+        Replace the pool if one of its jobs is lost, return True if so.
+        """
+        if self._timeout is None:
+            return False
+        lost_before = self._clock() - self._timeout * SIGNING_LOST_JOB_TIMEOUTS
+        with self._lock:
+            if not any(job.started < lost_before for job in self._jobs):
+                return False
+            pool, self._pool = self._pool, None
+            jobs, self._jobs = self._jobs, set()
+            self._recycled += 1
+        logger.warning(
+            'Processi di firma non rispondenti, {} richieste perse: il pool viene ricreato'.format(len(jobs)))
+        if pool is not None and self._pid == os.getpid():
+            pool.terminate()
+        for job in jobs:
+            self._release(job)
+        return True
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None and self._pid == os.getpid():
+            pool.terminate()
+            pool.join()
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self._workers,
+                'queue_size': self._queue_size,
+                'pending': self._pending,
+                'max_pending': self._max_pending,
+                'completed': self._completed,
+                'rejected': self._rejected,
+                'timeouts': self._timeouts,
+                'failures': self._failures,
+                'recycled': self._recycled,
+                'last_latency': self._last_latency,
+                'max_latency': self._max_latency,
+                'average_latency': self._total_latency / self._completed if self._completed else None,
+            }
+
+
+def create_signing_service(key, cert, conf, private_key=None, certificate_chain=None):
+    """
+    Build the service signing the responses as described by the `signing`
+    configuration: a pool of processes if `workers` is set, otherwise the
+    request threads sign on their own.
+
+    `private_key` and `certificate_chain` are `key` and `cert` already
+    parsed, used when signing inline: the processes get the PEM data.
+    """
+    if conf.get('workers'):
+        return PoolSigningService.from_config(key, cert, conf)
+    return InlineSigningService.from_config(private_key or key, certificate_chain or cert, conf)
@@ -1,45 +1,102 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import calendar
+import errno
+import hashlib
 import logging
+import mmap
+import multiprocessing
+import os
+import pickle
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from copy import copy
+from multiprocessing.pool import ThreadPool
 
 import requests
+from lxml import etree
+from requests.adapters import HTTPAdapter
 
 from testenv import config
+from testenv.crypto import KeyRing, load_certificate
 from testenv.exceptions import DeserializationError, MetadataLoadError, MetadataNotFoundError, ValidationError
-from testenv.saml import (
-    AssertionConsumerService, AttributeConsumingService, EntityDescriptor, KeyDescriptor, KeyInfo, RequestedAttribute,
-    SingleLogoutService, SPSSODescriptor, X509Certificate, X509Data,
+from testenv.settings import (
+    METADATA_HTTP_TIMEOUT, METADATA_LAZY_CACHE_SIZE, METADATA_MAX_BACKOFF, METADATA_REFRESH_INTERVAL,
+    METADATA_RETRY_INTERVAL, METADATA_WATCH_INTERVAL,
 )
-from testenv.utils import saml_to_dict
-from testenv.validators import ServiceProviderMetadataXMLSchemaValidator, ValidatorGroup, XMLMetadataFormatValidator
+from testenv.spmodel import ENTITYDESCRIPTOR, NO_ATTRIBUTES, SPSSODESCRIPTOR, parse_entity_descriptor
+from testenv.utils import parse_duration, str_to_struct_time
+from testenv.validators import (
+    ServiceProviderMetadataXMLSchemaValidator, ValidatorGroup, XMLMetadataFormatValidator, spid_schema_cache,
+)
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-ENTITYDESCRIPTOR = EntityDescriptor.tag()
-SPSSODESCRIPTOR = SPSSODescriptor.tag()
-KEYDESCRIPTOR = KeyDescriptor.tag()
-KEYINFO = KeyInfo.tag()
-X509DATA = X509Data.tag()
-X509CERTIFICATE = X509Certificate.tag()
-ASSERTION_CONSUMER_SERVICE = AssertionConsumerService.tag()
-ATTRIBUTE_CONSUMING_SERVICE = AttributeConsumingService.tag()
-REQUESTEDATTRIBUTE = RequestedAttribute.tag()
-SINGLE_LOGOUT_SERVICE = SingleLogoutService.tag()
+# bump whenever validation or the spmodel classes change
+METADATA_CACHE_VERSION = 2
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def get_http_session():
+    """
+    Session shared by the HTTP loaders, keeps the connections to the
+    SP metadata endpoints alive between two refreshes.
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=10, pool_maxsize=10)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http_session = session
+        return _http_session
 
 
 class ServiceProviderMetadataBaseLoader(object):
 
+    # whether the source should be polled by the MetadataRefresher
+    refreshable = False
+
     def __init__(self, conf, validator):
         self._config = conf
         self._validator = validator
+        self._validated = None
+
+    @property
+    def source(self):
+        return self._config
 
     def load(self):
-        metadata = self._load()
-        self._validate(metadata)
+        metadata = self.fetch()
+        self.validate(metadata)
         return metadata
 
+    def fetch(self):
+        return self._load()
+
+    def validate(self, metadata):
+        # an unchanged document is not validated again
+        if metadata is not self._validated:
+            self._validate(metadata)
+            self._validated = metadata
+
+    def mark_valid(self, metadata):
+        self._validated = metadata
+
     def _validate(self, metadata):
         try:
             self._validator.validate(metadata)
@@ -66,6 +123,20 @@ class ServiceProviderMetadataFileLoader(ServiceProviderMetadataBaseLoader):
 
 class ServiceProviderMetadataHTTPLoader(ServiceProviderMetadataBaseLoader):
 
+    refreshable = True
+
+    def __init__(self, conf, validator, session=None, timeout=METADATA_HTTP_TIMEOUT):
+        super(ServiceProviderMetadataHTTPLoader, self).__init__(conf, validator)
+        self._session = session
+        self._timeout = timeout
+        self._content = None
+        self._etag = None
+        self._last_modified = None
+
+    @property
+    def source(self):
+        return self._config.get('url')
+
     def _load(self):
         try:
             return self._make_request()
@@ -76,170 +147,339 @@ class ServiceProviderMetadataHTTPLoader(ServiceProviderMetadataBaseLoader):
             )
 
     def _make_request(self):
-        response = requests.get(self._config.get('url'))
+        headers = {}
+        if self._content is not None:
+            if self._etag:
+                headers['If-None-Match'] = self._etag
+            if self._last_modified:
+                headers['If-Modified-Since'] = self._last_modified
+        session = self._session or get_http_session()
+        response = session.get(
+            self._config.get('url'), headers=headers, timeout=self._timeout)
+        if response.status_code == 304 and self._content is not None:
+            return self._content
         response.raise_for_status()
-        return response.content
+        self._content = response.content
+        self._etag = response.headers.get('ETag')
+        self._last_modified = response.headers.get('Last-Modified')
+        return self._content
+
+
+class ServiceProviderMetadataStaticLoader(ServiceProviderMetadataBaseLoader):
+    """
+    Metadata document uploaded at runtime, e.g. through the admin API.
+    """
+
+    @property
+    def source(self):
+        return None
+
+    def _load(self):
+        return self._config
+
+
+def iter_entity_descriptors(source):
+    """
+    Stream the EntityDescriptor elements of an aggregated metadata
+    document (EntitiesDescriptor). Each element is cleared once the
+    caller moves to the next one, so memory does not grow with the file.
+    """
+    for _, element in etree.iterparse(source, events=('end',), tag=ENTITYDESCRIPTOR):
+        yield element
+        element.clear()
+        # drop the already processed siblings as well
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+
+class ServiceProviderMetadataAggregateLoader(ServiceProviderMetadataBaseLoader):
+    """
+    Load a single Service Provider from an aggregated metadata file.
+    """
+
+    def __init__(self, conf, validator, entity_id):
+        super(ServiceProviderMetadataAggregateLoader, self).__init__(conf, validator)
+        self._entity_id = entity_id
+
+    @property
+    def source(self):
+        return '{}#{}'.format(self._config, self._entity_id)
+
+    def _load(self):
+        try:
+            for element in iter_entity_descriptors(self._config):
+                if element.get('entityID') == self._entity_id:
+                    return etree.tostring(element)
+        except Exception as e:
+            raise MetadataLoadError(
+                "Impossibile leggere il file '{}': '{}'"
+                .format(self._config, e)
+            )
+        raise MetadataLoadError(
+            "Il Service Provider '{}' non è presente nel file '{}'"
+            .format(self._entity_id, self._config)
+        )
 
 
 class ServiceProviderMetadata(object):
+    """
+    In-memory view of a Service Provider metadata document.
+
+    The document is fetched, validated and parsed once by load() into a
+    spmodel.EntityDescriptor; every accessor is then served from it until
+    reload() is called.
+    """
 
-    def __init__(self, loader):
+    def __init__(self, loader, clock=None):
         self._loader = loader
+        self._clock = clock or time.time
+        self._raw = None
+        self._parsed = None
+        self._loaded_at = None
+        self.revision = 0
+
+    def load(self):
+        metadata = self._loader.load()
+        self._update(metadata)
+        return self
+
+    def _update(self, metadata, parsed=None):
+        self._loaded_at = self._clock()
+        if self._parsed is None or metadata is not self._raw:
+            # a single assignment, so readers never see a half-built document
+            self._parsed = parsed if parsed is not None else parse_entity_descriptor(metadata)
+            self._raw = metadata
+            self.revision += 1
+
+    def reload(self):
+        return self.load()
+
+    @property
+    def is_loaded(self):
+        return self._parsed is not None
+
+    @property
+    def is_refreshable(self):
+        return self._loader.refreshable
+
+    @property
+    def source(self):
+        return self._loader.source
 
     @property
-    def root_tag(self):
-        return ENTITYDESCRIPTOR
+    def expires_at(self):
+        """
+        Timestamp after which the document should be fetched again
+        according to its cacheDuration and validUntil, None if unbounded.
+        """
+        root = self.root
+        deadlines = []
+        cache_duration = root.cache_duration
+        if cache_duration:
+            try:
+                deadlines.append(self._loaded_at + parse_duration(cache_duration))
+            except ValueError as e:
+                logger.warning(
+                    "cacheDuration non valida nel metadata di '{}': {}".format(
+                        self.entity_id, e))
+        valid_until = root.valid_until
+        if valid_until:
+            try:
+                deadlines.append(calendar.timegm(str_to_struct_time(valid_until)))
+            except (ValueError, AttributeError):
+                logger.warning(
+                    "validUntil non valida nel metadata di '{}': '{}'".format(
+                        self.entity_id, valid_until))
+        return min(deadlines) if deadlines else None
 
     @property
     def root(self):
-        return self._metadata.get(
-            self.root_tag, {}
-        )
+        return self._metadata
 
     @property
     def entity_id(self):
-        return self.root.get(
-            'attrs', {}
-        ).get('entityID', None)
+        return self._metadata.entity_id
 
     def certs(self, use='signing'):
-        key_descriptors = self.root.get(
-            'children', {}
-        ).get(SPSSODESCRIPTOR, {}
-              ).get(
-            'children', {}
-        ).get(
-            KEYDESCRIPTOR, []
-        )
-        _certs = []
-        for key_descriptor in key_descriptors:
-            _key_descriptor = key_descriptor.get(
-                'children', {}
-            )
-            if key_descriptor.get('attrs', {}
-                                  ).get('use') == use:
-                _cert = _key_descriptor.get(
-                    KEYINFO, {}
-                ).get(
-                    'children', {}
-                ).get(
-                    X509DATA, {}
-                ).get(
-                    'children', {}
-                ).get(
-                    X509CERTIFICATE, {}
-                ).get('text', None)
-                if _cert is not None:
-                    splitted_cert = _cert.split('\n')
-                    _cert = ''.join([s.strip() for s in splitted_cert])
-                    _certs.append(_cert)
-        return _certs
+        return self._metadata.sp_sso_descriptor.certificates(use)
+
+    @property
+    def _lookup(self):
+        return self._metadata.sp_sso_descriptor.lookup
 
     @property
     def assertion_consumer_services(self):
-        acss = self.root.get(
-            'children', {}
-        ).get(SPSSODESCRIPTOR, {}
-              ).get(
-            'children', {}
-        ).get(
-            ASSERTION_CONSUMER_SERVICE, []
-        )
-        return [
-            acs.get('attrs', {}) for acs in acss
-        ]
+        return self._metadata.sp_sso_descriptor.assertion_consumer_services
 
     def assertion_consumer_service(self, binding=None, index=None):
-        return [
-            acs for acs in self.assertion_consumer_services if (
-                binding is not None and acs.get('Binding') == binding
-            ) or (
-                index is not None and acs.get('index') == index
-            )
-        ]
+        lookup = self._lookup
+        by_binding = lookup.acs_by_binding.get(binding, ()) if binding is not None else ()
+        by_index = lookup.acs_by_index.get(index, ()) if index is not None else ()
+        if not by_binding or not by_index:
+            return by_binding or by_index
+        # both given: keep the document order, without duplicates
+        matches = set(id(acs) for acs in by_binding + by_index)
+        return tuple(
+            acs for acs in self.assertion_consumer_services if id(acs) in matches
+        )
+
+    @property
+    def assertion_consumer_service_indexes(self):
+        return self._lookup.acs_indexes
+
+    @property
+    def assertion_consumer_service_urls(self):
+        return self._lookup.acs_urls
 
     @property
     def attribute_consuming_services(self):
-        return self.root.get(
-            'children', {}
-        ).get(SPSSODESCRIPTOR, {}
-              ).get(
-            'children', {}
-        ).get(
-            ATTRIBUTE_CONSUMING_SERVICE, []
-        )
+        return self._metadata.sp_sso_descriptor.attribute_consuming_services
 
     def attribute_consuming_service(self, index='0'):
-        return [
-            atcs for atcs in self.attribute_consuming_services if atcs.get(
-                'attrs', {}
-            ).get('index') == index
-        ]
+        return self._lookup.atcs_by_index.get(index, ())
+
+    @property
+    def attribute_consuming_service_indexes(self):
+        return self._lookup.atcs_indexes
 
     def attributes(self, index='0'):
-        services = self.attribute_consuming_service(index)
-        result_attributes = {
-            'required': [],
-            'optional': []
-        }
-        if services:
-            service = services[0]
-            requested_attributes = service.get(
-                'children', {}
-            ).get(REQUESTEDATTRIBUTE, []
-                  )
-            for requested_attribute in requested_attributes:
-                _attrs = requested_attribute.get(
-                    'attrs', {}
-                )
-                is_required = _attrs.get('isRequired', None)
-                name = _attrs.get('Name')
-                if is_required and is_required == 'true':
-                    result_attributes['required'].append(name)
-                else:
-                    result_attributes['optional'].append(name)
-        return result_attributes
+        return self._lookup.attributes_by_index.get(index, NO_ATTRIBUTES)
 
     @property
     def single_logout_services(self):
-        slos = self.root.get(
-            'children', {}
-        ).get(SPSSODESCRIPTOR, {}
-              ).get(
-            'children', {}
-        ).get(
-            SINGLE_LOGOUT_SERVICE, []
-        )
-        return [
-            slo.get('attrs', {}) for slo in slos
-        ]
+        return self._metadata.sp_sso_descriptor.single_logout_services
 
     def single_logout_service(self, binding):
-        return [
-            slo for slo in self.single_logout_services if slo.get('Binding') == binding
-        ]
+        return self._lookup.slo_by_binding.get(binding, ())
 
     @property
     def _metadata(self):
-        metadata = self._loader.load()
-        return saml_to_dict(metadata)
+        if self._parsed is None:
+            self.load()
+        return self._parsed
 
 
 class ServiceProviderMetadataRegistry(object):
 
+    """
+    Registered Service Providers by entity ID.
+
+    Entries are never modified in place: a reload swaps in a new
+    ServiceProviderMetadata, so whoever already holds the previous one
+    keeps a consistent snapshot.
+    """
+
+    lazy = False
+
     def __init__(self):
         self._metadata = {}
+        self._lock = threading.RLock()
+        self.keyring = KeyRing()
 
     def register(self, metadata):
+        return self.add(metadata) is not None
+
+    def add(self, metadata, replace=True):
+        """
+        Register `metadata`, checking for its entity ID under the registry
+        lock: return 'created' or 'replaced', 'exists' if the entity ID is
+        already registered and `replace` is False, None on failure.
+        """
         try:
-            self._register(metadata)
+            return self._register(metadata, replace)
         except MetadataLoadError as e:
             logger.error(
                 "Impossibile aggiungere metadata al registry: '{}'".format(e))
+        except DeserializationError as e:
+            logger.error(
+                "Impossibile aggiungere metadata al registry: {}".format(
+                    [detail.message for detail in e.details]))
+        return None
 
-    def _register(self, metadata):
+    def _register(self, metadata, replace=True):
+        if not metadata.is_loaded:
+            metadata.load()
         entity_id = metadata.entity_id
-        self._metadata[entity_id] = metadata
+        with self._lock:
+            exists = self.is_registered(entity_id)
+            if exists and not replace:
+                return 'exists'
+            self._update_keyring(entity_id, metadata)
+            self._metadata[entity_id] = metadata
+            spid_schema_cache.invalidate(entity_id)
+        return 'replaced' if exists else 'created'
+
+    def reload(self, entity_id=None):
+        """
+        Reload one or all the Service Providers, return False if any of
+        them kept its previous version.
+        """
+        entity_ids = [entity_id] if entity_id is not None else self.service_providers
+        return all([self._reload(_entity_id) for _entity_id in entity_ids])
+
+    def _reload(self, entity_id):
+        current = self.get(entity_id)
+        metadata = copy(current)
+        try:
+            metadata.reload()
+        except MetadataLoadError as e:
+            logger.error(
+                "Impossibile ricaricare il metadata di '{}', viene mantenuta "
+                "la versione precedente: '{}'".format(entity_id, e))
+            return False
+        except DeserializationError as e:
+            logger.error(
+                "Il metadata di '{}' non è valido, viene mantenuta "
+                "la versione precedente: {}".format(
+                    entity_id, [detail.message for detail in e.details]))
+            return False
+        with self._lock:
+            if self._metadata.get(entity_id) is not current:
+                # unregistered or replaced while reloading
+                return True
+            if metadata.revision == current.revision:
+                self._metadata[entity_id] = metadata
+                return True
+            self._update_keyring(metadata.entity_id, metadata)
+            # publish the new entity ID before dropping the old one
+            self._metadata[metadata.entity_id] = metadata
+            spid_schema_cache.invalidate(entity_id)
+            if metadata.entity_id != entity_id:
+                del self._metadata[entity_id]
+                self.keyring.remove(entity_id)
+                spid_schema_cache.invalidate(metadata.entity_id)
+        return True
+
+    def unregister(self, entity_id):
+        with self._lock:
+            try:
+                del self._metadata[entity_id]
+            except KeyError:
+                raise MetadataNotFoundError(entity_id)
+            self.keyring.remove(entity_id)
+            spid_schema_cache.invalidate(entity_id)
+
+    def is_registered(self, entity_id):
+        return entity_id in self._metadata
+
+    def find(self, source):
+        """
+        Entity ID of the Service Provider loaded from `source`, if any.
+        """
+        for entity_id, metadata in list(self._metadata.items()):
+            if metadata.source == source:
+                return entity_id
+
+    def _update_keyring(self, entity_id, metadata):
+        certificates = []
+        for cert in metadata.certs():
+            try:
+                certificates.append(load_certificate(cert))
+            except ValueError as e:
+                logger.error(
+                    "Certificato non valido nel metadata di '{}': '{}'".format(
+                        entity_id, e))
+        self.keyring.set(entity_id, certificates)
 
     def get(self, entity_id):
         try:
@@ -247,33 +487,948 @@ class ServiceProviderMetadataRegistry(object):
         except KeyError:
             raise MetadataNotFoundError(entity_id)
 
+    def certificates(self, entity_id):
+        return self.keyring.get(entity_id)
+
+    def certificate(self, entity_id, fingerprint):
+        """
+        Certificate of `entity_id` matching a SHA-256 fingerprint, if any.
+        """
+        return self.keyring.find(entity_id, fingerprint)
+
+    def loaded(self):
+        """
+        (entity ID, metadata) pairs currently held in memory.
+        """
+        return list(self._metadata.items())
+
     @property
     def service_providers(self):
         return list(self._metadata.keys())
 
 
+IndexEntry = namedtuple('IndexEntry', ['path', 'offset', 'length', 'digest'])
+
+ENTITY_DESCRIPTOR_START = re.compile(br'<(?:([A-Za-z_][\w.-]*):)?EntityDescriptor(?=[\s>/])')
+SP_SSO_DESCRIPTOR_START = re.compile(br'<(?:[A-Za-z_][\w.-]*:)?SPSSODescriptor(?=[\s>/])')
+ROOT_START = re.compile(br'<(?![?!])[^>]*>')
+ENTITY_ID = re.compile(br'\sentityID\s*=\s*(["\'])(.*?)\1', re.S)
+NAMESPACE_DECLARATION = re.compile(br'\s(xmlns(?::[A-Za-z_][\w.-]*)?)\s*=\s*(["\'])(.*?)\2', re.S)
+SKIPPED_MARKUP_START = re.compile(br'<!--|<!\[CDATA\[')
+SKIPPED_MARKUP_END = {b'<!--': b'-->', b'<![CDATA[': b']]>'}
+
+
+def _search_markup(pattern, data, position=0):
+    """
+    First match of `pattern` in `data` from `position` that is not inside a
+    comment or a CDATA section.
+    """
+    while True:
+        match = pattern.search(data, position)
+        if match is None:
+            return None
+        skipped = SKIPPED_MARKUP_START.search(data, position, match.start())
+        if skipped is None:
+            return match
+        end = data.find(SKIPPED_MARKUP_END[skipped.group(0)], skipped.end())
+        if end < 0:
+            return None
+        position = end + len(SKIPPED_MARKUP_END[skipped.group(0)])
+
+
+def _entity_id(start_tag):
+    """
+    Value of the entityID attribute of an EntityDescriptor start tag, with
+    entity and character references resolved by the XML parser.
+    """
+    match = ENTITY_ID.search(start_tag)
+    if match is None:
+        return None
+    try:
+        return etree.fromstring(b'<a' + match.group(0) + b'/>').get('entityID')
+    except etree.XMLSyntaxError:
+        return None
+
+
+class MetadataOffsetIndex(object):
+    """
+    entityID -> (file, byte offset, length, sha256) of the EntityDescriptor
+    elements of metadata files, built by scanning the raw bytes.
+
+    The namespace declarations of the root element are kept per file, so an
+    EntityDescriptor can be parsed on its own out of an EntitiesDescriptor.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._namespaces = {}
+        self._lock = threading.Lock()
+
+    def add_file(self, path):
+        """
+        (Re)index `path`, return the entity IDs found.
+        """
+        entries, namespaces = self._scan(path)
+        with self._lock:
+            for entity_id in self.entity_ids_in(path):
+                del self._entries[entity_id]
+            self._entries.update(entries)
+            self._namespaces[path] = namespaces
+        return list(entries.keys())
+
+    def entity_ids_in(self, path):
+        return [
+            entity_id for entity_id, entry in self._entries.items() if entry.path == path
+        ]
+
+    @staticmethod
+    def _scan(path):
+        entries = {}
+        with open(path, 'rb') as fp:
+            if os.fstat(fp.fileno()).st_size == 0:
+                return entries, {}
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                root = _search_markup(ROOT_START, data)
+                namespaces = dict(
+                    (match.group(1), match.group(3))
+                    for match in NAMESPACE_DECLARATION.finditer(root.group(0))
+                ) if root else {}
+                position = 0
+                while True:
+                    start = _search_markup(ENTITY_DESCRIPTOR_START, data, position)
+                    if start is None:
+                        break
+                    prefix = start.group(1)
+                    qname = prefix + b':EntityDescriptor' if prefix else b'EntityDescriptor'
+                    close_tag = _search_markup(re.compile(b'</' + re.escape(qname) + b'>'), data, start.end())
+                    if close_tag is None:
+                        break
+                    end = close_tag.end()
+                    start_tag = data[start.start():data.find(b'>', start.end()) + 1]
+                    entity_id = _entity_id(start_tag)
+                    chunk = data[start.start():end]
+                    # Identity Providers, Attribute Authorities... are not indexed
+                    if entity_id is not None and _search_markup(SP_SSO_DESCRIPTOR_START, chunk) is not None:
+                        entries[entity_id] = IndexEntry(
+                            path, start.start(), end - start.start(), hashlib.sha256(chunk).digest())
+                    position = end
+            finally:
+                data.close()
+        return entries, namespaces
+
+    def __contains__(self, entity_id):
+        return entity_id in self._entries
+
+    def discard(self, entity_id):
+        with self._lock:
+            self._entries.pop(entity_id, None)
+
+    def get(self, entity_id):
+        return self._entries[entity_id]
+
+    def find(self, path):
+        entity_ids = self.entity_ids_in(path)
+        return entity_ids[0] if entity_ids else None
+
+    @property
+    def entity_ids(self):
+        return list(self._entries.keys())
+
+    def read(self, entity_id):
+        """
+        Standalone XML document of the EntityDescriptor of `entity_id`.
+        """
+        entry = self._entries[entity_id]
+        with open(entry.path, 'rb') as fp:
+            fp.seek(entry.offset)
+            chunk = fp.read(entry.length)
+        if hashlib.sha256(chunk).digest() != entry.digest:
+            raise MetadataLoadError(
+                "Il file '{}' è stato modificato dopo l'indicizzazione".format(entry.path))
+        start_tag = chunk[:chunk.find(b'>') + 1]
+        declared = set(match.group(1) for match in NAMESPACE_DECLARATION.finditer(start_tag))
+        declarations = b''.join(
+            b' ' + name + b'="' + uri + b'"'
+            for name, uri in self._namespaces.get(entry.path, {}).items()
+            if name not in declared
+        )
+        name_end = ENTITY_DESCRIPTOR_START.match(chunk).end()
+        return chunk[:name_end] + declarations + chunk[name_end:]
+
+
+class ServiceProviderMetadataIndexLoader(ServiceProviderMetadataBaseLoader):
+    """
+    Load a single Service Provider through a MetadataOffsetIndex.
+    """
+
+    def __init__(self, conf, validator, entity_id):
+        super(ServiceProviderMetadataIndexLoader, self).__init__(conf, validator)
+        self._entity_id = entity_id
+
+    @property
+    def source(self):
+        return self._config.get(self._entity_id).path
+
+    def _load(self):
+        try:
+            return self._config.read(self._entity_id)
+        except (IOError, OSError, KeyError) as e:
+            raise MetadataLoadError(
+                "Impossibile leggere il metadata di '{}': '{}'"
+                .format(self._entity_id, e)
+            )
+
+
+class LazyServiceProviderMetadataRegistry(ServiceProviderMetadataRegistry):
+    """
+    Registry parsing and validating a file based Service Provider only when
+    it is first looked up.
+
+    Metadata files are just indexed at startup; parsed entries are kept in
+    an LRU cache of `cache_size` items, while explicitly registered ones
+    (e.g. remote metadata) are never evicted.
+    """
+
+    lazy = True
+
+    def __init__(self, cache_size=METADATA_LAZY_CACHE_SIZE):
+        super(LazyServiceProviderMetadataRegistry, self).__init__()
+        self.index = MetadataOffsetIndex()
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+
+    def add_file(self, path):
+        previous = self.index.entity_ids_in(path)
+        try:
+            entity_ids = self.index.add_file(path)
+        except (IOError, OSError, ValueError) as e:
+            logger.error(
+                "Impossibile indicizzare il file '{}': '{}'".format(path, e))
+            return []
+        with self._lock:
+            for entity_id in set(previous) | set(entity_ids):
+                self._evict(entity_id)
+        return entity_ids
+
+    def get(self, entity_id):
+        with self._lock:
+            if entity_id in self._metadata:
+                return self._metadata[entity_id]
+            if entity_id in self._cache:
+                metadata = self._cache.pop(entity_id)
+                self._cache[entity_id] = metadata
+                return metadata
+        if entity_id not in self.index:
+            raise MetadataNotFoundError(entity_id)
+        return self._load(entity_id)
+
+    def _load(self, entity_id):
+        metadata = ServiceProviderMetadata(_get_loader('index', self.index, entity_id=entity_id))
+        try:
+            try:
+                metadata.load()
+            except MetadataLoadError:
+                # the file changed under the index, look for the entity again
+                self.add_file(self.index.get(entity_id).path)
+                if entity_id not in self.index:
+                    raise MetadataNotFoundError(entity_id)
+                metadata.load()
+        except MetadataLoadError as e:
+            logger.error(
+                "Impossibile caricare il metadata di '{}': '{}'".format(entity_id, e))
+            raise MetadataNotFoundError(entity_id)
+        except DeserializationError as e:
+            logger.error(
+                "Il metadata di '{}' non è valido: {}".format(
+                    entity_id, [detail.message for detail in e.details]))
+            # not a Service Provider until its file changes
+            self.index.discard(entity_id)
+            raise MetadataNotFoundError(entity_id)
+        with self._lock:
+            self._update_keyring(entity_id, metadata)
+            self._cache[entity_id] = metadata
+            spid_schema_cache.invalidate(entity_id)
+            while len(self._cache) > self._cache_size:
+                self._evict(next(iter(self._cache)))
+        return metadata
+
+    def _evict(self, entity_id):
+        if self._cache.pop(entity_id, None) is not None:
+            self.keyring.remove(entity_id)
+            spid_schema_cache.invalidate(entity_id)
+
+    def _reload(self, entity_id):
+        if entity_id in self._metadata:
+            return super(LazyServiceProviderMetadataRegistry, self)._reload(entity_id)
+        if entity_id not in self.index:
+            raise MetadataNotFoundError(entity_id)
+        path = self.index.get(entity_id).path
+        with self._lock:
+            for _entity_id in list(self._cache):
+                if self._cache[_entity_id].source == path:
+                    self._evict(_entity_id)
+        return bool(self.add_file(path))
+
+    def unregister(self, entity_id):
+        if entity_id not in self._metadata and entity_id in self.index:
+            raise MetadataLoadError(
+                "Il Service Provider '{}' è definito in un file di metadata e non "
+                "può essere rimosso".format(entity_id))
+        super(LazyServiceProviderMetadataRegistry, self).unregister(entity_id)
+
+    def is_registered(self, entity_id):
+        return entity_id in self._metadata or entity_id in self.index
+
+    def find(self, source):
+        entity_id = super(LazyServiceProviderMetadataRegistry, self).find(source)
+        if entity_id is None:
+            entity_id = self.index.find(source)
+        return entity_id
+
+    def _ensure_keyring(self, entity_id):
+        if entity_id not in self.keyring:
+            try:
+                self.get(entity_id)
+            except MetadataNotFoundError:
+                pass
+
+    def certificates(self, entity_id):
+        self._ensure_keyring(entity_id)
+        return self.keyring.get(entity_id)
+
+    def certificate(self, entity_id, fingerprint):
+        self._ensure_keyring(entity_id)
+        return self.keyring.find(entity_id, fingerprint)
+
+    def loaded(self):
+        with self._lock:
+            return list(self._metadata.items()) + list(self._cache.items())
+
+    @property
+    def service_providers(self):
+        with self._lock:
+            pinned = list(self._metadata.keys())
+        return pinned + [
+            entity_id for entity_id in self.index.entity_ids if entity_id not in self._metadata
+        ]
+
+
+class MetadataRefresher(threading.Thread):
+    """
+    Periodically fetch again the remote metadata of the registry.
+
+    Each Service Provider is refreshed every `interval` seconds, or earlier
+    if its cacheDuration/validUntil say so; failures are retried with an
+    exponential backoff while the last good copy keeps being served.
+    """
+
+    def __init__(self, registry, interval=METADATA_REFRESH_INTERVAL,
+                 retry_interval=METADATA_RETRY_INTERVAL, max_backoff=METADATA_MAX_BACKOFF,
+                 clock=None):
+        super(MetadataRefresher, self).__init__(name='metadata-refresher')
+        self.daemon = True
+        self._registry = registry
+        self._interval = interval
+        self._retry_interval = retry_interval
+        self._max_backoff = max_backoff
+        self._clock = clock or time.time
+        self._due = {}
+        self._failures = {}
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self._wait_time()):
+            self.refresh_due()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _refreshable(self):
+        return [
+            entity_id for entity_id, metadata in self._registry.loaded()
+            if metadata.is_refreshable
+        ]
+
+    def _schedule(self):
+        entity_ids = self._refreshable()
+        now = self._clock()
+        for entity_id in entity_ids:
+            if entity_id not in self._due:
+                self._due[entity_id] = now + self._next_interval(entity_id)
+        for entity_id in set(self._due) - set(entity_ids):
+            del self._due[entity_id]
+            self._failures.pop(entity_id, None)
+        return self._due
+
+    def _wait_time(self):
+        due = self._schedule()
+        if not due:
+            return self._interval
+        return min(max(min(due.values()) - self._clock(), 0), self._interval)
+
+    def _next_interval(self, entity_id):
+        failures = self._failures.get(entity_id, 0)
+        if failures:
+            return min(self._retry_interval * 2 ** (failures - 1), self._max_backoff)
+        interval = self._interval
+        try:
+            expires_at = self._registry.get(entity_id).expires_at
+        except MetadataNotFoundError:
+            # unregistered in the meantime, dropped by the next _schedule()
+            return interval
+        if expires_at is not None:
+            interval = min(interval, max(expires_at - self._clock(), self._retry_interval))
+        return interval
+
+    def refresh_due(self):
+        now = self._clock()
+        for entity_id, due in list(self._schedule().items()):
+            if due <= now:
+                try:
+                    self.refresh(entity_id)
+                except Exception:
+                    # e.g. unregistered in the meantime: the other
+                    # Service Providers are still refreshed
+                    logger.exception(
+                        "Errore durante l'aggiornamento del metadata di '{}'".format(entity_id))
+                    self._due[entity_id] = self._clock() + self._retry_interval
+
+    def refresh(self, entity_id):
+        del self._due[entity_id]
+        if self._registry.reload(entity_id):
+            self._failures.pop(entity_id, None)
+            if not self._registry.is_registered(entity_id):
+                # new entity ID, scheduled by the next _schedule()
+                return
+        else:
+            self._failures[entity_id] = self._failures.get(entity_id, 0) + 1
+            expires_at = self._registry.get(entity_id).expires_at
+            if expires_at is not None and expires_at <= self._clock():
+                logger.warning(
+                    "Il metadata di '{}' è scaduto, viene servita l'ultima "
+                    "versione valida".format(entity_id))
+        self._due[entity_id] = self._clock() + self._next_interval(entity_id)
+
+
+class MetadataFileWatcher(threading.Thread):
+    """
+    Reload the local metadata files when they change on disk.
+
+    Files are compared by mtime, size and inode every `interval` seconds;
+    with inotify_simple installed the check runs as soon as the kernel
+    reports a write in their directories.
+    """
+
+    def __init__(self, registry, paths, interval=METADATA_WATCH_INTERVAL, clock=None):
+        super(MetadataFileWatcher, self).__init__(name='metadata-file-watcher')
+        self.daemon = True
+        self._registry = registry
+        self._paths = list(paths)
+        self._interval = interval
+        self._clock = clock or time.time
+        self._signatures = {path: self._signature(path) for path in self._paths}
+        self._reloads = 0
+        self._failures = 0
+        self._last_latency = None
+        self._max_latency = None
+        self._stopped = threading.Event()
+
+    @staticmethod
+    def _signature(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size, stat.st_ino
+
+    def _inotify(self):
+        if INotify is None:
+            return None
+        inotify = INotify()
+        mask = inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO | inotify_flags.CREATE
+        for directory in set(os.path.dirname(os.path.abspath(path)) for path in self._paths):
+            inotify.add_watch(directory, mask)
+        return inotify
+
+    def run(self):
+        inotify = self._inotify()
+        while not self._stopped.is_set():
+            if inotify is not None:
+                # collect the events of a whole write before checking
+                inotify.read(timeout=int(self._interval * 1000), read_delay=100)
+            elif self._stopped.wait(self._interval):
+                break
+            self.check()
+
+    def stop(self):
+        self._stopped.set()
+
+    def check(self):
+        for path in self._paths:
+            signature = self._signature(path)
+            if signature != self._signatures[path]:
+                self._signatures[path] = signature
+                if signature is not None:
+                    self.reload(path)
+
+    def reload(self, path):
+        started = self._clock()
+        entity_id = self._registry.find(path)
+        if entity_id is None:
+            loader = _get_loader('local', path)
+            reloaded = self._registry.register(ServiceProviderMetadata(loader))
+        else:
+            reloaded = self._registry.reload(entity_id)
+        latency = self._clock() - started
+        if not reloaded:
+            self._failures += 1
+            return
+        self._reloads += 1
+        self._last_latency = latency
+        self._max_latency = max(latency, self._max_latency or 0)
+        logger.info("Metadata '{}' ricaricato in {:.3f}s".format(path, latency))
+
+    @property
+    def stats(self):
+        return {
+            'paths': len(self._paths),
+            'reloads': self._reloads,
+            'failures': self._failures,
+            'last_reload_latency': self._last_latency,
+            'max_reload_latency': self._max_latency,
+        }
+
+
+class MetadataCache(object):
+    """
+    On-disk cache of validated and parsed metadata, keyed by the SHA-256 of
+    the source bytes and METADATA_CACHE_VERSION.
+
+    Entries are pickled: the directory must not be writable by untrusted
+    users. Write failures are logged and otherwise ignored.
+    """
+
+    suffix = '.pickle'
+
+    def __init__(self, path):
+        self._path = path
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            # already there, possibly created meanwhile by another worker
+            if e.errno != errno.EEXIST or not os.path.isdir(path):
+                raise
+
+    @staticmethod
+    def _hasher():
+        return hashlib.sha256('spid-testenv-metadata-v{}\n'.format(METADATA_CACHE_VERSION).encode('ascii'))
+
+    @classmethod
+    def key(cls, data):
+        hasher = cls._hasher()
+        hasher.update(data)
+        return hasher.hexdigest()
+
+    @classmethod
+    def file_key(cls, path, chunk_size=1024 * 1024):
+        hasher = cls._hasher()
+        with open(path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(chunk_size), b''):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self._path, key + self.suffix)
+
+    def get(self, key):
+        try:
+            with open(self._entry_path(key), 'rb') as fp:
+                return pickle.load(fp)
+        except (IOError, OSError):
+            return None
+        except Exception as e:
+            logger.warning(
+                "Voce della cache dei metadata '{}' non leggibile: '{}'".format(key, e))
+            return None
+
+    def set(self, key, value):
+        with self.writer(key) as dump:
+            dump(value)
+
+    def iter_entries(self, key):
+        """
+        Values written by writer(key); None if missing or unreadable.
+
+        The whole entry is read before returning, so that a truncated or
+        corrupted one is a cache miss rather than a partial load.
+        """
+        try:
+            fp = open(self._entry_path(key), 'rb')
+        except (IOError, OSError):
+            return None
+        entries = []
+        with fp:
+            while True:
+                try:
+                    entries.append(pickle.load(fp))
+                except EOFError:
+                    return entries
+                except Exception as e:
+                    logger.warning(
+                        "Voce della cache dei metadata '{}' non leggibile: '{}'".format(key, e))
+                    return None
+
+    @contextmanager
+    def writer(self, key):
+        """
+        Append values to a new entry, published only if the block succeeds.
+
+        A write failure (e.g. a full disk) disables the entry, not the block.
+        """
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self._path, suffix='.tmp')
+        except (IOError, OSError) as e:
+            logger.warning("Impossibile scrivere nella cache dei metadata: '{}'".format(e))
+            yield lambda value: None
+            return
+        fp = os.fdopen(fd, 'wb')
+        errors = []
+
+        def dump(value):
+            if errors:
+                return
+            try:
+                pickle.dump(value, fp, pickle.HIGHEST_PROTOCOL)
+            except (IOError, OSError, pickle.PicklingError) as e:
+                errors.append(e)
+
+        try:
+            yield dump
+            try:
+                fp.close()
+                if not errors:
+                    getattr(os, 'replace', os.rename)(tmp_path, self._entry_path(key))
+            except (IOError, OSError) as e:
+                errors.append(e)
+            if errors:
+                logger.warning(
+                    "Impossibile scrivere nella cache dei metadata: '{}'".format(errors[0]))
+        finally:
+            fp.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def prune(self, keys):
+        """
+        Remove the entries not listed in `keys`.
+        """
+        keep = set(key + self.suffix for key in keys)
+        for name in os.listdir(self._path):
+            if name.endswith(self.suffix) and name not in keep:
+                try:
+                    os.remove(os.path.join(self._path, name))
+                except OSError:
+                    pass
+
+
 registry = None
+refresher = None
+watcher = None
 
 
 def build_metadata_registry():
     global registry
-    registry = ServiceProviderMetadataRegistry()
+    conf = config.params.metadata_loading
+    if conf['lazy']:
+        registry = LazyServiceProviderMetadataRegistry(conf['cache_size'])
+    else:
+        registry = ServiceProviderMetadataRegistry()
     _populate_registry(registry)
 
 
+def start_metadata_refresher():
+    """
+    Start the thread refreshing the remote metadata, a forked worker
+    process has to start its own.
+    """
+    global refresher
+    conf = config.params.metadata_refresh
+    if not conf['interval'] or not config.params.metadata['remote']:
+        return
+    refresher = MetadataRefresher(
+        registry,
+        interval=conf['interval'],
+        retry_interval=conf['retry_interval'],
+        max_backoff=conf['max_backoff'],
+    )
+    refresher.start()
+
+
+def start_metadata_watcher():
+    """
+    Start the thread reloading the local metadata files, a forked worker
+    process has to start its own.
+    """
+    global watcher
+    interval = config.params.metadata_refresh['watch_interval']
+    if not interval or not config.params.metadata['local']:
+        return
+    watcher = MetadataFileWatcher(registry, config.params.metadata['local'], interval)
+    watcher.start()
+
+
+def open_metadata_cache(path):
+    """
+    The MetadataCache in `path`, None if there is none or its directory
+    can not be created: metadata are then loaded without the cache.
+    """
+    if not path:
+        return None
+    try:
+        return MetadataCache(path)
+    except (IOError, OSError) as e:
+        logger.error("Cache dei metadata '{}' non utilizzabile: '{}'".format(path, e))
+        return None
+
+
+SourceLoadResult = namedtuple(
+    'SourceLoadResult', ['metadata', 'parsed', 'elapsed', 'error', 'cache_key'])
+
+
 def _populate_registry(registry):
-    for source_type, source_params in config.params.metadata.items():
-        for param in source_params:
-            loader = _get_loader(source_type, param)
+    conf = config.params.metadata_loading
+    timeout = config.params.metadata_refresh['timeout']
+    # built once, the jobs only read and write its entries
+    cache = open_metadata_cache(conf['cache_dir'])
+    if registry.lazy:
+        # files are only indexed, their entities are loaded on first use
+        started = time.time()
+        for path in config.params.metadata['local'] + config.params.metadata['aggregate']:
+            registry.add_file(path)
+        logger.info('Indicizzati {} metadata in {:.3f}s'.format(
+            len(registry.service_providers), time.time() - started))
+        source_types = ('remote',)
+    else:
+        source_types = ('local', 'remote')
+    sources = [
+        (source_type, param)
+        for source_type in source_types
+        for param in config.params.metadata[source_type]
+    ]
+    loaders = [_get_loader(source_type, param, timeout) for source_type, param in sources]
+    if conf['pool'] == 'process':
+        # loaders hold lxml objects, the workers build their own
+        jobs = [(source_type, param, timeout, None, cache) for source_type, param in sources]
+    else:
+        jobs = [(source_type, param, timeout, loader, cache)
+                for (source_type, param), loader in zip(sources, loaders)]
+    started = time.time()
+    results = _run_pool(conf['pool'], conf['workers'], _load_source, jobs)
+    elapsed = time.time() - started
+    for loader, result in zip(loaders, results):
+        if result.error is not None:
+            logger.error(
+                "Impossibile aggiungere metadata al registry: '{}'".format(result.error))
+            continue
+        metadata = ServiceProviderMetadata(loader)
+        metadata._update(result.metadata, result.parsed)
+        registry.register(metadata)
+    _log_load_summary(sources, results, elapsed)
+    cache_keys = [result.cache_key for result in results if result.cache_key]
+    if not registry.lazy:
+        for path in config.params.metadata['aggregate']:
+            cache_keys.append(load_entities_descriptor(registry, path, cache))
+    if cache is not None:
+        cache.prune([key for key in cache_keys if key])
+
+
+def load_documents(documents):
+    """
+    Validate and parse metadata documents in parallel threads; return a
+    (ServiceProviderMetadata or None, SourceLoadResult) pair for each
+    document.
+
+    Threads are used even if the startup loading runs in processes: this
+    is called while serving requests, and forking a threaded server is
+    not safe.
+    """
+    conf = config.params.metadata_loading
+    loaders = [_get_loader('inline', document) for document in documents]
+    jobs = [('inline', document, None, loader, None)
+            for document, loader in zip(documents, loaders)]
+    results = _run_pool('thread', conf['workers'], _load_source, jobs)
+    loaded = []
+    for loader, result in zip(loaders, results):
+        metadata = None
+        if result.error is None:
             metadata = ServiceProviderMetadata(loader)
-            registry.register(metadata)
+            metadata._update(result.metadata, result.parsed)
+        loaded.append((metadata, result))
+    return loaded
+
+
+def load_entities_descriptor(registry, path, cache=None):
+    """
+    Register the Service Providers of an aggregated metadata file, each one
+    validated and indexed as soon as it has been parsed.
+
+    With a MetadataCache the parsed entities of an unchanged file are read
+    back from it; return the cache key of the file, if any.
+    """
+    started = time.time()
+    key = None
+    if cache is not None:
+        try:
+            key = cache.file_key(path)
+        except (IOError, OSError) as e:
+            logger.error(
+                "Impossibile leggere il file '{}': '{}'".format(path, e))
+            return None
+        entries = cache.iter_entries(key)
+        if entries is not None:
+            loaded = 0
+            for entity_id, parsed in entries:
+                _register_parsed(registry, path, entity_id, parsed)
+                loaded += 1
+            logger.info(
+                "Caricati {} metadata dal file '{}' in {:.3f}s (cache)".format(
+                    loaded, path, time.time() - started))
+            return key
+    writer = cache.writer(key) if cache is not None else _null_writer()
+    try:
+        with writer as dump:
+            loaded, failed, skipped = _ingest_entities_descriptor(registry, path, dump)
+    except (IOError, OSError, etree.XMLSyntaxError) as e:
+        logger.error(
+            "Impossibile leggere il file '{}': '{}'".format(path, e))
+        return None
+    logger.info(
+        "Caricati {} metadata dal file '{}' in {:.3f}s ({} errori, {} non SP)".format(
+            loaded, path, time.time() - started, failed, skipped))
+    return key
+
+
+def _ingest_entities_descriptor(registry, path, dump):
+    validator = ServiceProviderMetadataXMLSchemaValidator()
+    loaded = failed = skipped = 0
+    for element in iter_entity_descriptors(path):
+        entity_id = element.get('entityID')
+        if element.find(SPSSODESCRIPTOR) is None:
+            # Identity Providers, Attribute Authorities...
+            skipped += 1
+            continue
+        try:
+            validator.validate_element(element)
+        except ValidationError as e:
+            logger.error(
+                "Il metadata di '{}' nel file '{}' non è valido: {}".format(
+                    entity_id, path, [detail.message for detail in e.details]))
+            failed += 1
+            continue
+        parsed = parse_entity_descriptor(element)
+        _register_parsed(registry, path, entity_id, parsed)
+        dump((entity_id, parsed))
+        loaded += 1
+    return loaded, failed, skipped
+
+
+def _register_parsed(registry, path, entity_id, parsed):
+    loader = _get_loader('aggregate', path, entity_id=entity_id)
+    metadata = ServiceProviderMetadata(loader)
+    metadata._update(None, parsed)
+    registry.register(metadata)
+
+
+@contextmanager
+def _null_writer():
+    yield lambda value: None
+
+
+def _run_pool(pool_type, workers, func, jobs):
+    if workers < 2 or len(jobs) < 2:
+        return [func(job) for job in jobs]
+    Pool = multiprocessing.Pool if pool_type == 'process' else ThreadPool
+    pool = Pool(min(workers, len(jobs)))
+    try:
+        return pool.map(func, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _load_source(job):
+    """
+    Fetch, validate and parse a metadata source, run by the loading pool.
+    """
+    source_type, source_params, timeout, loader, cache = job
+    started = time.time()
+    if loader is None:
+        loader = _get_loader(source_type, source_params, timeout)
+    key = parsed = None
+    try:
+        metadata = loader.fetch()
+        if cache is not None:
+            key = cache.key(metadata)
+            parsed = cache.get(key)
+        if parsed is None:
+            loader.validate(metadata)
+            parsed = parse_entity_descriptor(metadata)
+            if cache is not None:
+                cache.set(key, parsed)
+        else:
+            loader.mark_valid(metadata)
+    except MetadataLoadError as e:
+        return SourceLoadResult(None, None, time.time() - started, e, None)
+    except DeserializationError as e:
+        error = MetadataLoadError(
+            "Il metadata '{}' non è valido: {}".format(
+                _source_label(source_type, source_params),
+                [detail.message for detail in e.details]))
+        return SourceLoadResult(None, None, time.time() - started, error, None)
+    return SourceLoadResult(metadata, parsed, time.time() - started, None, key)
+
+
+def _source_label(source_type, source_params):
+    if source_type == 'remote':
+        return source_params.get('url')
+    if source_type == 'inline':
+        return 'caricato a runtime'
+    return source_params
+
+
+def _log_load_summary(sources, results, elapsed, slowest=5):
+    timings = sorted(
+        [
+            (result.elapsed, _source_label(*source))
+            for source, result in zip(sources, results)
+        ],
+        reverse=True,
+    )
+    for source_elapsed, label in timings:
+        logger.debug("Metadata '{}' caricato in {:.3f}s".format(label, source_elapsed))
+    failed = len([result for result in results if result.error is not None])
+    logger.info(
+        'Caricati {} metadata in {:.3f}s ({} errori)'.format(
+            len(results) - failed, elapsed, failed))
+    if timings:
+        logger.info('Metadata più lenti: {}'.format(', '.join(
+            "'{}' ({:.3f}s)".format(label, source_elapsed)
+            for source_elapsed, label in timings[:slowest])))
 
 
-def _get_loader(source_type, source_params):
+def _get_loader(source_type, source_params, timeout=METADATA_HTTP_TIMEOUT, entity_id=None):
     Loader = {
         'local': ServiceProviderMetadataFileLoader,
         'remote': ServiceProviderMetadataHTTPLoader,
+        'aggregate': ServiceProviderMetadataAggregateLoader,
+        'index': ServiceProviderMetadataIndexLoader,
+        'inline': ServiceProviderMetadataStaticLoader,
     }[source_type]
     validator = ValidatorGroup(
         [XMLMetadataFormatValidator(), ServiceProviderMetadataXMLSchemaValidator()])
+    if source_type == 'remote':
+        return Loader(source_params, validator, timeout=timeout)
+    if source_type in ('aggregate', 'index'):
+        return Loader(source_params, validator, entity_id)
     return Loader(source_params, validator)
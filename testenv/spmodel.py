@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import namedtuple
+
+from lxml import etree
+
+from testenv.saml import (
+    AssertionConsumerService as AssertionConsumerServiceElement,
+    AttributeConsumingService as AttributeConsumingServiceElement, EntityDescriptor as EntityDescriptorElement,
+    KeyDescriptor as KeyDescriptorElement, RequestedAttribute, ServiceName,
+    SingleLogoutService as SingleLogoutServiceElement, SPSSODescriptor as SPSSODescriptorElement, X509Certificate,
+)
+from testenv.utils import FrozenDict
+
+ENTITYDESCRIPTOR = EntityDescriptorElement.tag()
+SPSSODESCRIPTOR = SPSSODescriptorElement.tag()
+KEYDESCRIPTOR = KeyDescriptorElement.tag()
+X509CERTIFICATE = X509Certificate.tag()
+ASSERTION_CONSUMER_SERVICE = AssertionConsumerServiceElement.tag()
+ATTRIBUTE_CONSUMING_SERVICE = AttributeConsumingServiceElement.tag()
+SERVICE_NAME = ServiceName.tag()
+REQUESTEDATTRIBUTE = RequestedAttribute.tag()
+SINGLE_LOGOUT_SERVICE = SingleLogoutServiceElement.tag()
+
+NO_ATTRIBUTES = FrozenDict({'required': (), 'optional': ()})
+
+
+def _boolean(value):
+    if value is None:
+        return None
+    return value in ('true', '1')
+
+
+def _group_by(items, key):
+    groups = {}
+    for item in items:
+        name = key(item)
+        groups[name] = groups.get(name, ()) + (item,)
+    return FrozenDict(groups)
+
+
+class _Model(object):
+    """
+    Read-only record of a metadata element. Only the values in `_fields`
+    are compared and pickled; other slots hold tables derived from them.
+    """
+
+    __slots__ = ()
+    _fields = ()
+
+    def __init__(self, *args):
+        self.__setstate__(args)
+
+    def _build(self):
+        pass
+
+    def _set(self, name, value):
+        object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("'{}' is read-only".format(self.__class__.__name__))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.__getstate__() == other.__getstate__()
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self._fields)
+
+    def __setstate__(self, state):
+        for name, value in zip(self._fields, state):
+            self._set(name, value)
+        self._build()
+
+    def __repr__(self):
+        return '{}({})'.format(
+            self.__class__.__name__,
+            ', '.join('{}={!r}'.format(name, getattr(self, name)) for name in self._fields),
+        )
+
+
+class KeyDescriptor(_Model):
+
+    __slots__ = _fields = ('use', 'certificates')
+
+    @classmethod
+    def from_element(cls, element):
+        # base64 certificates without the line breaks of the document
+        return cls(element.get('use'), tuple(
+            ''.join(line.strip() for line in cert.text.split('\n'))
+            for cert in element.iter(X509CERTIFICATE) if cert.text is not None
+        ))
+
+
+class Endpoint(_Model):
+
+    __slots__ = _fields = ('binding', 'location')
+
+
+class AssertionConsumerService(Endpoint):
+
+    __slots__ = ('index', 'is_default')
+    _fields = Endpoint._fields + __slots__
+
+    @classmethod
+    def from_element(cls, element):
+        return cls(
+            element.get('Binding'), element.get('Location'),
+            element.get('index'), _boolean(element.get('isDefault')),
+        )
+
+
+class SingleLogoutService(Endpoint):
+
+    __slots__ = ('response_location',)
+    _fields = Endpoint._fields + __slots__
+
+    @classmethod
+    def from_element(cls, element):
+        return cls(
+            element.get('Binding'), element.get('Location'), element.get('ResponseLocation'))
+
+
+class AttributeConsumingService(_Model):
+
+    __slots__ = _fields = ('index', 'service_names', 'required', 'optional')
+
+    @classmethod
+    def from_element(cls, element):
+        required, optional = [], []
+        for requested_attribute in element.iterchildren(REQUESTEDATTRIBUTE):
+            if requested_attribute.get('isRequired') == 'true':
+                required.append(requested_attribute.get('Name'))
+            else:
+                optional.append(requested_attribute.get('Name'))
+        return cls(
+            element.get('index'),
+            tuple(name.text for name in element.iterchildren(SERVICE_NAME)),
+            tuple(required), tuple(optional),
+        )
+
+    @property
+    def attributes(self):
+        return FrozenDict({'required': self.required, 'optional': self.optional})
+
+
+MetadataLookup = namedtuple('MetadataLookup', [
+    'acs_by_index', 'acs_by_binding', 'acs_indexes', 'acs_urls',
+    'atcs_by_index', 'atcs_indexes', 'attributes_by_index', 'slo_by_binding',
+])
+
+
+def _build_lookup(sp_sso_descriptor):
+    """
+    Read-only lookup tables of an SPSSODescriptor, keyed by index and
+    binding. Indexes and URLs are tuples in document order, so they can be
+    listed in error messages as well.
+    """
+    acss = sp_sso_descriptor.assertion_consumer_services
+    atcss = sp_sso_descriptor.attribute_consuming_services
+    attributes_by_index = {}
+    for atcs in atcss:
+        # the first service with a given index wins
+        attributes_by_index.setdefault(atcs.index, atcs.attributes)
+    return MetadataLookup(
+        acs_by_index=_group_by(acss, lambda acs: acs.index),
+        acs_by_binding=_group_by(acss, lambda acs: acs.binding),
+        acs_indexes=tuple(str(acs.index) for acs in acss),
+        acs_urls=tuple(str(acs.location) for acs in acss),
+        atcs_by_index=_group_by(atcss, lambda atcs: atcs.index),
+        atcs_indexes=tuple(atcs.index for atcs in atcss if atcs.index is not None),
+        attributes_by_index=FrozenDict(attributes_by_index),
+        slo_by_binding=_group_by(sp_sso_descriptor.single_logout_services, lambda slo: slo.binding),
+    )
+
+
+class SPSSODescriptor(_Model):
+    """
+    Service Provider role of an EntityDescriptor, with its endpoints
+    indexed by index and binding.
+    """
+
+    __slots__ = (
+        'authn_requests_signed', 'want_assertions_signed', 'key_descriptors',
+        'assertion_consumer_services', 'attribute_consuming_services', 'single_logout_services',
+        'lookup',
+    )
+    _fields = __slots__[:6]
+
+    @classmethod
+    def from_element(cls, element):
+        return cls(
+            _boolean(element.get('AuthnRequestsSigned')),
+            _boolean(element.get('WantAssertionsSigned')),
+            tuple(KeyDescriptor.from_element(child) for child in element.iterchildren(KEYDESCRIPTOR)),
+            tuple(
+                AssertionConsumerService.from_element(child)
+                for child in element.iterchildren(ASSERTION_CONSUMER_SERVICE)
+            ),
+            tuple(
+                AttributeConsumingService.from_element(child)
+                for child in element.iterchildren(ATTRIBUTE_CONSUMING_SERVICE)
+            ),
+            tuple(
+                SingleLogoutService.from_element(child)
+                for child in element.iterchildren(SINGLE_LOGOUT_SERVICE)
+            ),
+        )
+
+    def _build(self):
+        self._set('lookup', _build_lookup(self))
+
+    def certificates(self, use='signing'):
+        return [
+            cert
+            for key_descriptor in self.key_descriptors if key_descriptor.use == use
+            for cert in key_descriptor.certificates
+        ]
+
+
+NO_SP_SSO_DESCRIPTOR = SPSSODescriptor(None, None, (), (), (), ())
+
+
+class EntityDescriptor(_Model):
+
+    __slots__ = _fields = ('entity_id', 'valid_until', 'cache_duration', 'sp_sso_descriptor')
+
+    @classmethod
+    def from_element(cls, element):
+        sp_sso_descriptor = element.find(SPSSODESCRIPTOR)
+        return cls(
+            element.get('entityID'),
+            element.get('validUntil'),
+            element.get('cacheDuration'),
+            SPSSODescriptor.from_element(sp_sso_descriptor)
+            if sp_sso_descriptor is not None else NO_SP_SSO_DESCRIPTOR,
+        )
+
+
+def parse_entity_descriptor(xml):
+    """
+    Build the EntityDescriptor model of a metadata document, given as
+    bytes or as an already parsed element.
+    """
+    element = xml if etree.iselement(xml) else etree.fromstring(xml)
+    if element.tag != ENTITYDESCRIPTOR:
+        return EntityDescriptor(None, None, None, NO_SP_SSO_DESCRIPTOR)
+    return EntityDescriptor.from_element(element)
@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 600  # seconds
+DEFAULT_MAX_SIZE = 10000
+DEFAULT_SWEEP_INTERVAL = 60  # seconds
+DEFAULT_SQLITE_PATH = 'spid-testenv-state.db'
+
+
+class BaseStateStore(MutableMapping):
+    """
+    Dictionary-like store for the transient state of the IdP (pending
+    AuthnRequests, rendered responses, OTP challenges).
+
+    Every entry expires `ttl` seconds after it has been written and the
+    least recently used entries are evicted once `max_size` is reached.
+    Backends implement the underscore methods below.
+    """
+
+    def __init__(self, name, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE, clock=None):
+        self.name = name
+        self._ttl = ttl
+        self._max_size = max_size
+        self._clock = clock or time.time
+        self._evictions = 0
+        self._expirations = 0
+
+    @classmethod
+    def from_config(cls, name, conf):
+        return cls(
+            name,
+            ttl=conf.get('ttl', DEFAULT_TTL),
+            max_size=conf.get('max_size', DEFAULT_MAX_SIZE),
+        )
+
+    def _expires_at(self):
+        if not self._ttl:
+            return None
+        return self._clock() + self._ttl
+
+    def _is_expired(self, expires_at):
+        return expires_at is not None and expires_at <= self._clock()
+
+    def __getitem__(self, key):
+        return self._get(key)
+
+    def __setitem__(self, key, value):
+        self._set(key, value, self._expires_at())
+
+    def __delitem__(self, key):
+        self._delete(key)
+
+    def __iter__(self):
+        return iter(self._keys())
+
+    def __len__(self):
+        return self._len()
+
+    def __contains__(self, key):
+        try:
+            self._get(key)
+        except KeyError:
+            return False
+        return True
+
+    def keys(self):
+        return self._keys()
+
+    def purge_expired(self):
+        """
+        Drop the expired entries, return how many were removed.
+        """
+        purged = self._purge_expired()
+        self._expirations += purged
+        return purged
+
+    @property
+    def stats(self):
+        return {
+            'name': self.name,
+            'size': len(self),
+            'max_size': self._max_size,
+            'evictions': self._evictions,
+            'expirations': self._expirations,
+        }
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def _set(self, key, value, expires_at):
+        raise NotImplementedError
+
+    def _delete(self, key):
+        raise NotImplementedError
+
+    def _keys(self):
+        raise NotImplementedError
+
+    def _len(self):
+        raise NotImplementedError
+
+    def _purge_expired(self):
+        raise NotImplementedError
+
+
+class InMemoryStateStore(BaseStateStore):
+
+    def __init__(self, *args, **kwargs):
+        super(InMemoryStateStore, self).__init__(*args, **kwargs)
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def _get(self, key):
+        with self._lock:
+            value, expires_at = self._entries[key]
+            if self._is_expired(expires_at):
+                del self._entries[key]
+                self._expirations += 1
+                raise KeyError(key)
+            # most recently used entries are kept at the end
+            del self._entries[key]
+            self._entries[key] = (value, expires_at)
+            return value
+
+    def _set(self, key, value, expires_at):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires_at)
+            while self._max_size and len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def _delete(self, key):
+        with self._lock:
+            del self._entries[key]
+
+    def pop(self, key, *default):
+        with self._lock:
+            return super(InMemoryStateStore, self).pop(key, *default)
+
+    def _keys(self):
+        with self._lock:
+            return [
+                key for key, (_, expires_at) in self._entries.items()
+                if not self._is_expired(expires_at)
+            ]
+
+    def _len(self):
+        return len(self._keys())
+
+    def _purge_expired(self):
+        with self._lock:
+            expired = [
+                key for key, (_, expires_at) in self._entries.items()
+                if self._is_expired(expires_at)
+            ]
+            for key in expired:
+                del self._entries[key]
+            return len(expired)
+
+
+class SQLiteStateStore(BaseStateStore):
+    """
+    State store on a local SQLite database in WAL mode, shared by all the
+    worker processes of the host. Values are pickled; eviction and
+    expiration counters are local to the process.
+    """
+
+    _schema = (
+        'CREATE TABLE IF NOT EXISTS state ('
+        ' store TEXT NOT NULL,'
+        ' key TEXT NOT NULL,'
+        ' value BLOB NOT NULL,'
+        ' expires_at REAL,'
+        ' seq INTEGER NOT NULL,'
+        ' PRIMARY KEY (store, key))',
+        'CREATE INDEX IF NOT EXISTS state_seq ON state (store, seq)',
+        'CREATE INDEX IF NOT EXISTS state_expires_at ON state (store, expires_at)',
+    )
+    # logical clock shared by all processes, orders entries by last use
+    _next_seq = '(SELECT IFNULL(MAX(seq), 0) + 1 FROM state WHERE store = ?)'
+
+    def __init__(self, name, path=DEFAULT_SQLITE_PATH, timeout=30, **kwargs):
+        super(SQLiteStateStore, self).__init__(name, **kwargs)
+        self._path = path
+        self._timeout = timeout
+        self._local = threading.local()
+        with self._transaction() as conn:
+            for statement in self._schema:
+                conn.execute(statement)
+
+    @classmethod
+    def from_config(cls, name, conf):
+        return cls(
+            name,
+            path=conf.get('path', DEFAULT_SQLITE_PATH),
+            ttl=conf.get('ttl', DEFAULT_TTL),
+            max_size=conf.get('max_size', DEFAULT_MAX_SIZE),
+        )
+
+    @property
+    def _connection(self):
+        # one connection per thread, never shared with a forked child
+        conn, pid = getattr(self._local, 'connection', (None, None))
+        if conn is None or pid != os.getpid():
+            conn = sqlite3.connect(
+                self._path, timeout=self._timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = (conn, os.getpid())
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        else:
+            conn.execute('COMMIT')
+
+    @staticmethod
+    def _dumps(value):
+        return sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    @staticmethod
+    def _loads(value):
+        return pickle.loads(bytes(value))
+
+    def _fetch(self, conn, key):
+        row = conn.execute(
+            'SELECT value, expires_at FROM state WHERE store = ? AND key = ?',
+            (self.name, key),
+        ).fetchone()
+        if row is None:
+            return None
+        if self._is_expired(row[1]):
+            conn.execute(
+                'DELETE FROM state WHERE store = ? AND key = ?', (self.name, key))
+            self._expirations += 1
+            return None
+        return row[0]
+
+    def _get(self, key):
+        with self._transaction() as conn:
+            value = self._fetch(conn, key)
+            if value is not None:
+                conn.execute(
+                    'UPDATE state SET seq = {} WHERE store = ? AND key = ?'.format(self._next_seq),
+                    (self.name, self.name, key),
+                )
+        if value is None:
+            raise KeyError(key)
+        return self._loads(value)
+
+    def _set(self, key, value, expires_at):
+        with self._transaction() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO state (store, key, value, expires_at, seq) '
+                'VALUES (?, ?, ?, ?, {})'.format(self._next_seq),
+                (self.name, key, self._dumps(value), expires_at, self.name),
+            )
+            if self._max_size:
+                cursor = conn.execute(
+                    'DELETE FROM state WHERE store = ? AND key IN ('
+                    ' SELECT key FROM state WHERE store = ?'
+                    ' ORDER BY seq DESC LIMIT -1 OFFSET ?)',
+                    (self.name, self.name, self._max_size),
+                )
+                self._evictions += max(cursor.rowcount, 0)
+
+    def _delete(self, key):
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                'DELETE FROM state WHERE store = ? AND key = ?', (self.name, key))
+            if cursor.rowcount < 1:
+                raise KeyError(key)
+
+    def pop(self, key, *default):
+        # read and delete atomically, another worker may be popping too
+        with self._transaction() as conn:
+            value = self._fetch(conn, key)
+            if value is not None:
+                conn.execute(
+                    'DELETE FROM state WHERE store = ? AND key = ?', (self.name, key))
+        if value is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        return self._loads(value)
+
+    def _keys(self):
+        rows = self._connection.execute(
+            'SELECT key FROM state WHERE store = ? AND (expires_at IS NULL OR expires_at > ?) '
+            'ORDER BY seq',
+            (self.name, self._clock()),
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def _len(self):
+        return self._connection.execute(
+            'SELECT COUNT(*) FROM state WHERE store = ? AND (expires_at IS NULL OR expires_at > ?)',
+            (self.name, self._clock()),
+        ).fetchone()[0]
+
+    def _purge_expired(self):
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                'DELETE FROM state WHERE store = ? AND expires_at <= ?',
+                (self.name, self._clock()),
+            )
+            return max(cursor.rowcount, 0)
+
+
+STATE_STORE_BACKENDS = {
+    'memory': InMemoryStateStore,
+    'sqlite': SQLiteStateStore,
+}
+
+
+def create_state_store(name, conf):
+    """
+    Build the store `name` as described by the `storage` configuration.
+    """
+    backend = STATE_STORE_BACKENDS[conf.get('backend', 'memory')]
+    return backend.from_config(name, conf)
+
+
+class StateStoreSweeper(threading.Thread):
+    """
+    Periodically drop the expired entries of a group of stores.
+    """
+
+    def __init__(self, stores, interval=DEFAULT_SWEEP_INTERVAL):
+        super(StateStoreSweeper, self).__init__(name='state-store-sweeper')
+        self.daemon = True
+        self._stores = stores
+        self._interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            self.sweep()
+
+    def sweep(self):
+        for store in self._stores:
+            try:
+                purged = store.purge_expired()
+            except Exception:
+                logger.exception(
+                    "Errore durante la pulizia dello store '{}'".format(store.name))
+                continue
+            if purged:
+                logger.debug(
+                    "Rimossi {} elementi scaduti dallo store '{}'".format(purged, store.name))
+
+    def stop(self):
+        self._stopped.set()
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import unittest
+
+from flask import Flask
+
+from testenv.admin import MetadataAdminAPI
+from testenv.config import ConfigValidator
+from testenv.exceptions import BadConfiguration
+from testenv.spmetadata import ServiceProviderMetadata, ServiceProviderMetadataRegistry
+from testenv.storage import InMemoryStateStore
+from testenv.tests.test_spmetadata import FakeLoader, _read_example_metadata
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+TOKEN = 'an-admin-token-for-tests'
+
+
+class FakeConfig(object):
+    admin = {'token': TOKEN}
+    metadata_loading = {'pool': 'thread', 'workers': 4}
+
+
+class FakeSigningService(object):
+    stats = {'workers': 2, 'pending': 0, 'completed': 10}
+
+
+class FakeWatcher(object):
+    stats = {'paths': 1, 'reloads': 2, 'failures': 0}
+
+
+class MetadataAdminAPITestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.xml = _read_example_metadata().decode('utf-8')
+        self.registry = ServiceProviderMetadataRegistry()
+        self.registry.register(ServiceProviderMetadata(FakeLoader(self.xml.encode('utf-8'))))
+        app = Flask(__name__)
+        self.ticket = InMemoryStateStore('ticket')
+        MetadataAdminAPI(app, self.registry, FakeConfig(), FakeSigningService(), [self.ticket])
+        self.client = app.test_client()
+        self.patcher = patch('testenv.config.params', FakeConfig())
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def _request(self, method, url='/admin/metadata', token=TOKEN, **kwargs):
+        headers = {'Authorization': 'Bearer {}'.format(token)} if token else {}
+        response = getattr(self.client, method)(url, headers=headers, **kwargs)
+        return response.status_code, json.loads(response.get_data(as_text=True))
+
+    def _metadata(self, entity_id):
+        return self.xml.replace('https://spid.test:8000', entity_id)
+
+    def test_authentication(self):
+        self.assertEqual(self._request('get', token=None)[0], 401)
+        self.assertEqual(self._request('get', token='wrong')[0], 401)
+        status, data = self._request('get')
+        self.assertEqual(status, 200)
+        self.assertEqual(data['service_providers'], ['https://spid.test:8000'])
+
+    def test_bulk_add(self):
+        documents = [self._metadata('https://sp{}.spid.test'.format(index)) for index in range(3)]
+        documents.append('<md:EntityDescriptor')
+        documents.append(self._metadata('https://spid.test:8000'))
+        status, data = self._request('post', json={'metadata': documents})
+        self.assertEqual(status, 200)
+        self.assertEqual(
+            [result['status'] for result in data['results']],
+            ['created', 'created', 'created', 'error', 'error'])
+        self.assertEqual(data['errors'], 2)
+        self.assertIn('elapsed', data['results'][0])
+        self.assertEqual(len(self.registry.service_providers), 4)
+
+    def test_bulk_add_without_processes(self):
+        # the startup loading may use processes, the admin API never forks
+        FakeConfig.metadata_loading = {'pool': 'process', 'workers': 4}
+        documents = [self._metadata('https://sp{}.spid.test'.format(index)) for index in range(3)]
+        try:
+            with patch('multiprocessing.Pool') as pool:
+                status, data = self._request('post', json={'metadata': documents})
+        finally:
+            FakeConfig.metadata_loading = {'pool': 'thread', 'workers': 4}
+        self.assertFalse(pool.called)
+        self.assertEqual(data['errors'], 0)
+
+    def test_replace(self):
+        status, data = self._request(
+            'put', data=self._metadata('https://spid.test:8000'),
+            content_type='application/samlmetadata+xml')
+        self.assertEqual(data['results'][0]['status'], 'replaced')
+
+    def test_delete(self):
+        status, data = self._request('delete', '/admin/metadata/https://spid.test:8000')
+        self.assertEqual(status, 200)
+        self.assertEqual(self.registry.service_providers, [])
+        status, data = self._request('delete', json={'entity_ids': ['https://spid.test:8000']})
+        self.assertEqual(data['results'][0]['status'], 'not_found')
+
+    def test_signing_stats(self):
+        self.assertEqual(self._request('get', '/admin/signing', token=None)[0], 401)
+        status, data = self._request('get', '/admin/signing')
+        self.assertEqual(status, 200)
+        self.assertEqual(data, FakeSigningService.stats)
+
+    def test_metadata_stats(self):
+        self.ticket['request-id'] = 'request'
+        self.assertEqual(self._request('get', '/admin/metadata/stats', token=None)[0], 401)
+        with patch('testenv.spmetadata.watcher', None):
+            status, data = self._request('get', '/admin/metadata/stats')
+        self.assertEqual(status, 200)
+        self.assertIsNone(data['watcher'])
+        self.assertEqual(data['state_stores']['ticket']['size'], 1)
+        with patch('testenv.spmetadata.watcher', FakeWatcher()):
+            data = self._request('get', '/admin/metadata/stats')[1]
+        self.assertEqual(data['watcher'], FakeWatcher.stats)
+
+    def test_bad_request(self):
+        self.assertEqual(self._request('post', json={'metadata': 'not a list'})[0], 400)
+
+
+class AdminConfigTestCase(unittest.TestCase):
+
+    def _validate(self, **confdata):
+        confdata.update(key_file='conf/idp.key', cert_file='conf/idp.crt', base_url='https://idp.spid.test')
+        ConfigValidator(confdata).validate()
+
+    def test_single_worker(self):
+        self._validate(admin={'token': TOKEN}, server={'workers': 1})
+        self._validate(server={'workers': 4})
+
+    def test_multiple_workers(self):
+        with self.assertRaises(BadConfiguration):
+            self._validate(admin={'token': TOKEN}, server={'workers': 4})
@@ -3,11 +3,17 @@ from __future__ import unicode_literals
 
 import os
 import os.path
+import shutil
+import tempfile
 import unittest
 from base64 import b64decode
+from binascii import hexlify
 
 import pytest
 from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric.ec import ECDSA
+from cryptography.hazmat.primitives.asymmetric.utils import encode_dss_signature
 from cryptography.x509 import load_pem_x509_certificate
 from lxml import etree
 from signxml import XMLVerifier
@@ -15,14 +21,18 @@ from signxml.exceptions import InvalidInput
 from six.moves.urllib.parse import parse_qs
 
 from testenv.crypto import (
-    RSA_VERIFIERS, HTTPPostSignatureVerifier, HTTPRedirectSignatureVerifier, sign_http_post, sign_http_redirect,
+    RSA_VERIFIERS, HTTPPostSignatureVerifier, HTTPRedirectSignatureVerifier, KeyRing, check_signing_algorithm,
+    default_signing_algorithm, load_certificate, load_certificate_chain, load_private_key,
+    request_certificate_fingerprint, sign_http_post, sign_http_redirect, verify_http_redirect_signature,
 )
 from testenv.exceptions import SignatureVerificationError
 from testenv.parser import HTTPPostRequest, HTTPRedirectRequest
-from testenv.saml import create_response
-from testenv.settings import SIG_RSA_SHA256, SPID_LEVEL_1, STATUS_SUCCESS
+from testenv.saml import create_logout_response, create_response
+from testenv.settings import (
+    DIGEST_SHA256, DIGEST_SHA512, SIG_ECDSA_SHA256, SIG_RSA_SHA256, SIG_RSA_SHA512, SPID_LEVEL_1, STATUS_SUCCESS,
+)
 
-from .utils import generate_certificate
+from .utils import generate_certificate, generate_ecdsa_certificate
 
 try:
     from urllib import urlencode
@@ -59,6 +69,16 @@ SUPPORTED_SIG_ALG = [
 DATA_DIR = 'testenv/tests/data/'
 
 
+def _other_certificate():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        generate_certificate(fname='other', path=tmpdir)
+        with open(os.path.join(tmpdir, 'other.crt')) as fp:
+            return ''.join(fp.readlines()[1:-1])
+    finally:
+        shutil.rmtree(tmpdir)
+
+
 class HTTPRedirectSignatureVerifierTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -93,6 +113,12 @@ class HTTPRedirectSignatureVerifierTestCase(unittest.TestCase):
         verifier = HTTPRedirectSignatureVerifier(self.cert, request)
         self.assertIsNone(verifier.verify())
 
+    def test_valid_signature_with_parsed_certificate(self):
+        request = HTTPRedirectRequest(**self.request_data)
+        verifier = HTTPRedirectSignatureVerifier(
+            load_certificate(self.cert), request)
+        self.assertIsNone(verifier.verify())
+
     def test_deprecated_algorithm(self):
         self.request_data[
             'sig_alg'] = 'http://www.w3.org/2000/09/xmldsig#rsa-sha1'
@@ -130,6 +156,15 @@ class HTTPRedirectSignatureVerifierTestCase(unittest.TestCase):
         exc = excinfo.value
         self.assertEqual('Verifica della firma fallita.', exc.args[0])
 
+    def test_certificate_rotation(self):
+        request = HTTPRedirectRequest(**self.request_data)
+        current, following = load_certificate(self.cert), load_certificate(_other_certificate())
+        self.assertIs(verify_http_redirect_signature([following, current], request), current)
+        self.assertIs(verify_http_redirect_signature([current, following], request), current)
+        with pytest.raises(SignatureVerificationError) as excinfo:
+            verify_http_redirect_signature([following], request)
+        self.assertEqual('Verifica della firma fallita.', excinfo.value.args[0])
+
 
 class HTTPPostSignatureVerifierTestCase(unittest.TestCase):
 
@@ -202,6 +237,35 @@ class HTTPPostSignatureVerifierTestCase(unittest.TestCase):
         verifier = HTTPPostSignatureVerifier(self.cert, request)
         self.assertIsNone(verifier.verify())
 
+    def test_valid_signature_with_parsed_certificate(self):
+        saml_request = self.saml_request.format(
+            break_digest='',
+            signature_value=self.signature_value,
+            signed_info=self.signed_info.format(
+                sig_alg=self.sig_alg, break_signature=''),
+            certificate=self.cert,
+        )
+        request = HTTPPostRequest(
+            saml_request=saml_request, relay_state='relay_state')
+        verifier = HTTPPostSignatureVerifier(
+            load_certificate(self.cert), request)
+        self.assertIsNone(verifier.verify())
+
+    def test_request_certificate_fingerprint(self):
+        saml_request = self.saml_request.format(
+            break_digest='',
+            signature_value=self.signature_value,
+            signed_info=self.signed_info.format(
+                sig_alg=self.sig_alg, break_signature=''),
+            certificate=self.cert,
+        )
+        request = HTTPPostRequest(saml_request=saml_request, relay_state=None)
+        self.assertEqual(
+            request_certificate_fingerprint(request), load_certificate(self.cert).fingerprint)
+        request = HTTPPostRequest(
+            saml_request=saml_request.replace(self.cert, ''), relay_state=None)
+        self.assertIsNone(request_certificate_fingerprint(request))
+
     def test_deprecated_algorithm(self):
         sig_alg = 'http://www.w3.org/2000/09/xmldsig#rsa-sha1'
         saml_request = self.saml_request.format(
@@ -303,6 +367,28 @@ class HTTPPostSignatureVerifierTestCase(unittest.TestCase):
         self.assertEqual('Verifica della firma fallita.', exc.args[0])
 
 
+class KeyRingTestCase(unittest.TestCase):
+
+    def test_certificate_is_parsed_once(self):
+        certificate = load_certificate(CERTIFICATE)
+        self.assertEqual(certificate.text, CERTIFICATE)
+        self.assertEqual(certificate.normalized, ''.join(CERTIFICATE.split()))
+        self.assertEqual(len(certificate.fingerprint), 32)
+        keyring = KeyRing()
+        keyring.set('https://sp.example.org', [certificate])
+        self.assertIn('https://sp.example.org', keyring)
+        self.assertIs(keyring.get('https://sp.example.org')[0], certificate)
+        self.assertIs(keyring.find('https://sp.example.org', certificate.fingerprint), certificate)
+        self.assertIsNone(keyring.find('https://sp.example.org', b'unknown'))
+        keyring.remove('https://sp.example.org')
+        with pytest.raises(KeyError):
+            keyring.get('https://sp.example.org')
+
+    def test_invalid_certificate(self):
+        with pytest.raises(ValueError):
+            load_certificate('XXX_not_a_certificate_XXX')
+
+
 class SignedResponseTestCase(unittest.TestCase):
 
     def setUp(cls):
@@ -428,6 +514,138 @@ class SignedResponseTestCase(unittest.TestCase):
             self.assertEqual(len(signature_values), 2)
             self.assertEqual(len(digest_values), 2)
             XMLVerifier().verify(tree, x509_cert=cert)
+            # The element tree is signed without a serialization round trip
+            self.assertEqual(
+                sign_http_post(etree.fromstring(response_xmlstr), pkey, cert, message=True, assertion=True),
+                response)
+
+    def test_sign_with_loaded_key(self):
+        response_xmlstr = create_response(
+            {
+                'response': {
+                    'attrs': {
+                        'in_response_to': 'test_12345',
+                        'destination': 'http://post'
+                    }
+                },
+                'issuer': {
+                    'attrs': {
+                        'name_qualifier': 'http://test_id.entity',
+                    },
+                    'text': 'http://test_id.entity'
+                },
+                'name_id': {
+                    'attrs': {
+                        'name_qualifier': 'http://test_id.entity',
+                    }
+                },
+                'subject_confirmation_data': {
+                    'attrs': {
+                        'recipient': 'http://test_id.entity',
+                    }
+                },
+                'audience': {
+                    'text': 'http://test_sp_id.entity',
+                },
+                'authn_context_class_ref': {
+                    'text': SPID_LEVEL_1
+                }
+            },
+            {
+                'status_code': STATUS_SUCCESS
+            },
+            {}
+        ).to_xml()
+        with open(os.path.join(DATA_DIR, 'test.key'), 'rb') as fp:
+            pkey = fp.read()
+        with open(os.path.join(DATA_DIR, 'test.crt'), 'rb') as fp:
+            cert = fp.read()
+        key = load_private_key(pkey)
+        cert_chain = load_certificate_chain(cert)
+        self.assertEqual(len(cert_chain), 1)
+        response = sign_http_post(
+            response_xmlstr, key, cert_chain, message=True, assertion=True)
+        self.assertEqual(
+            response,
+            sign_http_post(response_xmlstr, pkey, cert, message=True, assertion=True)
+        )
+        tree = etree.fromstring(b64decode(response))
+        XMLVerifier().verify(tree, x509_cert=cert)
+        self.assertEqual(
+            sign_http_redirect(response_xmlstr, key, relay_state='relay_state'),
+            sign_http_redirect(response_xmlstr, pkey, relay_state='relay_state')
+        )
+
+    def test_fast_signing_engine(self):
+        response = create_response(
+            {
+                'response': {
+                    'attrs': {
+                        'in_response_to': 'test_12345',
+                        'destination': 'http://post'
+                    }
+                },
+                'issuer': {
+                    'attrs': {
+                        'name_qualifier': 'http://test_id.entity',
+                    },
+                    'text': 'http://test_id.entity'
+                },
+                'name_id': {
+                    'attrs': {
+                        'name_qualifier': 'http://test_id.entity',
+                    }
+                },
+                'subject_confirmation_data': {
+                    'attrs': {
+                        'recipient': 'http://test_id.entity',
+                    }
+                },
+                'audience': {
+                    'text': 'http://test_sp_id.entity',
+                },
+                'authn_context_class_ref': {
+                    'text': SPID_LEVEL_1
+                }
+            },
+            {
+                'status_code': STATUS_SUCCESS
+            },
+            {
+                'name': ('string', 'Nicolò <"&">'),
+                'familyName': ('string', 'D\'Angelo\r\n'),
+            }
+        )
+        with open(os.path.join(DATA_DIR, 'test.key'), 'rb') as fp:
+            pkey = fp.read()
+        with open(os.path.join(DATA_DIR, 'test.crt'), 'rb') as fp:
+            cert = fp.read()
+        key = load_private_key(pkey)
+        cert_chain = load_certificate_chain(cert)
+        for message, assertion in ((False, True), (True, False), (True, True)):
+            expected = sign_http_post(
+                response.to_xml(), key, cert_chain, message=message, assertion=assertion)
+            signed = sign_http_post(
+                response.to_xml(), key, cert_chain, message=message, assertion=assertion, engine='fast')
+            # RSA PKCS#1 v1.5 signatures are deterministic: the same document
+            self.assertEqual(signed, expected)
+            tree = etree.fromstring(b64decode(signed))
+            signatures = list(tree.iter('{http://www.w3.org/2000/09/xmldsig#}Signature'))
+            self.assertEqual(len(signatures), int(message) + int(assertion))
+            for signature in signatures:
+                # XMLVerifier checks the first Signature of the document: put
+                # the one of the element being verified first, which leaves
+                # its digest unchanged as the enveloped signature is removed
+                signed_element = signature.getparent()
+                document = etree.fromstring(etree.tostring(signed_element))
+                document.insert(0, document.find('{http://www.w3.org/2000/09/xmldsig#}Signature'))
+                verified = XMLVerifier().verify(document, x509_cert=cert)
+                self.assertEqual(verified.signed_xml.get('ID'), signed_element.get('ID'))
+        # the element tree is signed in place
+        tree = response.tree
+        signed = sign_http_post(tree, pkey, cert, engine='fast')
+        self.assertEqual(b64decode(signed), etree.tostring(tree))
+        XMLVerifier().verify(tree, x509_cert=cert)
 
     def test_sign_http_redirect(self):
         # https://github.com/italia/spid-testenv2/issues/175
@@ -595,3 +813,91 @@ class SignedResponseTestCase(unittest.TestCase):
                 bytes(signature)
             )
             self.assertTrue(verified)
+
+
+class SigningAlgorithmsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        generate_certificate(fname='rsa', path=self.tmpdir)
+        generate_ecdsa_certificate(fname='ecdsa', path=self.tmpdir)
+        self.response = create_logout_response(
+            {
+                'logout_response': {
+                    'attrs': {
+                        'in_response_to': 'test_12345',
+                        'destination': 'http://slo'
+                    }
+                },
+                'issuer': {
+                    'attrs': {
+                        'name_qualifier': 'http://test_id.entity',
+                    },
+                    'text': 'http://test_id.entity'
+                },
+            },
+            {
+                'status_code': STATUS_SUCCESS
+            }
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _credentials(self, name):
+        with open(os.path.join(self.tmpdir, '{}.key'.format(name)), 'rb') as fp:
+            key = fp.read()
+        with open(os.path.join(self.tmpdir, '{}.crt'.format(name)), 'rb') as fp:
+            cert = fp.read()
+        return key, cert
+
+    def _verify_http_post(self, response, cert, algorithm, digest_algorithm):
+        tree = etree.fromstring(b64decode(response))
+        XMLVerifier().verify(tree, x509_cert=cert)
+        signed_info = tree.find('{http://www.w3.org/2000/09/xmldsig#}Signature')[0]
+        self.assertEqual(signed_info[1].get('Algorithm'), algorithm)
+        self.assertEqual(signed_info[2][1].get('Algorithm'), digest_algorithm)
+
+    def test_rsa(self):
+        key, cert = self._credentials('rsa')
+        for algorithm, digest_algorithm in ((SIG_RSA_SHA256, DIGEST_SHA512), (SIG_RSA_SHA512, DIGEST_SHA256)):
+            signed = [
+                sign_http_post(
+                    self.response.to_xml(), key, cert, message=True, assertion=False, engine=engine,
+                    algorithm=algorithm, digest_algorithm=digest_algorithm)
+                for engine in ('signxml', 'fast')
+            ]
+            self.assertEqual(signed[0], signed[1])
+            self._verify_http_post(signed[0], cert, algorithm, digest_algorithm)
+
+    def test_ecdsa(self):
+        key, cert = self._credentials('ecdsa')
+        for engine in ('signxml', 'fast'):
+            response = sign_http_post(
+                self.response.to_xml(), key, cert, message=True, assertion=False, engine=engine,
+                algorithm=SIG_ECDSA_SHA256)
+            self._verify_http_post(response, cert, SIG_ECDSA_SHA256, DIGEST_SHA256)
+        query = parse_qs(sign_http_redirect(self.response.to_xml(), key, algorithm=SIG_ECDSA_SHA256))
+        self.assertEqual(query['SigAlg'], [SIG_ECDSA_SHA256])
+        signed_data = urlencode([
+            ('SAMLResponse', query['SAMLResponse'][0]),
+            ('SigAlg', query['SigAlg'][0]),
+        ]).encode('ascii')
+        # r and s, 32 bytes each for P-256
+        signature = b64decode(query['Signature'][0])
+        self.assertEqual(len(signature), 64)
+        public_key = load_pem_x509_certificate(cert, backend=default_backend()).public_key()
+        public_key.verify(
+            encode_dss_signature(int(hexlify(signature[:32]), 16), int(hexlify(signature[32:]), 16)),
+            signed_data, ECDSA(hashes.SHA256()))
+
+    def test_check_signing_algorithm(self):
+        rsa_key, _ = self._credentials('rsa')
+        ecdsa_key, _ = self._credentials('ecdsa')
+        check_signing_algorithm(rsa_key, SIG_RSA_SHA512)
+        check_signing_algorithm(ecdsa_key, SIG_ECDSA_SHA256)
+        for key, algorithm in ((rsa_key, SIG_ECDSA_SHA256), (ecdsa_key, SIG_RSA_SHA256), (rsa_key, 'unknown')):
+            with pytest.raises(ValueError):
+                check_signing_algorithm(key, algorithm)
+        self.assertEqual(default_signing_algorithm(rsa_key), SIG_RSA_SHA256)
+        self.assertEqual(default_signing_algorithm(ecdsa_key), SIG_ECDSA_SHA256)
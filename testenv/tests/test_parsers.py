@@ -2,18 +2,22 @@
 from __future__ import unicode_literals
 
 import base64
+import pickle
 import unittest
 import zlib
 from copy import copy
 
 import pytest
-from lxml import objectify
+from lxml import etree, objectify
 
 from testenv.exceptions import (
     DeserializationError, RequestParserError, SPIDValidationError, XMLFormatValidationError, XMLSchemaValidationError,
 )
-from testenv.parser import HTTPPostRequestParser, HTTPRedirectRequestParser, HTTPRequestDeserializer, SAMLTree
+from testenv.parser import (
+    HTTPPostRequest, HTTPPostRequestParser, HTTPRedirectRequestParser, HTTPRequestDeserializer, SAMLTree,
+)
 from testenv.tests.utils import FakeRequest
+from testenv.utils import SAMLRequestContext, saml_to_dict
 from testenv.validators import ValidatorGroup
 
 try:
@@ -159,6 +163,17 @@ class HTTPRequestDeserializerTestCase(unittest.TestCase):
         deserialized = deserializer.deserialize()
         self.assertIsInstance(deserialized, FakeSAMLClass)
 
+    def test_request_context_is_parsed_once(self):
+        xml = '<xml>\n    <child/>\n</xml>'
+        validator = ValidatorGroup([SuccessValidator()])
+        request = HTTPPostRequest(xml, None, None, SAMLRequestContext(xml))
+        deserializer = HTTPRequestDeserializer(
+            request, validator=validator, saml_class=FakeSAMLClass)
+        deserialized = deserializer.deserialize()
+        self.assertIs(deserialized.data, request.context.xml_doc)
+        self.assertEqual(
+            saml_to_dict(request.context.xml_doc), saml_to_dict(xml))
+
     def test_blocking_validation_failure(self):
         xml = '<xml></xml>'
         blocking_validator = FailValidator(
@@ -221,3 +236,11 @@ class SAMLTreeTestCase(unittest.TestCase):
                          0].another_attribute, 'foo')
         self.assertEqual(saml_tree.special_child3.item[
                          1].even_another_attribute, 'bar')
+
+    def test_pickle(self):
+        xml = '<root xmlns="urn:test"><child1 AnAttribute="some data"/></root>'
+        saml_tree = SAMLTree(etree.fromstring(xml))
+        unpickled = pickle.loads(pickle.dumps(saml_tree))
+        self.assertEqual(unpickled.child1.an_attribute, 'some data')
+        self.assertEqual(
+            etree.tostring(unpickled._xml_doc), etree.tostring(saml_tree._xml_doc))
@@ -2,8 +2,10 @@
 from __future__ import unicode_literals
 
 import unittest
+from collections import OrderedDict
+from uuid import uuid4
 
-from testenv.saml import create_idp_metadata, create_response
+from testenv.saml import FIELD_MARKER, FIELD_TOKEN, ResponseFactory, create_idp_metadata, create_response
 from testenv.settings import (
     BINDING_HTTP_POST, BINDING_HTTP_REDIRECT, DS, MD, SAML, SAMLP, SPID_LEVEL_1, STATUS_SUCCESS,
 )
@@ -11,6 +13,11 @@ from testenv.utils import Key, Slo, Sso
 
 from .utils import validate_xml
 
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
 
 class SamlElementTestCase(unittest.TestCase):
 
@@ -176,3 +183,90 @@ class SamlElementTestCase(unittest.TestCase):
         self.assertEqual(len(slos), 1)
         self.assertEqual(slos[0].attrib['Binding'], BINDING_HTTP_REDIRECT)
         self.assertEqual(slos[0].attrib['Location'], 'http://slo.slo')
+
+
+class ResponseFactoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.data = {
+            'response': {
+                'attrs': {
+                    'in_response_to': 'test_12345',
+                    'destination': 'http://some.dest.nation'
+                }
+            },
+            'issuer': {
+                'attrs': {
+                    'name_qualifier': 'http://test_id.entity',
+                },
+                'text': 'http://test_id.entity'
+            },
+            'name_id': {
+                'attrs': {
+                    'name_qualifier': 'http://test_id.entity',
+                }
+            },
+            'subject_confirmation_data': {
+                'attrs': {
+                    'recipient': 'http://test_id.entity',
+                }
+            },
+            'audience': {
+                'text': 'http://sp.entity?a=1&b="2"'
+            },
+            'authn_context_class_ref': {
+                'text': SPID_LEVEL_1
+            }
+        }
+        self.attributes = OrderedDict([
+            ('name', ('string', 'Niccolò <&>\r\n"\'\t€')),
+            ('familyName', ('string', '')),
+            ('fiscalNumber', ('string', None)),
+            ('dateOfBirth', ('date', '2000-01-01')),
+        ])
+
+    def _patched_create(self, create):
+        issue_instants = [('2018-07-16T09:38:29Z', '2018-07-16T09:36:29Z', '2018-07-16T09:40:29Z')]
+        unique_ids = ['id_response', 'id_assertion', 'id_name_id', 'id_session_index']
+        with patch('testenv.saml.generate_issue_instant', side_effect=issue_instants), \
+                patch('testenv.saml.generate_unique_id', side_effect=unique_ids):
+            return create()
+
+    def test_same_output_as_create_response(self):
+        factory = ResponseFactory()
+        for attributes in (self.attributes, {}):
+            expected = self._patched_create(
+                lambda: create_response(self.data, {'status_code': STATUS_SUCCESS}, attributes).to_xml())
+            for _ in range(2):
+                self.assertEqual(
+                    self._patched_create(
+                        lambda: factory.create_response(self.data, {'status_code': STATUS_SUCCESS}, attributes)),
+                    expected)
+
+    def test_static_values_like_fields(self):
+        # values in the format of the field markers, with another token
+        marker = FIELD_MARKER.replace(FIELD_TOKEN, uuid4().hex)
+        factory = ResponseFactory()
+        self.data['response']['attrs']['destination'] = 'http://sp.entity/' + marker.format('audience')
+        self.data['issuer']['text'] = marker.format('name_id')
+        attributes = OrderedDict([(marker.format('attribute_0'), ('string', 'value'))])
+        expected = self._patched_create(
+            lambda: create_response(self.data, {'status_code': STATUS_SUCCESS}, attributes).to_xml())
+        response = self._patched_create(
+            lambda: factory.create_response(self.data, {'status_code': STATUS_SUCCESS}, attributes))
+        self.assertEqual(response, expected)
+        self.assertIn(marker.format('name_id').encode('ascii'), response)
+
+    def test_skeleton_reuse(self):
+        factory = ResponseFactory(max_size=1)
+        status = {'status_code': STATUS_SUCCESS}
+        factory.create_response(self.data, status, self.attributes)
+        self.data['response']['attrs']['in_response_to'] = 'test_67890'
+        self.data['audience']['text'] = 'http://other.sp.entity'
+        response = factory.create_response(self.data, status, self.attributes)
+        self.assertEqual(len(factory._skeletons), 1)
+        self.assertIn(b'InResponseTo="test_67890"', response)
+        self.assertIn(b'<saml:Audience>http://other.sp.entity</saml:Audience>', response)
+        self.data['response']['attrs']['destination'] = 'http://other.dest.nation'
+        factory.create_response(self.data, status, self.attributes)
+        self.assertEqual(len(factory._skeletons), 1)
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os.path
+import shutil
+import tempfile
+import time
+import unittest
+from base64 import b64decode
+
+from lxml import etree
+from signxml import XMLVerifier
+
+from testenv.crypto import load_certificate_chain, load_private_key
+from testenv.exceptions import SigningError
+from testenv.saml import create_logout_response
+from testenv.settings import DIGEST_SHA256, DIGEST_SHA512, SIG_RSA_SHA256, SIG_RSA_SHA512, STATUS_SUCCESS
+from testenv.signing import InlineSigningService, PoolSigningService, SigningAlgorithms, create_signing_service
+
+from .test_storage import FakeClock
+from .utils import generate_certificate
+
+LOGOUT_RESPONSE = {
+    'logout_response': {
+        'attrs': {
+            'in_response_to': 'test_12345',
+            'destination': 'http://slo',
+        }
+    },
+    'issuer': {
+        'attrs': {
+            'name_qualifier': 'http://test_id.entity',
+        },
+        'text': 'http://test_id.entity',
+    },
+}
+
+
+class SigningServiceTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            generate_certificate(fname='test', path=tmpdir)
+            with open(os.path.join(tmpdir, 'test.key'), 'rb') as fp:
+                cls.key = fp.read()
+            with open(os.path.join(tmpdir, 'test.crt'), 'rb') as fp:
+                cls.cert = fp.read()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def setUp(self):
+        self.inline = InlineSigningService(self.key, self.cert)
+        self.pool = PoolSigningService(self.key, self.cert, workers=1, queue_size=2)
+        self.response = create_logout_response(LOGOUT_RESPONSE, {'status_code': STATUS_SUCCESS})
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_same_signature(self):
+        signed = self.pool.sign_http_post(self.response.tree, message=True, assertion=False)
+        XMLVerifier().verify(etree.fromstring(b64decode(signed)), x509_cert=self.cert)
+        self.assertEqual(
+            signed, self.inline.sign_http_post(self.response.tree, message=True, assertion=False))
+        xml = self.response.to_xml()
+        self.assertEqual(
+            self.pool.sign_http_redirect(xml, 'relay_state'),
+            self.inline.sign_http_redirect(xml, 'relay_state'))
+        # the algorithms are chosen by the caller, not by the signing process
+        self.pool._algorithms = self.inline._algorithms = SigningAlgorithms(SIG_RSA_SHA512)
+        self.assertEqual(
+            self.pool.sign_http_redirect(xml, 'relay_state'),
+            self.inline.sign_http_redirect(xml, 'relay_state'))
+        stats = self.pool.stats
+        self.assertEqual(stats['completed'], 3)
+        self.assertEqual(stats['pending'], 0)
+        self.assertEqual(stats['max_pending'], 1)
+        self.assertIsNotNone(stats['max_latency'])
+
+    def test_full_queue(self):
+        self.pool._slots.acquire()
+        self.pool._slots.acquire()
+        with self.assertRaises(SigningError):
+            self.pool.sign_http_post(self.response.to_xml(), message=True)
+        self.assertEqual(self.pool.stats['rejected'], 1)
+
+    def test_timeout_keeps_slot_until_done(self):
+        pool = PoolSigningService(self.key, self.cert, workers=1, queue_size=1, timeout=0.2)
+        try:
+            with self.assertRaises(SigningError):
+                pool._run(time.sleep, (0.5,))
+            self.assertEqual(pool.stats['timeouts'], 1)
+            self.assertEqual(pool.stats['pending'], 1)
+            # the abandoned job still counts against the queue size
+            with self.assertRaises(SigningError):
+                pool.sign_http_post(self.response.to_xml(), message=True)
+            self.assertEqual(pool.stats['rejected'], 1)
+            time.sleep(0.5)
+            self.assertEqual(pool.stats['completed'], 1)
+            self.assertEqual(pool.stats['pending'], 0)
+            pool.sign_http_post(self.response.to_xml(), message=True)
+            self.assertEqual(pool.stats['recycled'], 0)
+        finally:
+            pool.close()
+
+    def test_lost_job_recycles_pool(self):
+        clock = FakeClock()
+        pool = PoolSigningService(self.key, self.cert, workers=1, queue_size=1, timeout=1, clock=clock)
+        try:
+            # the signing process dies, its job never completes
+            with self.assertRaises(SigningError):
+                pool._run(os._exit, (1,))
+            self.assertEqual(pool.stats['pending'], 1)
+            self.assertEqual(pool.stats['recycled'], 0)
+            clock.now += 3.5
+            signed = pool.sign_http_post(self.response.to_xml(), message=True)
+            XMLVerifier().verify(etree.fromstring(b64decode(signed)), x509_cert=self.cert)
+            stats = pool.stats
+            self.assertEqual(stats['recycled'], 1)
+            self.assertEqual(stats['pending'], 0)
+            self.assertEqual(stats['completed'], 1)
+        finally:
+            pool.close()
+
+    def test_failure(self):
+        with self.assertRaises(SigningError):
+            self.pool.sign_http_post(b'<not xml', message=True)
+        stats = self.pool.stats
+        self.assertEqual(stats['failures'], 1)
+        self.assertEqual(stats['pending'], 0)
+        # the pool keeps working after a failed job
+        self.pool.sign_http_post(self.response.to_xml(), message=True)
+
+    def test_create_signing_service(self):
+        self.assertIsInstance(
+            create_signing_service(self.key, self.cert, {'workers': 0}), InlineSigningService)
+        # the parsed key is used as it is
+        private_key = load_private_key(self.key)
+        service = create_signing_service(self.key, self.cert, {}, private_key, load_certificate_chain(self.cert))
+        self.assertIs(service._key, private_key)
+        service = create_signing_service(
+            self.key, self.cert, {'engine': 'fast', 'workers': 2, 'timeout': 0})
+        self.assertIsInstance(service, PoolSigningService)
+        self.assertEqual(service.stats['workers'], 2)
+
+
+class SigningAlgorithmsTestCase(unittest.TestCase):
+
+    def test_overrides(self):
+        algorithms = SigningAlgorithms.from_config({
+            'algorithm': SIG_RSA_SHA256,
+            'service_providers': {
+                'https://sp.example.org': {'algorithm': SIG_RSA_SHA512},
+                'https://other.example.org': {'digest_algorithm': DIGEST_SHA512},
+            },
+        })
+        self.assertEqual(algorithms.get(), (SIG_RSA_SHA256, DIGEST_SHA256))
+        self.assertEqual(algorithms.get('https://unknown.example.org'), (SIG_RSA_SHA256, DIGEST_SHA256))
+        self.assertEqual(algorithms.get('https://sp.example.org'), (SIG_RSA_SHA512, DIGEST_SHA256))
+        self.assertEqual(algorithms.get('https://other.example.org'), (SIG_RSA_SHA256, DIGEST_SHA512))
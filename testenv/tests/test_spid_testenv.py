@@ -18,6 +18,7 @@ from six.moves.urllib.parse import parse_qs, quote, urlparse
 from testenv import config, spmetadata
 from testenv.crypto import decode_base64_and_inflate, deflate_and_base64_encode, sign_http_redirect
 from testenv.parser import SAMLTree
+from testenv.server import IdpServer
 from testenv.settings import (
     BINDING_HTTP_POST, BINDING_HTTP_REDIRECT, NAMEID_FORMAT_ENTITY, NAMEID_FORMAT_TRANSIENT, SIG_RSA_SHA1,
     SIG_RSA_SHA256,
@@ -222,12 +223,13 @@ class SpidTestenvTest(unittest.TestCase):
         app = flask.Flask(spid_testenv.__name__, static_url_path='/static')
         config.load('testenv/tests/data/config.yaml')
         spmetadata.build_metadata_registry()
-        cls.idp_server = spid_testenv.IdpServer(app=app)
+        cls.idp_server = IdpServer(app=app)
         cls.idp_server.app.testing = True
         cls.test_client = cls.idp_server.app.test_client()
 
     @classmethod
     def tearDownClass(cls):
+        cls.idp_server.close()
         to_remove = ['users.json', 'idp.crt', 'idp.key',
                      'sp.crt', 'sp.key', 'sp-metadata.xml']
         for f in to_remove:
@@ -241,6 +243,17 @@ class SpidTestenvTest(unittest.TestCase):
         self.idp_server.responses = {}
         self.idp_server.challenges = {}
 
+    def test_close(self):
+        server = IdpServer(app=flask.Flask('close'))
+        sweeper = server._sweeper
+        self.assertTrue(sweeper.is_alive())
+        server.close()
+        sweeper.join(5)
+        self.assertFalse(sweeper.is_alive())
+        self.assertIsNone(server._sweeper)
+        # left to the forked workers
+        self.assertIsNone(IdpServer(app=flask.Flask('workers'), start_threads=False)._sweeper)
+
     def test_permissions(self):
         response = self.test_client.get('/login')
         self.assertEqual(response.status_code, 403)
@@ -0,0 +1,629 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from testenv.crypto import load_certificate
+from testenv.exceptions import MetadataLoadError, MetadataNotFoundError
+from testenv.settings import BINDING_HTTP_POST, BINDING_HTTP_REDIRECT
+from testenv.spmetadata import (
+    LazyServiceProviderMetadataRegistry, MetadataCache, MetadataFileWatcher, MetadataRefresher,
+    ServiceProviderMetadata, ServiceProviderMetadataHTTPLoader, ServiceProviderMetadataRegistry, _get_loader,
+    _populate_registry, iter_entity_descriptors, load_entities_descriptor,
+)
+from testenv.tests.test_crypto import CERTIFICATE
+from testenv.tests.test_storage import FakeClock
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+DATA_DIR = 'testenv/tests/data/'
+
+
+def _read_example_metadata():
+    with open(os.path.join(DATA_DIR, 'sp-metadata.xml.example'), 'rb') as fp:
+        return fp.read()
+
+
+class FakeLoader(object):
+
+    refreshable = False
+
+    def __init__(self, metadata):
+        self.metadata = metadata
+        self.calls = 0
+
+    def load(self):
+        self.calls += 1
+        if isinstance(self.metadata, Exception):
+            raise self.metadata
+        return self.metadata
+
+
+class ServiceProviderMetadataTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.xml = _read_example_metadata()
+        self.loader = FakeLoader(self.xml)
+
+    def test_accessors_do_not_reload(self):
+        metadata = ServiceProviderMetadata(self.loader).load()
+        self.assertEqual(metadata.entity_id, 'https://spid.test:8000')
+        metadata.certs()
+        metadata.assertion_consumer_services
+        metadata.attributes('1')
+        metadata.single_logout_services
+        self.assertEqual(self.loader.calls, 1)
+
+    def test_lookups(self):
+        metadata = ServiceProviderMetadata(self.loader).load()
+        acs = metadata.assertion_consumer_service(index='0')
+        self.assertEqual(acs[0].location, 'http://127.0.0.1:8000/acs-test')
+        self.assertEqual(metadata.assertion_consumer_service(binding=BINDING_HTTP_POST), acs)
+        self.assertEqual(metadata.assertion_consumer_service(binding=BINDING_HTTP_POST, index='0'), acs)
+        self.assertEqual(metadata.assertion_consumer_service(index='9'), ())
+        self.assertEqual(metadata.assertion_consumer_service_indexes, ('0',))
+        self.assertEqual(metadata.assertion_consumer_service_urls, ('http://127.0.0.1:8000/acs-test',))
+        self.assertEqual(metadata.attribute_consuming_service_indexes, ('1',))
+        self.assertEqual(len(metadata.attributes('1')['optional']), 17)
+        self.assertEqual(metadata.attributes('2'), {'required': (), 'optional': ()})
+        self.assertEqual(
+            metadata.single_logout_service(BINDING_HTTP_REDIRECT)[0].location,
+            'http://127.0.0.1:8000/slo-test')
+        with self.assertRaises(AttributeError):
+            acs[0].location = 'http://attacker.test'
+
+    def test_lazy_load_on_first_access(self):
+        metadata = ServiceProviderMetadata(self.loader)
+        self.assertFalse(metadata.is_loaded)
+        self.assertEqual(metadata.entity_id, 'https://spid.test:8000')
+        self.assertTrue(metadata.is_loaded)
+        self.assertEqual(self.loader.calls, 1)
+
+    def test_reload(self):
+        metadata = ServiceProviderMetadata(self.loader).load()
+        self.loader.metadata = self.xml.replace(
+            b'https://spid.test:8000', b'https://other.spid.test')
+        metadata.reload()
+        self.assertEqual(self.loader.calls, 2)
+        self.assertEqual(metadata.entity_id, 'https://other.spid.test')
+
+
+class ServiceProviderMetadataRegistryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.xml = _read_example_metadata()
+        self.loader = FakeLoader(self.xml)
+        self.registry = ServiceProviderMetadataRegistry()
+
+    def test_register_loads_once(self):
+        self.registry.register(ServiceProviderMetadata(self.loader))
+        self.assertEqual(self.registry.service_providers, ['https://spid.test:8000'])
+        self.registry.get('https://spid.test:8000').certs()
+        self.assertEqual(self.loader.calls, 1)
+
+    def test_register_parses_certificates(self):
+        self.loader.metadata = self.xml.replace(
+            b'<ds:X509Certificate></ds:X509Certificate>',
+            '<ds:X509Certificate>{}</ds:X509Certificate>'.format(CERTIFICATE).encode('ascii'))
+        self.registry.register(ServiceProviderMetadata(self.loader))
+        metadata = self.registry.get('https://spid.test:8000')
+        certificates = self.registry.keyring.get('https://spid.test:8000')
+        self.assertEqual(
+            [certificate.normalized for certificate in certificates],
+            metadata.certs())
+        self.assertEqual(len(certificates), 1)
+
+    def test_register_failure(self):
+        self.loader.metadata = MetadataLoadError('boom')
+        self.registry.register(ServiceProviderMetadata(self.loader))
+        self.assertEqual(self.registry.service_providers, [])
+
+    def test_add(self):
+        first = ServiceProviderMetadata(self.loader)
+        self.assertEqual(self.registry.add(first, replace=False), 'created')
+        second = ServiceProviderMetadata(FakeLoader(self.xml))
+        self.assertEqual(self.registry.add(second, replace=False), 'exists')
+        self.assertIs(self.registry.get('https://spid.test:8000'), first)
+        self.assertEqual(self.registry.add(second), 'replaced')
+        self.assertIs(self.registry.get('https://spid.test:8000'), second)
+        self.loader.metadata = MetadataLoadError('boom')
+        self.assertIsNone(self.registry.add(ServiceProviderMetadata(self.loader)))
+
+    def test_failed_reload_keeps_previous_version(self):
+        self.registry.register(ServiceProviderMetadata(self.loader))
+        self.loader.metadata = MetadataLoadError('boom')
+        self.registry.reload('https://spid.test:8000')
+        metadata = self.registry.get('https://spid.test:8000')
+        self.assertEqual(metadata.entity_id, 'https://spid.test:8000')
+
+    def test_unregistered_while_reloading(self):
+        self.registry.register(ServiceProviderMetadata(self.loader))
+
+        def unregister():
+            self.registry.unregister('https://spid.test:8000')
+            return self.xml
+        self.loader.load = unregister
+        self.assertTrue(self.registry.reload('https://spid.test:8000'))
+        self.assertFalse(self.registry.is_registered('https://spid.test:8000'))
+
+    def test_reload_with_new_entity_id(self):
+        self.registry.register(ServiceProviderMetadata(self.loader))
+        self.loader.metadata = self.xml.replace(
+            b'https://spid.test:8000', b'https://other.spid.test')
+        self.registry.reload()
+        self.assertEqual(self.registry.service_providers, ['https://other.spid.test'])
+
+    def test_reload_updates_keyring(self):
+        self.registry.register(ServiceProviderMetadata(self.loader))
+        self.loader.metadata = self.xml.replace(
+            b'https://spid.test:8000', b'https://other.spid.test')
+        self.registry.reload()
+        self.assertNotIn('https://spid.test:8000', self.registry.keyring)
+        self.assertEqual(self.registry.keyring.get('https://other.spid.test'), [])
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code, content=b'', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception('HTTP {}'.format(self.status_code))
+
+
+class FakeSession(object):
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def get(self, url, headers=None, timeout=None):
+        self.requests.append((url, headers, timeout))
+        return self.responses.pop(0)
+
+
+class CountingValidator(object):
+
+    def __init__(self):
+        self.calls = 0
+
+    def validate(self, metadata):
+        self.calls += 1
+
+
+class ServiceProviderMetadataHTTPLoaderTestCase(unittest.TestCase):
+
+    def test_conditional_request(self):
+        xml = _read_example_metadata()
+        session = FakeSession([
+            FakeResponse(200, xml, {'ETag': '"v1"', 'Last-Modified': 'Mon, 01 Oct 2018 10:00:00 GMT'}),
+            FakeResponse(304),
+        ])
+        validator = CountingValidator()
+        loader = ServiceProviderMetadataHTTPLoader(
+            {'url': 'http://spid-sp/metadata'}, validator, session=session, timeout=3)
+        self.assertIs(loader.load(), xml)
+        self.assertIs(loader.load(), xml)
+        self.assertEqual(validator.calls, 1)
+        self.assertEqual(session.requests[0], ('http://spid-sp/metadata', {}, 3))
+        self.assertEqual(session.requests[1][1], {
+            'If-None-Match': '"v1"',
+            'If-Modified-Since': 'Mon, 01 Oct 2018 10:00:00 GMT',
+        })
+
+    def test_failure(self):
+        session = FakeSession([FakeResponse(500)])
+        loader = ServiceProviderMetadataHTTPLoader(
+            {'url': 'http://spid-sp/metadata'}, CountingValidator(), session=session)
+        with self.assertRaises(MetadataLoadError):
+            loader.load()
+
+
+class RemoteFakeLoader(FakeLoader):
+
+    refreshable = True
+
+
+class MetadataRefresherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.xml = _read_example_metadata()
+        self.clock = FakeClock()
+        self.loader = RemoteFakeLoader(self.xml)
+        self.registry = ServiceProviderMetadataRegistry()
+        self.registry.register(ServiceProviderMetadata(self.loader, clock=self.clock))
+        self.refresher = MetadataRefresher(
+            self.registry, interval=100, retry_interval=10, max_backoff=25, clock=self.clock)
+
+    def _tick(self, seconds):
+        self.clock.now += seconds
+        self.refresher.refresh_due()
+
+    def test_ignores_local_metadata(self):
+        self.registry = ServiceProviderMetadataRegistry()
+        self.registry.register(ServiceProviderMetadata(FakeLoader(self.xml)))
+        refresher = MetadataRefresher(self.registry, clock=self.clock)
+        self.assertEqual(refresher._schedule(), {})
+
+    def test_refresh_interval(self):
+        self.assertEqual(self.refresher._wait_time(), 100)
+        self._tick(99)
+        self.assertEqual(self.loader.calls, 1)
+        self._tick(1)
+        self.assertEqual(self.loader.calls, 2)
+
+    def test_errors_do_not_stop_refreshing(self):
+        self.assertEqual(self.refresher._wait_time(), 100)
+        with patch.object(self.registry, 'reload', side_effect=MetadataNotFoundError('https://spid.test:8000')):
+            self._tick(100)
+        self.assertEqual(self.refresher._wait_time(), 10)
+        self._tick(10)
+        self.assertEqual(self.loader.calls, 2)
+        self.registry.unregister('https://spid.test:8000')
+        self.assertEqual(self.refresher._next_interval('https://spid.test:8000'), 100)
+
+    def test_backoff_keeps_last_good_copy(self):
+        self.loader.metadata = MetadataLoadError('boom')
+        waits = []
+        for _ in range(4):
+            self._tick(self.refresher._wait_time())
+            waits.append(self.refresher._wait_time())
+        self.assertEqual(waits, [10, 20, 25, 25])
+        self.assertEqual(
+            self.registry.get('https://spid.test:8000').entity_id, 'https://spid.test:8000')
+        self.loader.metadata = self.xml
+        self._tick(25)
+        self.assertEqual(self.refresher._wait_time(), 100)
+
+    def test_cache_duration(self):
+        self.loader.metadata = self.xml.replace(
+            b'ID="_0480324032lsdjs98"', b'ID="_0480324032lsdjs98" cacheDuration="PT30S"')
+        self.registry.reload()
+        self.assertEqual(self.refresher._wait_time(), 30)
+
+
+class FakeConfig(object):
+
+    def __init__(self, local, pool, aggregate=(), cache_dir=None):
+        self.metadata = {'local': local, 'remote': [], 'aggregate': list(aggregate)}
+        self.metadata_loading = {'pool': pool, 'workers': 4, 'cache_dir': cache_dir}
+        self.metadata_refresh = {'timeout': 1}
+
+
+class PopulateRegistryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        xml = _read_example_metadata()
+        self.paths = []
+        for index in range(3):
+            path = os.path.join(self.tmpdir, 'sp{}.xml'.format(index))
+            with open(path, 'wb') as fp:
+                fp.write(xml.replace(
+                    b'https://spid.test:8000', 'https://sp{}.spid.test'.format(index).encode('ascii')))
+            self.paths.append(path)
+        invalid = os.path.join(self.tmpdir, 'invalid.xml')
+        with open(invalid, 'wb') as fp:
+            fp.write(b'<md:EntityDescriptor')
+        self.paths.append(invalid)
+        self.paths.append(os.path.join(self.tmpdir, 'missing.xml'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _populate(self, pool, cache_dir=None, aggregate=()):
+        registry = ServiceProviderMetadataRegistry()
+        with patch('testenv.config.params', FakeConfig(self.paths, pool, aggregate, cache_dir)):
+            _populate_registry(registry)
+        return registry
+
+    def test_thread_pool(self):
+        registry = self._populate('thread')
+        self.assertEqual(
+            sorted(registry.service_providers),
+            ['https://sp0.spid.test', 'https://sp1.spid.test', 'https://sp2.spid.test'])
+
+    def test_process_pool(self):
+        registry = self._populate('process')
+        self.assertEqual(len(registry.service_providers), 3)
+        metadata = registry.get('https://sp1.spid.test')
+        self.assertTrue(metadata.is_loaded)
+        self.assertEqual(metadata.attributes('1'), registry.get('https://sp2.spid.test').attributes('1'))
+
+    def test_cache(self):
+        self.paths = self.paths[:3]
+        cache_dir = os.path.join(self.tmpdir, 'cache')
+        aggregate = os.path.join(self.tmpdir, 'federation.xml')
+        _write_entities_descriptor(aggregate, 3)
+        with open(aggregate, 'rb') as fp:
+            xml = fp.read()
+        with open(aggregate, 'wb') as fp:
+            fp.write(xml.replace(b'https://sp', b'https://federated-sp'))
+        registry = self._populate('thread', cache_dir, [aggregate])
+        self.assertEqual(len(os.listdir(cache_dir)), 4)
+        expected = dict(
+            (entity_id, registry.get(entity_id).root) for entity_id in registry.service_providers)
+        self.assertEqual(len(expected), 6)
+        with patch('testenv.spmetadata.parse_entity_descriptor') as parse_entity_descriptor:
+            with patch('testenv.spmetadata.ValidatorGroup.validate') as validate:
+                registry = self._populate('thread', cache_dir, [aggregate])
+        self.assertFalse(parse_entity_descriptor.called)
+        self.assertFalse(validate.called)
+        self.assertEqual(
+            dict((entity_id, registry.get(entity_id).root) for entity_id in registry.service_providers),
+            expected)
+        # stale entries are dropped
+        os.remove(aggregate)
+        self._populate('thread', cache_dir)
+        self.assertEqual(len(os.listdir(cache_dir)), 3)
+
+    def test_cache_with_process_pool(self):
+        cache_dir = os.path.join(self.tmpdir, 'cache')
+        registry = self._populate('process', cache_dir)
+        self.assertEqual(len(registry.service_providers), 3)
+        self.assertEqual(len(os.listdir(cache_dir)), 3)
+        # the directory exists already
+        registry = self._populate('process', cache_dir)
+        self.assertEqual(len(registry.service_providers), 3)
+
+    def test_unusable_cache(self):
+        # the cache directory can not be created below a regular file
+        cache_dir = os.path.join(self.paths[0], 'cache')
+        registry = self._populate('thread', cache_dir)
+        self.assertEqual(len(registry.service_providers), 3)
+
+
+class MetadataFileWatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.xml = _read_example_metadata()
+        self.path = os.path.join(self.tmpdir, 'sp.xml')
+        self.other_path = os.path.join(self.tmpdir, 'other.xml')
+        self._write(self.path, self.xml)
+        self.registry = ServiceProviderMetadataRegistry()
+        self.registry.register(ServiceProviderMetadata(_get_loader('local', self.path)))
+        self.watcher = MetadataFileWatcher(self.registry, [self.path, self.other_path])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, path, xml):
+        with open(path, 'wb') as fp:
+            fp.write(xml)
+
+    def test_reload_changed_file(self):
+        snapshot = self.registry.get('https://spid.test:8000')
+        self._write(self.path, self.xml.replace(
+            b'<ds:X509Certificate></ds:X509Certificate>',
+            '<ds:X509Certificate>{}</ds:X509Certificate>'.format(CERTIFICATE).encode('ascii')))
+        self.watcher.check()
+        metadata = self.registry.get('https://spid.test:8000')
+        self.assertIsNot(metadata, snapshot)
+        self.assertEqual(snapshot.certs(), [])
+        self.assertEqual(metadata.certs(), [CERTIFICATE.replace('\n', '')])
+        self.assertEqual(len(self.registry.keyring.get('https://spid.test:8000')), 1)
+        self.assertIs(
+            self.registry.certificate('https://spid.test:8000', load_certificate(CERTIFICATE).fingerprint),
+            self.registry.keyring.get('https://spid.test:8000')[0])
+        self.assertEqual(self.watcher.stats['reloads'], 1)
+        self.assertIsNotNone(self.watcher.stats['last_reload_latency'])
+
+    def test_new_file(self):
+        self.watcher.check()
+        self.assertEqual(self.watcher.stats['reloads'], 0)
+        self._write(self.other_path, self.xml.replace(
+            b'https://spid.test:8000', b'https://other.spid.test'))
+        self.watcher.check()
+        self.assertEqual(
+            sorted(self.registry.service_providers),
+            ['https://other.spid.test', 'https://spid.test:8000'])
+
+    def test_invalid_file_keeps_previous_version(self):
+        self._write(self.path, b'<md:EntityDescriptor')
+        self.watcher.check()
+        self.assertEqual(self.watcher.stats['failures'], 1)
+        self.assertEqual(
+            self.registry.get('https://spid.test:8000').entity_id, 'https://spid.test:8000')
+
+
+def _write_entities_descriptor(path, count):
+    xml = _read_example_metadata().decode('utf-8')
+    entity = xml[xml.index('<md:EntityDescriptor'):]
+    entities = [
+        entity.replace('https://spid.test:8000', 'https://sp{}.spid.test'.format(index))
+        for index in range(count)
+    ]
+    # an Identity Provider and an invalid Service Provider
+    entities.append(
+        '<md:EntityDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata" '
+        'entityID="https://idp.spid.test"><md:IDPSSODescriptor '
+        'protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol"/>'
+        '</md:EntityDescriptor>')
+    entities.append(
+        '<md:EntityDescriptor entityID="https://invalid.spid.test">'
+        '<md:SPSSODescriptor/></md:EntityDescriptor>')
+    with open(path, 'wb') as fp:
+        fp.write((
+            '<?xml version="1.0"?>\n'
+            '<md:EntitiesDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata">'
+            '{}</md:EntitiesDescriptor>'.format(''.join(entities))
+        ).encode('utf-8'))
+
+
+class EntitiesDescriptorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'federation.xml')
+        _write_entities_descriptor(self.path, 20)
+        self.registry = ServiceProviderMetadataRegistry()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_processed_elements_are_released(self):
+        for element in iter_entity_descriptors(self.path):
+            # at most the previous, already cleared, entity is still there
+            previous = element.getprevious()
+            if previous is not None:
+                self.assertEqual(len(previous), 0)
+                self.assertIsNone(previous.getprevious())
+
+    def test_load(self):
+        load_entities_descriptor(self.registry, self.path)
+        self.assertEqual(len(self.registry.service_providers), 20)
+        self.assertNotIn('https://idp.spid.test', self.registry.service_providers)
+        self.assertNotIn('https://invalid.spid.test', self.registry.service_providers)
+        metadata = self.registry.get('https://sp7.spid.test')
+        self.assertEqual(
+            metadata.attributes('1'),
+            self.registry.get('https://sp8.spid.test').attributes('1'))
+
+    def test_reload_single_entity(self):
+        load_entities_descriptor(self.registry, self.path)
+        metadata = self.registry.get('https://sp3.spid.test')
+        self.assertTrue(self.registry.reload('https://sp3.spid.test'))
+        reloaded = self.registry.get('https://sp3.spid.test')
+        self.assertEqual(reloaded.assertion_consumer_services, metadata.assertion_consumer_services)
+
+    def test_truncated_cache_entry(self):
+        cache = MetadataCache(os.path.join(self.tmpdir, 'cache'))
+        key = load_entities_descriptor(self.registry, self.path, cache)
+        entry = os.path.join(self.tmpdir, 'cache', key + MetadataCache.suffix)
+        with open(entry, 'rb') as fp:
+            data = fp.read()
+        with open(entry, 'wb') as fp:
+            fp.write(data[:len(data) // 2])
+        self.assertIsNone(cache.iter_entries(key))
+        registry = ServiceProviderMetadataRegistry()
+        self.assertEqual(load_entities_descriptor(registry, self.path, cache), key)
+        self.assertEqual(len(registry.service_providers), 20)
+        # the entry has been written again
+        self.assertEqual(len(cache.iter_entries(key)), 20)
+
+    def test_cache_write_failure(self):
+        cache = MetadataCache(os.path.join(self.tmpdir, 'cache'))
+        with patch('testenv.spmetadata.pickle.dump', side_effect=IOError(28, 'No space left on device')):
+            key = load_entities_descriptor(self.registry, self.path, cache)
+        self.assertEqual(len(self.registry.service_providers), 20)
+        self.assertIsNone(cache.iter_entries(key))
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir, 'cache')), [])
+
+    def test_populate_registry(self):
+        with patch('testenv.config.params', FakeConfig([], 'thread', [self.path])):
+            _populate_registry(self.registry)
+        self.assertEqual(len(self.registry.service_providers), 20)
+
+
+class LazyServiceProviderMetadataRegistryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'federation.xml')
+        _write_entities_descriptor(self.path, 5)
+        self.local_path = os.path.join(self.tmpdir, 'sp.xml')
+        with open(self.local_path, 'wb') as fp:
+            fp.write(_read_example_metadata().replace(
+                b'<ds:X509Certificate></ds:X509Certificate>',
+                '<ds:X509Certificate>{}</ds:X509Certificate>'.format(CERTIFICATE).encode('ascii')))
+        self.registry = LazyServiceProviderMetadataRegistry(cache_size=2)
+        self.registry.add_file(self.path)
+        self.registry.add_file(self.local_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_index_only_at_startup(self):
+        # the Identity Provider is not indexed
+        self.assertEqual(len(self.registry.service_providers), 7)
+        self.assertFalse(self.registry.is_registered('https://idp.spid.test'))
+        with self.assertRaises(MetadataNotFoundError):
+            self.registry.get('https://idp.spid.test')
+        self.assertEqual(self.registry.loaded(), [])
+        entry = self.registry.index.get('https://spid.test:8000')
+        self.assertEqual(entry.offset, _read_example_metadata().index(b'<md:EntityDescriptor'))
+
+    def test_is_registered(self):
+        self.assertTrue(self.registry.is_registered('https://sp2.spid.test'))
+        self.assertFalse(self.registry.is_registered('https://unknown.spid.test'))
+        # answered by the index, without loading the metadata
+        self.assertEqual(self.registry.loaded(), [])
+
+    def test_load_on_first_use(self):
+        metadata = self.registry.get('https://sp2.spid.test')
+        self.assertEqual(metadata.entity_id, 'https://sp2.spid.test')
+        self.assertEqual(metadata.source, self.path)
+        self.assertIs(self.registry.get('https://sp2.spid.test'), metadata)
+        self.assertEqual(len(self.registry.loaded()), 1)
+
+    def test_lru_eviction(self):
+        self.registry.get('https://sp0.spid.test')
+        self.registry.get('https://sp1.spid.test')
+        self.registry.get('https://sp0.spid.test')
+        self.registry.get('https://spid.test:8000')
+        self.assertEqual(
+            sorted(entity_id for entity_id, _ in self.registry.loaded()),
+            ['https://sp0.spid.test', 'https://spid.test:8000'])
+        self.assertNotIn('https://sp1.spid.test', self.registry.keyring)
+
+    def test_certificates(self):
+        certificates = self.registry.certificates('https://spid.test:8000')
+        self.assertEqual(len(certificates), 1)
+        with self.assertRaises(KeyError):
+            self.registry.certificates('https://unknown.spid.test')
+
+    def test_invalid_entity(self):
+        with self.assertRaises(MetadataNotFoundError):
+            self.registry.get('https://invalid.spid.test')
+        self.assertFalse(self.registry.is_registered('https://invalid.spid.test'))
+        self.assertNotIn('https://invalid.spid.test', self.registry.service_providers)
+        with self.assertRaises(MetadataNotFoundError):
+            self.registry.get('https://unknown.spid.test')
+
+    def test_escaped_entity_id(self):
+        xml = _read_example_metadata().replace(
+            b'entityID="https://spid.test:8000"', b'entityID="https://spid.test/?sp=1&amp;env=test"')
+        # a closing tag in a comment does not end the EntityDescriptor
+        xml = xml.replace(b'<md:SPSSODescriptor', b'<!-- </md:EntityDescriptor> --><md:SPSSODescriptor', 1)
+        with open(self.local_path, 'wb') as fp:
+            fp.write(xml)
+        self.assertEqual(self.registry.add_file(self.local_path), ['https://spid.test/?sp=1&env=test'])
+        metadata = self.registry.get('https://spid.test/?sp=1&env=test')
+        self.assertEqual(metadata.entity_id, 'https://spid.test/?sp=1&env=test')
+
+    def test_comments_and_cdata_are_skipped(self):
+        with open(self.path, 'rb') as fp:
+            xml = fp.read()
+        hidden = (
+            b'<!-- <md:EntityDescriptor entityID="https://comment.spid.test"></md:EntityDescriptor> -->'
+            b'<![CDATA[<md:EntityDescriptor entityID="https://cdata.spid.test"></md:EntityDescriptor>]]>'
+        )
+        with open(self.path, 'wb') as fp:
+            fp.write(xml.replace(b'<md:EntityDescriptor', hidden + b'<md:EntityDescriptor', 1))
+        entity_ids = self.registry.add_file(self.path)
+        self.assertEqual(len(entity_ids), 6)
+        self.assertFalse(self.registry.is_registered('https://comment.spid.test'))
+        self.assertFalse(self.registry.is_registered('https://cdata.spid.test'))
+        self.assertEqual(self.registry.get('https://sp0.spid.test').entity_id, 'https://sp0.spid.test')
+
+    def test_file_changed_after_indexing(self):
+        self.registry.get('https://sp3.spid.test')
+        with open(self.path, 'rb') as fp:
+            xml = fp.read()
+        with open(self.path, 'wb') as fp:
+            fp.write(xml.replace(b'<?xml version="1.0"?>', b'<?xml version="1.0"?>\n<!-- moved -->'))
+        # stale offsets are detected by the content hash
+        self.assertEqual(self.registry.get('https://sp4.spid.test').entity_id, 'https://sp4.spid.test')
+        self.assertTrue(self.registry.reload('https://sp3.spid.test'))
+        self.assertNotIn('https://sp3.spid.test', dict(self.registry.loaded()))
+        self.assertEqual(self.registry.get('https://sp3.spid.test').entity_id, 'https://sp3.spid.test')
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import pickle
+import unittest
+
+from lxml import etree
+
+from testenv.settings import BINDING_HTTP_POST, BINDING_HTTP_REDIRECT
+from testenv.spmodel import AssertionConsumerService, parse_entity_descriptor
+from testenv.tests.test_crypto import CERTIFICATE
+from testenv.tests.test_spmetadata import _read_example_metadata
+
+
+class EntityDescriptorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.xml = _read_example_metadata().replace(
+            b'<ds:X509Certificate></ds:X509Certificate>',
+            '<ds:X509Certificate>{}</ds:X509Certificate>'.format(CERTIFICATE).encode('ascii'), 1)
+        self.entity = parse_entity_descriptor(self.xml)
+
+    def test_model(self):
+        self.assertEqual(self.entity.entity_id, 'https://spid.test:8000')
+        sp = self.entity.sp_sso_descriptor
+        self.assertTrue(sp.authn_requests_signed)
+        self.assertEqual(sp.certificates(), [CERTIFICATE.replace('\n', '')])
+        self.assertEqual(sp.certificates('encryption'), [])
+        self.assertEqual(
+            sp.assertion_consumer_services,
+            (AssertionConsumerService(BINDING_HTTP_POST, 'http://127.0.0.1:8000/acs-test', '0', True),))
+        self.assertEqual(sp.attribute_consuming_services[0].index, '1')
+        self.assertEqual(sp.lookup.slo_by_binding[BINDING_HTTP_REDIRECT][0].location, 'http://127.0.0.1:8000/slo-test')
+
+    def test_slots(self):
+        acs = self.entity.sp_sso_descriptor.assertion_consumer_services[0]
+        self.assertFalse(hasattr(acs, '__dict__'))
+        with self.assertRaises(AttributeError):
+            acs.index = '1'
+
+    def test_from_element(self):
+        self.assertEqual(parse_entity_descriptor(etree.fromstring(self.xml)), self.entity)
+
+    def test_pickle(self):
+        unpickled = pickle.loads(pickle.dumps(self.entity, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(unpickled, self.entity)
+        self.assertEqual(
+            unpickled.sp_sso_descriptor.lookup.acs_by_index['0'],
+            self.entity.sp_sso_descriptor.lookup.acs_by_index['0'])
+
+    def test_lookup_indexes(self):
+        xml = self.xml.replace(b'index="0"', b'', 1)
+        lookup = parse_entity_descriptor(xml).sp_sso_descriptor.lookup
+        # listed as in the validator messages, missing indexes included
+        self.assertEqual(lookup.acs_indexes, ('None',))
+        self.assertEqual(lookup.acs_urls, ('http://127.0.0.1:8000/acs-test',))
+        self.assertEqual(lookup.atcs_indexes, ('1',))
+
+    def test_not_an_entity_descriptor(self):
+        entity = parse_entity_descriptor(b'<root/>')
+        self.assertIsNone(entity.entity_id)
+        self.assertEqual(entity.sp_sso_descriptor.certificates(), [])
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from testenv.storage import InMemoryStateStore, SQLiteStateStore, StateStoreSweeper, create_state_store
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class InMemoryStateStoreTestCase(unittest.TestCase):
+
+    store_class = InMemoryStateStore
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.store = self.store_class('test', ttl=10, max_size=3, clock=self.clock)
+
+    def test_dict_interface(self):
+        self.store['a'] = 1
+        self.assertIn('a', self.store)
+        self.assertEqual(self.store['a'], 1)
+        self.assertEqual(list(self.store.keys()), ['a'])
+        self.assertEqual(len(self.store), 1)
+        self.assertEqual(self.store.pop('a'), 1)
+        self.assertNotIn('a', self.store)
+        self.assertIsNone(self.store.pop('a', None))
+        with self.assertRaises(KeyError):
+            del self.store['a']
+
+    def test_ttl(self):
+        self.store['a'] = 1
+        self.clock.now += 5
+        self.store['b'] = 2
+        self.clock.now += 5
+        self.assertNotIn('a', self.store)
+        self.assertEqual(self.store['b'], 2)
+        self.assertEqual(self.store.stats['expirations'], 1)
+
+    def test_lru_eviction(self):
+        for key in ('a', 'b', 'c'):
+            self.store[key] = key
+        self.store['a']
+        self.store['d'] = 'd'
+        self.assertEqual(sorted(self.store.keys()), ['a', 'c', 'd'])
+        self.assertEqual(self.store.stats['evictions'], 1)
+        self.assertEqual(self.store.stats['size'], 3)
+
+    def test_purge_expired(self):
+        self.store['a'] = 1
+        self.store['b'] = 2
+        self.clock.now += 10
+        self.store['c'] = 3
+        StateStoreSweeper([self.store]).sweep()
+        self.assertEqual(list(self.store.keys()), ['c'])
+        self.assertEqual(self.store.stats['expirations'], 2)
+
+
+class SQLiteStateStoreTestCase(InMemoryStateStoreTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'state.db')
+        self.clock = FakeClock()
+        self.store = SQLiteStateStore(
+            'test', path=self.path, ttl=10, max_size=3, clock=self.clock)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_shared_between_instances(self):
+        # two instances on the same file behave like two workers
+        other = SQLiteStateStore('test', path=self.path, ttl=10, clock=self.clock)
+        unrelated = SQLiteStateStore('other', path=self.path, ttl=10, clock=self.clock)
+        self.store['a'] = ['123456', 'data']
+        self.assertEqual(other['a'], ['123456', 'data'])
+        self.assertNotIn('a', unrelated)
+        self.assertEqual(other.pop('a'), ['123456', 'data'])
+        self.assertNotIn('a', self.store)
+
+
+class CreateStateStoreTestCase(unittest.TestCase):
+
+    def test_memory_backend(self):
+        store = create_state_store('ticket', {'backend': 'memory', 'ttl': 5, 'max_size': 2})
+        self.assertIsInstance(store, InMemoryStateStore)
+        self.assertEqual(store.stats['max_size'], 2)
+
+    def test_sqlite_backend(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            store = create_state_store(
+                'ticket', {'backend': 'sqlite', 'path': os.path.join(tmpdir, 'state.db')})
+            self.assertIsInstance(store, SQLiteStateStore)
+        finally:
+            shutil.rmtree(tmpdir)
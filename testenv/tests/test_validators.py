@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import threading
 import unittest
+from copy import deepcopy
 
 import pytest
 from freezegun import freeze_time
+from lxml import etree
 
 from testenv import settings
 from testenv.exceptions import (
@@ -12,7 +15,15 @@ from testenv.exceptions import (
 )
 from testenv.tests.data import sample_saml_requests as sample_requests
 from testenv.tests.utils import FakeRequest
-from testenv.validators import AuthnRequestXMLSchemaValidator, SpidValidator, XMLFormatValidator
+from testenv.validators import (
+    AuthnRequestXMLSchemaValidator, SpidRulesValidator, SpidSchemaCache, SpidValidator, XMLFormatValidator,
+    XMLSchemaFileLoader, get_spid_validator, spid_schema_cache,
+)
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
 
 
 class FakeTranslator(object):
@@ -56,6 +67,9 @@ class FakeRegistry(object):
     def get(self, entity_id):
         return self._metadata.get(entity_id)
 
+    def is_registered(self, entity_id):
+        return entity_id in self._metadata
+
     @property
     def service_providers(self):
         return list(self._metadata.keys())
@@ -79,6 +93,18 @@ class ServiceProviderMetadataFakeLoader(object):
             {'index': acs[0], 'Location': acs[1]} for acs in self.acs_indexes
         ]
 
+    @property
+    def attribute_consuming_service_indexes(self):
+        return tuple(str(index) for index in self.atcs_indexes)
+
+    @property
+    def assertion_consumer_service_indexes(self):
+        return tuple(str(acs[0]) for acs in self.acs_indexes)
+
+    @property
+    def assertion_consumer_service_urls(self):
+        return tuple(str(acs[1]) for acs in self.acs_indexes)
+
 
 class XMLFormatValidatorTestCase(unittest.TestCase):
 
@@ -133,6 +159,53 @@ class XMLFormatValidatorTestCase(unittest.TestCase):
         validator.validate(request)
 
 
+class XMLSchemaFileLoaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loader = XMLSchemaFileLoader()
+        self.pools = patch.dict(XMLSchemaFileLoader._pools, clear=True)
+        self.pools.start()
+
+    def tearDown(self):
+        self.pools.stop()
+
+    def test_schema_is_compiled_once(self):
+        self.loader.warm_up()
+        with self.loader.schema('protocol') as schema:
+            pass
+        with XMLSchemaFileLoader().schema('protocol') as other:
+            self.assertIs(schema, other)
+        with self.loader.schema('metadata') as other:
+            self.assertIsNot(schema, other)
+
+    def test_concurrent_checkouts(self):
+        self.loader.warm_up(size=2)
+        with patch.object(XMLSchemaFileLoader, '_parse') as parse:
+            with self.loader.schema('protocol') as schema:
+                with self.loader.schema('protocol') as other:
+                    self.assertIsNot(schema, other)
+            self.assertFalse(parse.called)
+            # the pool is empty, another instance is compiled
+            schemas = [self.loader.checkout('protocol') for _ in range(3)]
+            self.assertEqual(parse.call_count, 1)
+            self.assertIs(schemas[2], parse.return_value)
+
+    def test_schema_shared_by_threads(self):
+        self.loader.warm_up()
+        with self.loader.schema('protocol') as schema:
+            pass
+        schemas = []
+
+        def validate():
+            with self.loader.schema('protocol') as schema:
+                schemas.append(schema)
+
+        thread = threading.Thread(target=validate)
+        thread.start()
+        thread.join()
+        self.assertIs(schemas[0], schema)
+
+
 class AuthnRequestXMLSchemaValidatorTestCase(unittest.TestCase):
 
     def test_valid_requests(self):
@@ -220,6 +293,50 @@ class SPIDValidatorTestCase(unittest.TestCase):
 
     maxDiff = None
 
+    def setUp(self):
+        # fake registries differ between tests for the same entity ID
+        spid_schema_cache.invalidate()
+
+    @freeze_time('2018-08-18T06:55:22Z')
+    def test_schema_is_compiled_once_per_service_provider(self):
+        config = FakeConfig('http://localhost:8088/sso',
+                            'http://localhost:8088/')
+        registry = FakeRegistry({
+            'https://localhost:8088/': ServiceProviderMetadataFakeLoader([], [(0, 'http://localhost:3000/spid-sso')])
+        })
+        cache = SpidSchemaCache()
+        validator = SpidValidator(
+            'login', settings.BINDING_HTTP_POST, registry, config, schema_cache=cache)
+        for _ in range(2):
+            request = FakeRequest(sample_requests.auth_no_signature %
+                                  (sample_requests.fake_signature))
+            validator.validate(request)
+        self.assertEqual(len(cache._schemas), 1)
+        schema = validator._get_schema('https://localhost:8088/')
+        self.assertIs(schema, validator._get_schema('https://localhost:8088/'))
+        cache.invalidate('https://other.localhost/')
+        self.assertIs(schema, validator._get_schema('https://localhost:8088/'))
+        cache.invalidate('https://localhost:8088/')
+        self.assertIsNot(schema, validator._get_schema('https://localhost:8088/'))
+
+    def test_schema_invalidated_while_building(self):
+        cache = SpidSchemaCache()
+        key = ('login', settings.BINDING_HTTP_POST, 'https://localhost:8088/', 'http://localhost:8088/')
+        built = []
+
+        def builder():
+            # the metadata changes while the schema is built from it
+            cache.invalidate('https://localhost:8088/')
+            built.append(object())
+            return built[-1]
+
+        self.assertIs(cache.get(key, builder), built[0])
+        self.assertEqual(cache._schemas, {})
+        schema = cache.get(key, lambda: 'schema')
+        self.assertEqual(schema, 'schema')
+        self.assertEqual(cache.get(key, builder), 'schema')
+        self.assertEqual(len(built), 1)
+
     @freeze_time('2018-08-18T06:55:22Z')
     def test_missing_issuer(self):
         # https://github.com/italia/spid-testenv2/issues/133
@@ -402,3 +519,100 @@ class SPIDValidatorTestCase(unittest.TestCase):
         validator = SpidValidator(
             'logout', settings.BINDING_HTTP_REDIRECT, registry, config)
         validator.validate(request)
+
+
+def _request_variants(xml):
+    # the original request plus one copy for every single alteration of
+    # attributes, children and text of each element
+    root = etree.fromstring(xml)
+    yield root
+    for idx, element in enumerate(root.iter(tag=etree.Element)):
+        if element.tag.startswith('{%s}' % (settings.DS)) and element is not root:
+            if element.getparent() is not root:
+                continue
+
+        def _alter(func):
+            new_root = deepcopy(root)
+            func(list(new_root.iter(tag=etree.Element))[idx])
+            return new_root
+
+        for name in element.attrib.keys():
+            yield _alter(lambda el: el.attrib.pop(name))
+            yield _alter(lambda el: el.set(name, 'bogus'))
+        yield _alter(lambda el: el.set('Extra', 'bogus'))
+        yield _alter(lambda el: el.append(etree.Element('{%s}Extra' % (settings.SAML))))
+        yield _alter(lambda el: setattr(el, 'text', 'bogus'))
+        yield _alter(lambda el: setattr(el, 'text', None))
+        if element is not root:
+            yield _alter(lambda el: el.getparent().remove(el))
+
+
+class SpidRulesValidatorParityTestCase(unittest.TestCase):
+
+    def setUp(self):
+        spid_schema_cache.invalidate()
+        self.config = FakeConfig('http://localhost:8088/sso',
+                                 'http://localhost:8088/')
+        self.registry = FakeRegistry({
+            'https://localhost:8088/': ServiceProviderMetadataFakeLoader(
+                ['0'], [(0, 'http://localhost:3000/spid-sso')]
+            )
+        })
+
+    def _validation_result(self, validator_class, action, binding, xml):
+        validator = validator_class(action, binding, self.registry, self.config)
+        try:
+            validator.validate(FakeRequest(xml))
+        except SPIDValidationError as e:
+            return sorted(e.details, key=lambda d: (d.path, d.message, repr(d.value)))
+        except UnknownEntityIDError as e:
+            return str(e)
+
+    def _assert_parity(self, action, xml):
+        variants = 0
+        for root in _request_variants(xml):
+            request = etree.tostring(root)
+            for binding in (settings.BINDING_HTTP_POST, settings.BINDING_HTTP_REDIRECT):
+                self.assertEqual(
+                    self._validation_result(SpidValidator, action, binding, request),
+                    self._validation_result(SpidRulesValidator, action, binding, request),
+                    request
+                )
+            variants += 1
+        self.assertGreater(variants, 30)
+
+    def test_engine_from_config(self):
+        for engine, validator_class in (('voluptuous', SpidValidator), ('lxml', SpidRulesValidator)):
+            self.config.spid_validator_engine = engine
+            validator = get_spid_validator(
+                'login', settings.BINDING_HTTP_POST, self.registry, self.config)
+            self.assertIs(type(validator), validator_class)
+
+    @freeze_time('2018-08-18T06:55:22Z')
+    def test_authn_request(self):
+        for signature in ('', sample_requests.fake_signature):
+            self._assert_parity(
+                'login', sample_requests.auth_no_signature % (signature))
+
+    @freeze_time('2018-08-18T06:55:22Z')
+    def test_authn_request_with_optional_elements(self):
+        xml = sample_requests.auth_no_signature % (
+            '<saml2:Subject Format="%s" NameQualifier="x"/>'
+            '<saml2:Conditions NotBefore="2018-08-18T06:55:22Z" NotOnOrAfter="2018-08-18T07:55:22Z"/>'
+            '<saml2p:Scoping ProxyCount="0"/>' % (settings.NAMEID_FORMAT_ENTITY)
+        )
+        self._assert_parity('login', xml)
+
+    @freeze_time('2018-08-18T06:55:22Z')
+    def test_authn_request_assertion_consumer_service_index(self):
+        xml = sample_requests.auth_no_signature % ('').replace(
+            'AssertionConsumerServiceURL="http://localhost:3000/spid-sso"',
+            'AssertionConsumerServiceIndex="0" AttributeConsumingServiceIndex="0"'
+        ).replace('ProtocolBinding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST"', '')
+        self._assert_parity('login', xml)
+
+    @freeze_time('2018-08-18T06:55:22Z')
+    def test_logout_request(self):
+        for signature in ('', sample_requests.fake_signature):
+            self._assert_parity(
+                'logout', sample_requests.logout_no_signature % (signature))
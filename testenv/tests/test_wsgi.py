@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import unittest
+
+from testenv.wsgi import ProductionServer, create_app
+
+try:
+    from unittest.mock import MagicMock, patch
+except ImportError:
+    from mock import MagicMock, patch
+
+
+class FakeConfig(object):
+    host = '127.0.0.1'
+    port = 8088
+    https = False
+    https_certificate_file_path = 'conf/idp.crt'
+    https_key_file_path = 'conf/idp.key'
+    server = {
+        'workers': 4,
+        'threads': 16,
+        'keepalive': 2,
+        'backlog': 512,
+        'timeout': 60,
+    }
+    storage = {'backend': 'sqlite'}
+
+
+class ProductionServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.conf = FakeConfig()
+        self.app = object()
+
+    def test_options(self):
+        server = ProductionServer(self.app, conf=self.conf)
+        self.assertEqual(server.cfg.bind, ['127.0.0.1:8088'])
+        self.assertEqual(server.cfg.workers, 4)
+        self.assertEqual(server.cfg.threads, 16)
+        self.assertEqual(server.cfg.keepalive, 2)
+        self.assertEqual(server.cfg.backlog, 512)
+        self.assertEqual(server.cfg.timeout, 60)
+        self.assertIsNone(server.cfg.certfile)
+        self.assertIs(server.load(), self.app)
+
+    def test_https(self):
+        self.conf.https = True
+        server = ProductionServer(self.app, conf=self.conf)
+        self.assertEqual(server.cfg.certfile, 'conf/idp.crt')
+        self.assertEqual(server.cfg.keyfile, 'conf/idp.key')
+
+    def test_threads_started_by_workers(self):
+        server = ProductionServer(MagicMock(), conf=self.conf)
+        with patch('testenv.wsgi.spmetadata') as spmetadata:
+            server.cfg.post_fork(server, None)
+        self.assertTrue(spmetadata.start_metadata_refresher.called)
+        self.assertTrue(spmetadata.start_metadata_watcher.called)
+
+
+class CreateAppTestCase(unittest.TestCase):
+
+    def _create_app(self, **kwargs):
+        with patch('testenv.wsgi.config'), patch('testenv.wsgi.warm_up_schemas'), \
+                patch('testenv.wsgi.IdpServer') as idp_server, patch('testenv.wsgi.spmetadata') as spmetadata:
+            create_app(**kwargs)
+        self.assertTrue(spmetadata.build_metadata_registry.called)
+        self.idp_server_kwargs = idp_server.call_args[1]
+        return spmetadata
+
+    def test_start_threads(self):
+        spmetadata = self._create_app()
+        self.assertTrue(self.idp_server_kwargs['start_threads'])
+        self.assertTrue(spmetadata.start_metadata_refresher.called)
+        self.assertTrue(spmetadata.start_metadata_watcher.called)
+
+    def test_without_threads(self):
+        spmetadata = self._create_app(start_threads=False)
+        self.assertFalse(self.idp_server_kwargs['start_threads'])
+        self.assertFalse(spmetadata.start_metadata_refresher.called)
+        self.assertFalse(spmetadata.start_metadata_watcher.called)
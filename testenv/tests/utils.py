@@ -1,9 +1,15 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import datetime
 import os
 import os.path
 
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
 from lxml import etree
 from OpenSSL import crypto
 
@@ -44,3 +50,20 @@ def generate_certificate(fname, path):
         crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
     open(os.path.join(path, '{}.key'.format(fname)), "wb").write(
         crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+
+
+def generate_ecdsa_certificate(fname, path):
+    key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    name = x509.Name([x509.NameAttribute(NameOID.COUNTRY_NAME, 'IT')])
+    now = datetime.datetime.utcnow()
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(
+        key.public_key()
+    ).serial_number(x509.random_serial_number()).not_valid_before(now).not_valid_after(
+        now + datetime.timedelta(days=3650)
+    ).sign(key, hashes.SHA256(), default_backend())
+    with open(os.path.join(path, '{}.crt'.format(fname)), 'wb') as fp:
+        fp.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(os.path.join(path, '{}.key'.format(fname)), 'wb') as fp:
+        fp.write(key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+            serialization.NoEncryption()))
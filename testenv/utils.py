@@ -12,10 +12,27 @@ from lxml import objectify
 
 from testenv.settings import MULTIPLE_OCCURRENCES_TAGS, SPID_ERRORS
 
+try:
+    from types import MappingProxyType as FrozenDict
+except ImportError:  # Python 2: a plain copy, read-only by convention
+    FrozenDict = dict
+
 TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 TIME_FORMAT_WITH_FRAGMENT = re.compile(
     '^(\d{4,4}-\d{2,2}-\d{2,2}T\d{2,2}:\d{2,2}:\d{2,2})(\.\d*)?Z?$')
 
+DURATION_FORMAT = re.compile(
+    r'^(?P<sign>-)?P(?:(?P<years>\d+)Y)?(?:(?P<months>\d+)M)?(?:(?P<days>\d+)D)?'
+    r'(?:T(?:(?P<hours>\d+)H)?(?:(?P<minutes>\d+)M)?(?:(?P<seconds>\d+(?:\.\d+)?)S)?)?$')
+DURATION_SECONDS = {
+    'years': 365 * 86400,
+    'months': 30 * 86400,
+    'days': 86400,
+    'hours': 3600,
+    'minutes': 60,
+    'seconds': 1,
+}
+
 
 def get_spid_error(code):
     error_type = SPID_ERRORS.get(code)
@@ -70,6 +87,22 @@ def str_to_struct_time(timestr, format=TIME_FORMAT):
     return time.gmtime(calendar.timegm(then))
 
 
+def parse_duration(value):
+    """
+    :param value: xs:duration, e.g. PT1H30M
+    :return: seconds (years and months are approximated)
+    """
+    match = DURATION_FORMAT.match(value or '')
+    if match is None or value.rstrip('T').endswith('P'):
+        raise ValueError("Durata non valida: '{}'".format(value))
+    seconds = sum(
+        float(amount) * DURATION_SECONDS[unit]
+        for unit, amount in match.groupdict().items()
+        if unit != 'sign' and amount is not None
+    )
+    return -seconds if match.group('sign') else seconds
+
+
 def prettify_xml(msg):
     msg = etree.tostring(
         msg,
@@ -78,8 +111,57 @@ def prettify_xml(msg):
     return msg.decode('utf-8')
 
 
-def saml_to_dict(xmlstr):
-    root = objectify.fromstring(xmlstr)
+class SAMLRequestContext(object):
+    """
+    Carry a SAML message together with the tree parsed from it, so that
+    all the processing stages of a request share a single parse.
+    """
+
+    def __init__(self, saml_request, parser=None):
+        self.saml_request = saml_request
+        self._parser = parser or etree.XMLParser()
+        self._xml_doc = None
+        self._syntax_error = None
+
+    @property
+    def xml_doc(self):
+        if self._xml_doc is None:
+            if self._syntax_error is not None:
+                raise self._syntax_error
+            try:
+                self._xml_doc = etree.fromstring(
+                    self.saml_request, parser=self._parser)
+            except SyntaxError as e:
+                self._syntax_error = e
+                raise
+        return self._xml_doc
+
+    @property
+    def error_log(self):
+        return self._parser.error_log
+
+
+def get_request_context(request, parser=None):
+    context = getattr(request, 'context', None)
+    if context is None:
+        context = SAMLRequestContext(request.saml_request, parser)
+    return context
+
+
+def element_text(elem):
+    text = elem.text
+    # objectify drops whitespace-only text in elements with children,
+    # trees coming from a plain parser must look the same
+    if text is not None and len(elem) and not text.strip():
+        return None
+    return text
+
+
+def saml_to_dict(xml):
+    if etree.iselement(xml):
+        root = xml
+    else:
+        root = objectify.fromstring(xml)
 
     def _obj(elem):
         children = {}
@@ -98,7 +180,7 @@ def saml_to_dict(xmlstr):
         return {
             'attrs': dict(elem.attrib),
             'children': children,
-            'text': elem.text,
+            'text': element_text(elem),
         }
 
     return {
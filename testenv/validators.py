@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import threading
 from collections import namedtuple
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
 import importlib_resources
@@ -15,11 +17,11 @@ from testenv.exceptions import (
     XMLFormatValidationError, XMLSchemaValidationError,
 )
 from testenv.settings import (
-    BINDING_HTTP_POST, DEFAULT_LIST_VALUE_ERROR, DEFAULT_VALUE_ERROR, DS as SIGNATURE, NAMEID_FORMAT_ENTITY,
-    NAMEID_FORMAT_TRANSIENT, SAML as ASSERTION, SAMLP as PROTOCOL, SPID_LEVELS, TIMEDELTA,
+    BINDING_HTTP_POST, DEFAULT_LIST_VALUE_ERROR, DEFAULT_VALUE_ERROR, DS as SIGNATURE, MULTIPLE_OCCURRENCES_TAGS,
+    NAMEID_FORMAT_ENTITY, NAMEID_FORMAT_TRANSIENT, SAML as ASSERTION, SAMLP as PROTOCOL, SPID_LEVELS, TIMEDELTA,
 )
 from testenv.translation import Libxml2Translator
-from testenv.utils import saml_to_dict, str_to_datetime, str_to_struct_time
+from testenv.utils import element_text, get_request_context, saml_to_dict, str_to_datetime, str_to_struct_time
 
 ValidationDetail = namedtuple(
     'ValidationDetail',
@@ -74,22 +76,22 @@ class XMLFormatValidator(object):
         self._translator = translator or Libxml2Translator()
 
     def validate(self, request):
+        context = get_request_context(request, self._parser)
         try:
-            etree.fromstring(request.saml_request, parser=self._parser)
+            context.xml_doc
         except SyntaxError:
-            self._handle_errors()
+            self._handle_errors(context.error_log)
 
-    def _handle_errors(self):
-        errors = self._build_errors()
+    def _handle_errors(self, error_log):
+        errors = self._build_errors(error_log)
         localized_errors = self._localize_messages(errors)
         raise XMLFormatValidationError(localized_errors)
 
-    def _build_errors(self):
-        errors = self._parser.error_log
+    def _build_errors(self, error_log):
         return [
             ValidationDetail(None, err.line, err.column, err.domain_name,
                              err.type_name, err.message, err.path)
-            for err in errors
+            for err in error_log
         ]
 
     def _localize_messages(self, errors):
@@ -102,25 +104,59 @@ class XMLMetadataFormatValidator(XMLFormatValidator):
         try:
             etree.fromstring(xmlstr, parser=self._parser)
         except SyntaxError:
-            self._handle_errors()
+            self._handle_errors(self._parser.error_log)
 
 
 class XMLSchemaFileLoader(object):
     """
     Load XML Schema instances from the filesystem.
+
+    Compiled schemas are kept in a pool shared by all the threads: the error
+    log of an XMLSchema instance is filled by assertValid(), so an instance
+    is checked out for the duration of a single validation and checked back
+    in afterwards. A new one is compiled only when the pool is empty, i.e.
+    when no instance has been pre-compiled by warm_up() for the concurrency
+    at hand.
     """
 
     _schema_files = {
         'protocol': 'saml-schema-protocol-2.0.xsd',
         'metadata': 'saml-schema-metadata-2.0.xsd',
     }
+    _pools = {}
+    _lock = threading.Lock()
 
     def __init__(self, import_path=None):
         self._import_path = import_path or 'testenv.xsd'
 
-    def load(self, schema_type):
-        path = self._build_path(schema_type)
-        return self._parse(path)
+    @contextmanager
+    def schema(self, schema_type):
+        schema = self.checkout(schema_type)
+        try:
+            yield schema
+        finally:
+            self.checkin(schema_type, schema)
+
+    def checkout(self, schema_type):
+        with self._lock:
+            pool = self._pools.get((self._import_path, schema_type))
+            if pool:
+                return pool.pop()
+        return self._parse(self._build_path(schema_type))
+
+    def checkin(self, schema_type, schema):
+        with self._lock:
+            self._pools.setdefault((self._import_path, schema_type), []).append(schema)
+
+    def warm_up(self, size=1):
+        """
+        Fill the pool with `size` compiled instances of each schema type.
+        """
+        for schema_type in self._schema_files:
+            with self._lock:
+                missing = size - len(self._pools.get((self._import_path, schema_type), []))
+            for _ in range(missing):
+                self.checkin(schema_type, self._parse(self._build_path(schema_type)))
 
     def _build_path(self, schema_type):
         filename = self._schema_files[schema_type]
@@ -133,6 +169,14 @@ class XMLSchemaFileLoader(object):
         return etree.XMLSchema(xmlschema_doc)
 
 
+def warm_up_schemas(schema_loader=None, size=1):
+    """
+    Compile the XML Schemas used for validation before serving requests,
+    `size` instances of each one for as many concurrent validations.
+    """
+    (schema_loader or XMLSchemaFileLoader()).warm_up(size)
+
+
 class BaseXMLSchemaValidator(object):
     """
     Validate XML fragments against XML Schema (XSD).
@@ -145,15 +189,15 @@ class BaseXMLSchemaValidator(object):
 
     def _run(self, xml, schema_type):
         xml_doc = self._parse_xml(xml)
-        schema = self._load_schema(schema_type)
-        return self._validate_xml(xml_doc, schema)
+        return self._run_on_tree(xml_doc, schema_type)
+
+    def _run_on_tree(self, xml_doc, schema_type):
+        with self._schema_loader.schema(schema_type) as schema:
+            return self._validate_xml(xml_doc, schema)
 
     def _parse_xml(self, xml):
         return etree.fromstring(xml, parser=self._parser)
 
-    def _load_schema(self, schema_type):
-        return self._schema_loader.load(schema_type)
-
     def _validate_xml(self, xml_doc, schema):
         try:
             schema.assertValid(xml_doc)
@@ -179,9 +223,9 @@ class BaseXMLSchemaValidator(object):
 class AuthnRequestXMLSchemaValidator(BaseXMLSchemaValidator):
 
     def validate(self, request):
-        xml = request.saml_request
+        xml_doc = get_request_context(request).xml_doc
         schema_type = 'protocol'
-        return self._run(xml, schema_type)
+        return self._run_on_tree(xml_doc, schema_type)
 
 
 class ServiceProviderMetadataXMLSchemaValidator(BaseXMLSchemaValidator):
@@ -190,27 +234,127 @@ class ServiceProviderMetadataXMLSchemaValidator(BaseXMLSchemaValidator):
         schema_type = 'metadata'
         return self._run(metadata, schema_type)
 
+    def validate_element(self, element):
+        schema_type = 'metadata'
+        return self._run_on_tree(element, schema_type)
+
+
+def assertion_consumer_service_check(assertion_consumer_service_indexes, assertion_consumer_service_urls):
+    """
+    Build the check on the mutually exclusive AssertionConsumerService
+    attributes of an AuthnRequest, shared by both SPID validator engines.
+    """
+    indexes = frozenset(assertion_consumer_service_indexes)
+    urls = frozenset(assertion_consumer_service_urls)
+
+    def check_assertion_consumer_service(attrs):
+        keys = attrs.keys()
+        if (
+            'AssertionConsumerServiceURL' in keys and 'ProtocolBinding' in keys and 'AssertionConsumerServiceIndex' not in keys
+        ):
+            _errors = []
+            if attrs['ProtocolBinding'] != BINDING_HTTP_POST:
+                _errors.append(
+                    Invalid(
+                        DEFAULT_VALUE_ERROR.format(BINDING_HTTP_POST), path=['ProtocolBinding']
+                    )
+                )
+            if attrs['AssertionConsumerServiceURL'] not in urls:
+                _errors.append(
+                    Invalid(
+                        DEFAULT_VALUE_ERROR.format(assertion_consumer_service_urls), path=['AssertionConsumerServiceURL'])
+                )
+            if _errors:
+                raise MultipleInvalid(errors=_errors)
+            return attrs
+
+        elif (
+            'AssertionConsumerServiceURL' not in keys and 'ProtocolBinding' not in keys and 'AssertionConsumerServiceIndex' in keys
+        ):
+            if attrs['AssertionConsumerServiceIndex'] not in indexes:
+                raise Invalid(
+                    DEFAULT_LIST_VALUE_ERROR.format(
+                        assertion_consumer_service_indexes),
+                    path=['AssertionConsumerServiceIndex'])
+            return attrs
+
+        else:
+            raise Invalid('Uno e uno solo uno tra gli attributi o gruppi di attributi devono essere presenti: '
+                          '[AssertionConsumerServiceIndex, [AssertionConsumerServiceUrl, ProtocolBinding]]')
+
+    return check_assertion_consumer_service
+
+
+class SpidSchemaCache(object):
+    """
+    Compiled SPID validation schemas, keyed by request type, binding,
+    Service Provider entityID and IdP entityID.
+
+    Schemas are built outside the lock: a generation counter per Service
+    Provider, bumped by invalidate(), keeps a schema built from metadata
+    that changed meanwhile out of the cache.
+    """
+
+    def __init__(self):
+        self._schemas = {}
+        self._generation = 0
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def _current_generation(self, entity_id):
+        return self._generation, self._generations.get(entity_id, 0)
+
+    def get(self, key, builder):
+        with self._lock:
+            try:
+                return self._schemas[key]
+            except KeyError:
+                generation = self._current_generation(key[2])
+        schema = builder()
+        with self._lock:
+            if generation != self._current_generation(key[2]):
+                return schema
+            return self._schemas.setdefault(key, schema)
+
+    def invalidate(self, entity_id=None):
+        with self._lock:
+            if entity_id is None:
+                self._generation += 1
+                self._schemas.clear()
+                return
+            self._generations[entity_id] = self._generations.get(entity_id, 0) + 1
+            for key in list(self._schemas.keys()):
+                if key[2] == entity_id:
+                    del self._schemas[key]
+
+
+spid_schema_cache = SpidSchemaCache()
+
 
 class SpidValidator(object):
 
-    def __init__(self, action, binding, registry=None, conf=None):
+    def __init__(self, action, binding, registry=None, conf=None, schema_cache=None):
         self._action = action
         self._binding = binding
         self._config = conf or config.params
+        self._schema_cache = schema_cache or spid_schema_cache
         if registry:  # FIXME fix circular import. this is ugly.
             self._registry = registry
         else:
             from testenv import spmetadata
             self._registry = spmetadata.registry
 
-    def _check_utc_date(self, date):
+    @staticmethod
+    def _check_utc_date(date):
         try:
             str_to_struct_time(date)
         except Exception:
             raise Invalid('la data non è in formato UTC')
         return date
 
-    def _check_date_in_range(self, date):
+    @staticmethod
+    def _check_date_in_range(date):
+        # evaluated on every validation, even when the schema is cached
         date = str_to_datetime(date)
         now = datetime.utcnow()
         lower = now - timedelta(minutes=TIMEDELTA)
@@ -223,45 +367,96 @@ class SpidValidator(object):
             )
         return date
 
-    def validate(self, request):
-        xmlstr = request.saml_request
-        data = saml_to_dict(xmlstr)
+    @property
+    def _request_type(self):
         if self._action == 'login':
-            req_type = 'AuthnRequest'
+            return 'AuthnRequest'
         elif self._action == 'logout':
-            req_type = 'LogoutRequest'
-        issuer_name = data.get(
-            '{urn:oasis:names:tc:SAML:2.0:protocol}%s' % (req_type), {}
-        ).get(
-            'children', {}
-        ).get(
-            '{urn:oasis:names:tc:SAML:2.0:assertion}Issuer', {}
-        ).get('text')
+            return 'LogoutRequest'
+
+    def _check_issuer(self, issuer_name):
         if issuer_name is None:
             raise UnknownEntityIDError(
-                'Issuer non presente nella {}'.format(req_type)
+                'Issuer non presente nella {}'.format(self._request_type)
             )
-        if issuer_name and issuer_name not in self._registry.service_providers:
+        if issuer_name and not self._registry.is_registered(issuer_name):
             raise UnknownEntityIDError(
                 'entity ID {} non registrato'.format(issuer_name)
             )
+
+    def validate(self, request):
+        xml_doc = get_request_context(request).xml_doc
+        data = saml_to_dict(xml_doc)
+        issuer_name = data.get(
+            '{%s}%s' % (PROTOCOL, self._request_type), {}
+        ).get(
+            'children', {}
+        ).get(
+            '{%s}Issuer' % (ASSERTION), {}
+        ).get('text')
+        self._check_issuer(issuer_name)
+        saml_schema = self._get_schema(issuer_name)
+        errors = []
+        try:
+            saml_schema(data)
+        except MultipleInvalid as e:
+            for err in e.errors:
+                _val = data
+                _paths = []
+                _attr = None
+                for idx, _path in enumerate(err.path):
+                    if _path != 'children':
+                        if _path == 'attrs':
+                            try:
+                                _attr = err.path[(idx + 1)]
+                            except IndexError:
+                                _attr = ''
+                            break
+                        _paths.append(_path)
+                path = '/'.join(_paths)
+                path = 'xpath: {}'.format(path)
+                if _attr is not None:
+                    path = '{} - attribute: {}'.format(path, _attr)
+                for _ in err.path:
+                    _val = _val.get(_)
+                errors.append(
+                    ValidationDetail(
+                        _val, None, None, None, None, err.msg, path
+                    )
+                )
+            raise SPIDValidationError(details=errors)
+
+    def _get_schema(self, issuer_name):
+        key = (self._action, self._binding, issuer_name, self._config.entity_id)
+        return self._schema_cache.get(
+            key, lambda: self._build_schema(issuer_name))
+
+    def _service_provider_indexes(self, issuer_name):
         sp_metadata = self._registry.get(issuer_name)
         if sp_metadata is not None:
-            atcss = sp_metadata.attribute_consuming_services
-            attribute_consuming_service_indexes = [
-                str(
-                    el.get('attrs').get('index')
-                ) for el in atcss if 'index' in el.get('attrs', {})
-            ]
-            ascss = sp_metadata.assertion_consumer_services
-            assertion_consumer_service_indexes = [
-                str(el.get('index')) for el in ascss]
-            assertion_consumer_service_urls = [
-                str(el.get('Location')) for el in ascss]
+            # lists, as they are also shown in the error messages
+            attribute_consuming_service_indexes = list(
+                sp_metadata.attribute_consuming_service_indexes)
+            assertion_consumer_service_indexes = list(
+                sp_metadata.assertion_consumer_service_indexes)
+            assertion_consumer_service_urls = list(
+                sp_metadata.assertion_consumer_service_urls)
         else:
             attribute_consuming_service_indexes = []
             assertion_consumer_service_indexes = []
             assertion_consumer_service_urls = []
+        return (
+            attribute_consuming_service_indexes,
+            assertion_consumer_service_indexes,
+            assertion_consumer_service_urls,
+        )
+
+    def _build_schema(self, issuer_name):
+        (
+            attribute_consuming_service_indexes,
+            assertion_consumer_service_indexes,
+            assertion_consumer_service_urls,
+        ) = self._service_provider_indexes(issuer_name)
         entity_id = self._config.entity_id
 
         issuer = Schema(
@@ -382,40 +577,8 @@ class SpidValidator(object):
 
         # LOGIN
 
-        def check_assertion_consumer_service(attrs):
-            keys = attrs.keys()
-            if (
-                'AssertionConsumerServiceURL' in keys and 'ProtocolBinding' in keys and 'AssertionConsumerServiceIndex' not in keys
-            ):
-                _errors = []
-                if attrs['ProtocolBinding'] != BINDING_HTTP_POST:
-                    _errors.append(
-                        Invalid(
-                            DEFAULT_VALUE_ERROR.format(BINDING_HTTP_POST), path=['ProtocolBinding']
-                        )
-                    )
-                if attrs['AssertionConsumerServiceURL'] not in assertion_consumer_service_urls:
-                    _errors.append(
-                        Invalid(
-                            DEFAULT_VALUE_ERROR.format(assertion_consumer_service_urls), path=['AssertionConsumerServiceURL'])
-                    )
-                if _errors:
-                    raise MultipleInvalid(errors=_errors)
-                return attrs
-
-            elif (
-                'AssertionConsumerServiceURL' not in keys and 'ProtocolBinding' not in keys and 'AssertionConsumerServiceIndex' in keys
-            ):
-                if attrs['AssertionConsumerServiceIndex'] not in assertion_consumer_service_indexes:
-                    raise Invalid(
-                        DEFAULT_LIST_VALUE_ERROR.format(
-                            assertion_consumer_service_indexes),
-                        path=['AssertionConsumerServiceIndex'])
-                return attrs
-
-            else:
-                raise Invalid('Uno e uno solo uno tra gli attributi o gruppi di attributi devono essere presenti: '
-                              '[AssertionConsumerServiceIndex, [AssertionConsumerServiceUrl, ProtocolBinding]]')
+        check_assertion_consumer_service = assertion_consumer_service_check(
+            assertion_consumer_service_indexes, assertion_consumer_service_urls)
 
         authnrequest_attr_schema = Schema(
             All(
@@ -428,7 +591,7 @@ class SpidValidator(object):
                     ),
                     Optional('ForceAuthn'): str,
                     Optional('AttributeConsumingServiceIndex'): In(
-                        attribute_consuming_service_indexes,
+                        frozenset(attribute_consuming_service_indexes),
                         msg=DEFAULT_LIST_VALUE_ERROR.format(
                             attribute_consuming_service_indexes)
                     ),
@@ -527,37 +690,309 @@ class SpidValidator(object):
             required=True,
         )
 
-        saml_schema = None
         if self._action == 'login':
-            saml_schema = authn_request
+            return authn_request
         elif self._action == 'logout':
-            saml_schema = logout_request
+            return logout_request
+
+
+# Native lxml rule engine
+
+_ANY = object()
+EXTRA_KEY_ERROR = 'extra keys not allowed'
+REQUIRED_KEY_ERROR = 'required key not provided'
+
+
+def _rule_detail(value, message, path, attr=None):
+    # same xpath notation used by SpidValidator for voluptuous error paths
+    xpath = 'xpath: {}'.format('/'.join(path))
+    if attr is not None:
+        xpath = '{} - attribute: {}'.format(xpath, attr)
+    return ValidationDetail(value, None, None, None, None, message, xpath)
+
+
+def _element_node(element):
+    if isinstance(element, list):
+        return [_element_node(el) for el in element]
+    return saml_to_dict(element)[element.tag]
+
+
+def _is_str(value):
+    if not isinstance(value, str):
+        raise Invalid('expected str')
+
+
+def _equal(target):
+    def check(value):
+        if value != target:
+            raise Invalid(DEFAULT_VALUE_ERROR.format(target))
+    return check
+
+
+def _one_of(container):
+    members = frozenset(container)
+
+    def check(value):
+        if value not in members:
+            raise Invalid(DEFAULT_LIST_VALUE_ERROR.format(container))
+    return check
+
+
+def _chain(*checks):
+    def check(value):
+        for _check in checks:
+            _check(value)
+    return check
+
+
+class ElementRule(object):
+    """
+    SPID constraints on a single element of a request: its attributes,
+    its children and its text, checked directly on the lxml tree.
+    """
+
+    def __init__(self, attrs=None, children=None, text=None, attrs_check=None):
+        # attrs: {name: (required, check)}, children: {tag: (required, rule)}
+        # or _ANY to accept whatever is there. A rule or a check set to None
+        # accepts any value.
+        self._attrs = {} if attrs is None else attrs
+        self._children = {} if children is None else children
+        self._text = text
+        self._attrs_check = attrs_check
+
+    def validate(self, element):
         errors = []
+        self._validate(element, [element.tag], errors)
+        return errors
+
+    def _validate(self, element, path, errors):
+        self._validate_attrs(element, path, errors)
+        self._validate_children(element, path, errors)
+        self._validate_text(element, path, errors)
+
+    @staticmethod
+    def _run_check(check, value):
         try:
-            saml_schema(data)
-        except MultipleInvalid as e:
-            for err in e.errors:
-                _val = data
-                _paths = []
-                _attr = None
-                for idx, _path in enumerate(err.path):
-                    if _path != 'children':
-                        if _path == 'attrs':
-                            try:
-                                _attr = err.path[(idx + 1)]
-                            except IndexError:
-                                _attr = ''
-                            break
-                        _paths.append(_path)
-                path = '/'.join(_paths)
-                path = 'xpath: {}'.format(path)
-                if _attr is not None:
-                    path = '{} - attribute: {}'.format(path, _attr)
-                for _ in err.path:
-                    _val = _val.get(_)
+            check(value)
+        except ValueError:
+            return 'not a valid value'
+        except Invalid as e:
+            return e.msg
+
+    def _validate_attrs(self, element, path, errors):
+        if self._attrs is _ANY:
+            return
+        attrib = element.attrib
+        failed = False
+        for name, value in attrib.items():
+            if name not in self._attrs:
+                errors.append(_rule_detail(value, EXTRA_KEY_ERROR, path, name))
+                failed = True
+                continue
+            check = self._attrs[name][1]
+            message = check is not None and self._run_check(check, value)
+            if message:
+                errors.append(_rule_detail(value, message, path, name))
+                failed = True
+        for name, (required, _) in self._attrs.items():
+            if required and name not in attrib:
+                errors.append(_rule_detail(None, REQUIRED_KEY_ERROR, path, name))
+                failed = True
+        if not failed and self._attrs_check is not None:
+            self._validate_attrs_check(dict(attrib), path, errors)
+
+    def _validate_attrs_check(self, attrs, path, errors):
+        try:
+            self._attrs_check(attrs)
+        except Invalid as e:
+            for err in getattr(e, 'errors', [e]):
+                if err.path:
+                    name = err.path[0]
+                    errors.append(_rule_detail(attrs.get(name), err.msg, path, name))
+                else:
+                    errors.append(_rule_detail(attrs, err.msg, path, ''))
+
+    def _validate_children(self, element, path, errors):
+        if self._children is _ANY:
+            return
+        children = {}
+        for child in element.iterchildren(tag=etree.Element):
+            # group children like saml_to_dict does
+            if child.tag in MULTIPLE_OCCURRENCES_TAGS:
+                children.setdefault(child.tag, []).append(child)
+            else:
+                children[child.tag] = child
+        for tag, child in children.items():
+            if tag not in self._children:
                 errors.append(
-                    ValidationDetail(
-                        _val, None, None, None, None, err.msg, path
-                    )
-                )
+                    _rule_detail(_element_node(child), EXTRA_KEY_ERROR, path + [tag]))
+                continue
+            rule = self._children[tag][1]
+            if rule is None:
+                continue
+            if isinstance(child, list):
+                errors.append(
+                    _rule_detail(_element_node(child), 'expected a dictionary', path + [tag]))
+                continue
+            rule._validate(child, path + [tag], errors)
+        for tag, (required, _) in self._children.items():
+            if required and tag not in children:
+                errors.append(_rule_detail(None, REQUIRED_KEY_ERROR, path + [tag]))
+
+    def _validate_text(self, element, path, errors):
+        if self._text is _ANY:
+            return
+        text = element_text(element)
+        if self._text is None:
+            message = text is not None and 'not a valid value'
+        else:
+            message = self._run_check(self._text, text)
+        if message:
+            errors.append(_rule_detail(text, message, path + ['text']))
+
+
+class SpidRulesValidator(SpidValidator):
+    """
+    Enforce the same rules as SpidValidator, reporting the same details,
+    without converting the request to a dictionary first.
+    """
+
+    def validate(self, request):
+        xml_doc = get_request_context(request).xml_doc
+        issuer_name = self._issuer_name(xml_doc)
+        self._check_issuer(issuer_name)
+        rule = self._get_schema(issuer_name)
+        errors = rule.validate(xml_doc)
+        if errors:
             raise SPIDValidationError(details=errors)
+
+    def _issuer_name(self, xml_doc):
+        if xml_doc.tag != '{%s}%s' % (PROTOCOL, self._request_type):
+            return None
+        issuer = None
+        for issuer in xml_doc.iterchildren(tag='{%s}Issuer' % (ASSERTION)):
+            pass
+        if issuer is not None:
+            return element_text(issuer)
+
+    def _get_schema(self, issuer_name):
+        key = (self._action, self._binding, issuer_name, self._config.entity_id, 'lxml')
+        return self._schema_cache.get(
+            key, lambda: self._build_schema(issuer_name))
+
+    def _build_schema(self, issuer_name):
+        (
+            attribute_consuming_service_indexes,
+            assertion_consumer_service_indexes,
+            assertion_consumer_service_urls,
+        ) = self._service_provider_indexes(issuer_name)
+        entity_id = self._config.entity_id
+
+        issuer = ElementRule(
+            attrs={
+                'Format': (True, _equal(NAMEID_FORMAT_ENTITY)),
+                'NameQualifier': (True, _equal(issuer_name)),
+            },
+            text=_is_str,
+        )
+        name_id = ElementRule(
+            attrs={
+                'NameQualifier': (True, _is_str),
+                'Format': (True, _equal(NAMEID_FORMAT_TRANSIENT)),
+            },
+            text=_is_str,
+        )
+        name_id_policy = ElementRule(
+            attrs={
+                'Format': (True, _equal(NAMEID_FORMAT_TRANSIENT)),
+            },
+        )
+        conditions = ElementRule(
+            attrs={
+                'NotBefore': (True, _chain(_is_str, self._check_utc_date)),
+                'NotOnOrAfter': (True, _chain(_is_str, self._check_utc_date)),
+            },
+        )
+        authn_context_class_ref = ElementRule(
+            text=_chain(_is_str, _one_of(SPID_LEVELS)),
+        )
+        requested_authn_context = ElementRule(
+            attrs={
+                'Comparison': (True, _is_str),
+            },
+            children={
+                '{%s}AuthnContextClassRef' % (ASSERTION): (True, authn_context_class_ref),
+            },
+        )
+        scoping = ElementRule(
+            attrs={
+                'ProxyCount': (True, _equal('0')),
+            },
+        )
+        signature = ElementRule(attrs=_ANY, children=_ANY)
+        subject = ElementRule(
+            attrs={
+                'Format': (True, _equal(NAMEID_FORMAT_ENTITY)),
+                'NameQualifier': (True, _is_str),
+            },
+        )
+        issue_instant = _chain(_is_str, self._check_utc_date, self._check_date_in_range)
+        # the request attributes are wrapped in All() by SpidValidator,
+        # where voluptuous does not enforce required keys: the XSD does
+
+        if self._action == 'login':
+            children = {
+                '{%s}Subject' % (ASSERTION): (False, subject),
+                '{%s}Issuer' % (ASSERTION): (True, issuer),
+                '{%s}NameIDPolicy' % (PROTOCOL): (True, name_id_policy),
+                '{%s}Conditions' % (ASSERTION): (False, conditions),
+                '{%s}RequestedAuthnContext' % (PROTOCOL): (True, requested_authn_context),
+                '{%s}Scoping' % (PROTOCOL): (False, scoping),
+            }
+            if self._binding == BINDING_HTTP_POST:
+                children['{%s}Signature' % (SIGNATURE)] = (True, signature)
+            return ElementRule(
+                attrs={
+                    'ID': (False, _is_str),
+                    'Version': (False, _equal('2.0')),
+                    'IssueInstant': (False, issue_instant),
+                    'Destination': (False, _equal(entity_id)),
+                    'ForceAuthn': (False, _is_str),
+                    'AttributeConsumingServiceIndex': (False, _one_of(attribute_consuming_service_indexes)),
+                    'AssertionConsumerServiceIndex': (False, _is_str),
+                    'AssertionConsumerServiceURL': (False, _is_str),
+                    'ProtocolBinding': (False, _is_str),
+                },
+                attrs_check=assertion_consumer_service_check(
+                    assertion_consumer_service_indexes, assertion_consumer_service_urls),
+                children=children,
+            )
+        elif self._action == 'logout':
+            children = {
+                '{%s}Issuer' % (ASSERTION): (True, issuer),
+                '{%s}NameID' % (ASSERTION): (True, name_id),
+                '{%s}SessionIndex' % (PROTOCOL): (True, None),
+            }
+            if self._binding == BINDING_HTTP_POST:
+                children['{%s}Signature' % (SIGNATURE)] = (True, signature)
+            return ElementRule(
+                attrs={
+                    'ID': (False, _is_str),
+                    'Version': (False, _equal('2.0')),
+                    'IssueInstant': (False, issue_instant),
+                    'Destination': (False, _equal(entity_id)),
+                },
+                children=children,
+            )
+
+
+SPID_VALIDATOR_ENGINES = {
+    'voluptuous': SpidValidator,
+    'lxml': SpidRulesValidator,
+}
+
+
+def get_spid_validator(action, binding, registry=None, conf=None):
+    conf = conf or config.params
+    validator_class = SPID_VALIDATOR_ENGINES[conf.spid_validator_engine]
+    return validator_class(action, binding, registry, conf)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+import os.path
+
+from flask import Flask
+from gunicorn.app.base import BaseApplication
+
+from testenv import config, spmetadata
+from testenv.server import IdpServer
+from testenv.validators import warm_up_schemas
+
+logger = logging.getLogger(__name__)
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def create_app(config_path='./conf/config.yaml', config_type='yaml', start_threads=True):
+    """
+    Build the Flask application of the test IdP, e.g. for
+
+        gunicorn "testenv.wsgi:create_app()"
+
+    Without `start_threads` the state store sweeper and the metadata
+    refresher and watcher are left to the processes serving the requests,
+    see ProductionServer.
+    """
+    config.load(config_path, config_type)
+    warm_up_schemas(size=config.params.server['threads'])
+    spmetadata.build_metadata_registry()
+    app = Flask('spid-testenv', root_path=ROOT_PATH, static_url_path='/static')
+    app.extensions['idp_server'] = IdpServer(app=app, start_threads=start_threads)
+    if start_threads:
+        spmetadata.start_metadata_refresher()
+        spmetadata.start_metadata_watcher()
+    return app
+
+
+class ProductionServer(BaseApplication):
+    """
+    Serve the application with gunicorn: preforked workers, each one
+    running a pool of threads. The background threads are started by every
+    worker after the fork, so the application is built with
+    create_app(start_threads=False).
+    """
+
+    def __init__(self, app, conf=None):
+        self._app = app
+        self._config = conf or config.params
+        super(ProductionServer, self).__init__()
+
+    @property
+    def options(self):
+        server = self._config.server
+        options = {
+            'bind': '{}:{}'.format(self._config.host, self._config.port),
+            'worker_class': 'gthread',
+            'workers': server['workers'],
+            'threads': server['threads'],
+            'keepalive': server['keepalive'],
+            'backlog': server['backlog'],
+            'timeout': server['timeout'],
+            'post_fork': self._post_fork,
+        }
+        if self._config.https:
+            options['certfile'] = self._config.https_certificate_file_path
+            options['keyfile'] = self._config.https_key_file_path
+        return options
+
+    def _post_fork(self, server, worker):
+        # threads are not inherited by the forked workers
+        self._app.extensions['idp_server'].start_sweeper()
+        spmetadata.start_metadata_refresher()
+        spmetadata.start_metadata_watcher()
+
+    def load_config(self):
+        if self._config.server['workers'] > 1 and self._config.storage['backend'] == 'memory':
+            logger.warning(
+                'Con più di un worker lo stato delle richieste non è condiviso '
+                'tra i processi: configurare lo storage "sqlite"')
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self._app